@@ -29,6 +29,20 @@
      - Thread is deamonic (it automatically ends when program exit)
      - Redesigned state machine 
      - Use numpy array
+     - Vectorized decoding of whole windows (numpy structured dtype)
+     - Optional preallocation (SESSION_DURATION) or fixed-memory ring buffer (HISTORY)
+     - Optional compact storage of raw counts, converted to units only when read (COMPACT)
+     - Optional disk-backed (memory-mapped) vectors for sessions longer than the RAM allows (MAPPED)
+     - Optional asyncio engine for many MuvBoxes on one event loop (M.engine, see muvbox_engine.py)
+     - Optional packet journal on disk while acquiring (M.JOURNAL, see muvbox_journal.py)
+     - Optional continuous recording to rolling csv, HDF5 or Parquet files while acquiring (M.RECORD, see muvbox_export.py)
+     - Acquisition counters and gauges (M.stats(), Prometheus endpoint in muvbox_metrics.py)
+     - Leveled logging (logger 'muvbox'), bounded log ring per MuvBox and rate-limit of repeated messages
+     - Sample rate (acq_rate), jitter histogram, gaps and rtc resets tracked from the rtc of each block (M.time_health)
+     - Parallel connect with a deadline (connect_all) and persistent DNS cache (M.dns_cache = MuvBox_DNSCache())
+     - Optional automatic reconnection with exponential backoff, keeping the data (M.AUTO_RECONNECT, M.outages)
+     - Firmware registry (FIRMWARES): packet layout, window, scales and channels of each firmware version,
+       decoder compiled at connect time (register_firmware adds new firmware versions)
      - 
 
     Example:
@@ -43,6 +57,12 @@
     M.stop()
     M.disconnect()
 
+    Messages are sent to the logger 'muvbox' (M.logger) and the last LOG_RING_SIZE records are kept in
+    M.log_ring. They are also printed (stdout) while M.LOG_CONSOLE is True. An application reading
+    M.log_ring (as muvbox_control) sets M.LOG_CONSOLE = False. Repeated warnings and errors are
+    rate-limited (MuvBox_RateLimit). The logger does not propagate to the root logger (messages would
+    be printed twice): to write them to a file, add a handler to logging.getLogger('muvbox').
+
     Data is stored in 'sensors.data' matriz and can be accessed while MuvBox is running
     or after stop reading. Each column corresponds to a sensor and lines to sampled data.
     For example:
@@ -56,10 +76,28 @@
     gyrz = M.sensors.data[:,6]
     bat = M.sensors.data[:,7]
 
+    Firmware versions with magnetometer (M.mag_present) add the columns magx, magy, magz (8 to 10, in uT).
+    The columns of each firmware version are listed in M.firmware.channels.
+
+    While MuvBox is running, read the vectors from another thread with view(), latest(n) or
+    snapshot(t_from, t_to), which return consistent (zero-copy) views. Example:
+
+    last_second = M.sensors.latest(M.ACQ_FREQ)
+    window = M.sensors.snapshot(M.rtc0 + 10, M.rtc0 + 20)
+
     acc is in g (~9.81 m/s^2) and gyr in °/s. Time is in seconds
 
     Battery level information is stored in column 'bat', in %.
 
+    By default the whole session is kept in memory. Set M.SESSION_DURATION (seconds) to preallocate
+    the vectors, or M.HISTORY (seconds) to keep only the most recent data with constant memory.
+    Set M.COMPACT to keep the sensors as raw counts (about 20 bytes per sample instead of 64, see
+    MuvBox_RawFrame). Values are converted when read: M.sensors.data[:,1] returns accx in g as above.
+    Set M.MAPPED to keep the vectors in temporary files (MuvBox_MappedFrame, in M.MAPPED_PATH) instead of
+    the RAM. Only the most recent data stays resident; older data is read from disk when accessed.
+    Set M.RECORD to save the data to rolling files while acquiring (MuvBox_Recorder, in M.RECORD_PATH). Only
+    the last RECORD_HISTORY seconds are kept in memory; the files are listed in M.recorder_files.
+
     Euler angles are calculated if flag 'calculate_quaternion' is set. 
     Values are stored in 'angles.data' matrix. Quaternions are stored in 'Q.data' matrix.
     Example:
@@ -69,31 +107,219 @@
     roll = M.angles.data[:,3]
     Q = M.Q.data[:,1:5]
 
+    If flag 'ahrs_process' is set, the orientation filter runs in a separate process and 'Q' and 'angles'
+    are filled as results arrive. The delay between sensor time and angle time is given by 'ahrs_lag' (s).
+
     
 """
 import numpy as np
 import pandas as pd
 
 import struct
-#import time
+import time
 import datetime
 
 import socket
 from socket import AF_INET, SOCK_DGRAM
 
-from threading import Thread, current_thread
+from threading import Thread, Event, Lock, current_thread
 
 from ahrs.filters import Madgwick
 from ahrs import Quaternion
 import ahrs
 
+import os
+import sys
 import json
+import mmap
+import logging
+import tempfile
+from collections import deque
+
+from muvbox_ahrs import madgwick_imu, madgwick_marg, quaternion_to_angles, MuvBox_AHRSWorker
+from muvbox_journal import MuvBox_Journal
+from muvbox_export import EXPORTERS, export_metadata, MuvBox_Recorder
+
+
+logger = logging.getLogger('muvbox')  # Driver messages. Records of a MuvBox have the attribute 'muvbox'
+
+
+class MuvBox_RingHandler(logging.Handler):
+    # Stores each record in the log_ring of its MuvBox (bounded deque). Formatting is left to the consumer.
+
+    def emit(self, record):
+        m = getattr(record, 'muvbox', None)
+        if m is not None:
+            m.log_ring.append(record)
+
+
+class MuvBox_ConsoleHandler(logging.StreamHandler):
+    # Prints the records of MuvBoxes with LOG_CONSOLE set, and records of no MuvBox, to stdout
+    # (as print_log did when there was no logbox)
+
+    def __init__(self):
+        super().__init__(sys.stdout)
+        self.setFormatter(MuvBox_Formatter())
+
+    def emit(self, record):
+        m = getattr(record, 'muvbox', None)
+        if m is None or getattr(m, 'LOG_CONSOLE', True):
+            self.stream = sys.stdout    # current stdout (may be redirected)
+            super().emit(record)
+
+
+class MuvBox_RateLimit(logging.Filter):
+    # Lets at most 'burst' records of level 'level' or above with the same message template (per MuvBox)
+    # pass every 'interval' seconds, whatever their arguments. When the window reopens, the number of
+    # suppressed records is added to the next record that passes ('suppressed'). Records below 'level'
+    # always pass.
+
+    MAX_KEYS = 1000     # Windows kept; expired windows are removed when there are more
+
+    def __init__(self, interval=10.0, burst=3, level=logging.WARNING):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self.level = level
+        self._windows = {}  # (MuvBox, message template): [start of window, records in window, suppressed]
+
+    def filter(self, record):
+        if record.levelno < self.level:
+            return True
+        if len(self._windows) > self.MAX_KEYS:
+            self._windows = {k: w for k, w in self._windows.items() if record.created - w[0] < self.interval}
+            if len(self._windows) > self.MAX_KEYS:
+                self._windows.clear()
+        msg = record.msg if record.msg != '%s' else record.getMessage()  # print_log passes the whole text
+        key = (id(getattr(record, 'muvbox', None)), msg)
+        w = self._windows.get(key)
+        if w is None or record.created - w[0] >= self.interval:
+            suppressed = w[2] if w is not None else 0
+            self._windows[key] = [record.created, 1, 0]
+            if suppressed:
+                record.suppressed = suppressed
+            return True
+        if w[1] < self.burst:
+            w[1] += 1
+            return True
+        w[2] += 1
+        return False
+
+
+class MuvBox_Formatter(logging.Formatter):
+    # '* name #number: message', as print_log used to build
+
+    def format(self, record):
+        s = super().format(record)
+        m = getattr(record, 'muvbox', None)
+        if m is not None:
+            s = '* ' + m.name + ' #' + str(m.muvbox_number) + ': ' + s
+        if getattr(record, 'suppressed', 0):
+            s += ' (' + str(record.suppressed) + ' similar messages suppressed)'
+        return s
+
+
+logger.setLevel(logging.INFO)
+logger.propagate = False   # printed by MuvBox_ConsoleHandler
+logger.addHandler(MuvBox_RingHandler())
+logger.addHandler(MuvBox_ConsoleHandler())
+logger.addFilter(MuvBox_RateLimit())
+
+
+class MuvBox_Firmware:
+    # Data format of one firmware version (registered in FIRMWARES with register_firmware).
+    # packet: numpy structured dtype of one packet, with the fields start (must be 0), time (rtc),
+    # acc (3 axes), gyr (3 axes), bat (mV) and end (must be 255). An optional field mag (3 axes)
+    # adds the magnetometer channels.
+
+    CHANNELS = ['time', 'accx', 'accy', 'accz', 'gyrx', 'gyry', 'gyrz', 'bat']   # Columns of sensors
+    MAG_CHANNELS = ['magx', 'magy', 'magz']                                        # Appended if mag_present
+
+    def __init__(self, version, packet, window, gscales, degscales, mag_scale=None, word_size=16,
+                 timescale=1/1000000, bat_vmax=4, bat_vmin=3.6):
+        self.version = version          # firmware_version (int, characters 5 to 7 of the firmware string)
+        self.packet = packet
+        self.window = window            # Packets per window sent by MuvBox
+        self.gscales = gscales          # Accelerometer range (g) for ACCSCALE = 0, 1, ...
+        self.degscales = degscales      # Gyroscope range (°/s) for GYROSCALE = 0, 1, ...
+        self.mag_scale = mag_scale      # Magnetometer counts per uT (if packet has the field mag)
+        self.word_size = word_size      # Number of bits of the accelerometer and gyroscope registers
+        self.timescale = timescale      # rtc unit (s)
+        self.bat_vmax = bat_vmax        # Voltage for 100% battery
+        self.bat_vmin = bat_vmin        # Voltage for 0% battery
+        self.mag_present = 'mag' in packet.names
+        self.channels = self.CHANNELS + (self.MAG_CHANNELS if self.mag_present else [])
+
+    def compile(self, m):
+        # Decoder with the current scales of MuvBox m (TO_G, TO_DPS, TIMESCALE and battery limits)
+        return MuvBox_Decoder(self, m.TO_G, m.TO_DPS, m.TIMESCALE, m.BAT_VMIN, m.BAT_VMAX)
+
+
+class MuvBox_Decoder:
+    # Packet decoder of one firmware version, compiled with fixed scales (see MuvBox_Firmware.compile).
+    # Column positions and constants are resolved here, so decoding a block of packets has no branch
+    # on the firmware version.
+
+    def __init__(self, firmware, to_g, to_dps, timescale, bat_vmin, bat_vmax):
+        self.firmware = firmware
+        self.dtype = firmware.packet
+        self.cols = len(firmware.channels)
+        self.timescale = timescale
+        self.bat_vmin = bat_vmin
+        self.bat_range = bat_vmax - bat_vmin
+        c = firmware.channels.index
+        self.fields = [('acc', slice(c('accx'), c('accz')+1), to_g),      # (packet field, columns, counts per unit)
+                       ('gyr', slice(c('gyrx'), c('gyrz')+1), to_dps)]
+        if firmware.mag_present:
+            self.fields.append(('mag', slice(c('magx'), c('magz')+1), firmware.mag_scale))
+        self.bat_column = c('bat')
+
+    def __call__(self, packets, rtc_offset=0.0):
+        # Convert an array of packets to a (n, cols) block. Same units and rounding as MuvBox.appendSensors
+        block = np.empty((len(packets), self.cols))
+        block[:, 0] = packets['time'] * self.timescale + rtc_offset
+        for field, columns, scale in self.fields:
+            block[:, columns] = packets[field] / scale
+        block[:, self.bat_column] = self.battery(packets['bat'])
+        return block
+
+    def battery(self, mv):
+        # Battery level (%) from the values of the field bat (mV)
+        batteryLocal = mv*1E-3  # transform to Volts
+        return np.trunc(100*((batteryLocal-self.bat_vmin)/self.bat_range))
+
+
+FIRMWARES = {}  # firmware_version -> MuvBox_Firmware
+
+
+def register_firmware(firmware):
+    # Add (or replace) the data format of a firmware version
+    FIRMWARES[firmware.version] = firmware
+    return firmware
+
+
+# Firmware version 0 (FM10V000.xxx): MuvBox M1, 6-DOF, 150 packets of 24 bytes (little-endian) per window
+register_firmware(MuvBox_Firmware(0,
+                                  np.dtype([('start', 'u1'),        # start byte (must be 0)
+                                            ('time', '<u8'),        # rtc, in us
+                                            ('acc', '<i2', (3,)),   # ax, ay, az
+                                            ('gyr', '<i2', (3,)),   # gx, gy, gz
+                                            ('bat', '<i2'),         # battery level, in mV
+                                            ('end', 'u1')]),        # end byte (must be 255)
+                                  window=150,
+                                  gscales=[2, 4, 8, 16],
+                                  degscales=[250, 500, 1000, 2000]))
+
 
 class MuvBox():
 
     PC_DRIVER_VERSION = '0.9'   # Version of Python MuvBox driver
+    LOG_RING_SIZE = 1000        # Maximum number of log records kept in log_ring
+
+    PACKET_V0 = FIRMWARES[0].packet  # Packet layout for firmware version 0 (24 bytes). See MuvBox_Firmware.
 
     def __init__(self, m:int=0, ip:str='192.168.0.1', version:str='FM10V000.950', port:int=8001):
+        self._stop_event = Event()  # Set to stop the reading thread (see stop_reading)
         self.muvbox_number = m  # MuvBox number in the application
         self.ip = ip            # IP address
         self.port = port        # Port number
@@ -101,14 +327,21 @@ class MuvBox():
         self.mac = ''           # MuvBox mac address
         self.firmware_version_full = version # MuvBox firmware version informed by application
         self.firmware_version = int(self.firmware_version_full[5:8])
+        self.firmware = FIRMWARES.get(self.firmware_version)  # Data format (None: firmware version unknown)
+        self.decoder = None      # Packet decoder compiled for the current scales (see compile_decoder)
         
-        self.logbox = None
+        self.logger = logging.LoggerAdapter(logger, {'muvbox': self})  # Messages of this MuvBox (see MuvBox_RingHandler)
+        self.log_ring = deque(maxlen=self.LOG_RING_SIZE)                # Last log records, drained by the application
+        self.LOG_CONSOLE = True  # Print messages to stdout (False when the application reads log_ring)
 
         # Data packet
         self.WINDOWS_SIZE = 24*20  # read 20 samples at once
         self.STEP = 24             # number of bits per packet
         self.PROTOCOL = 'TCP'      # Only TCP implemented
         self.TIMEOUT = 5           # Maximum wifi waiting time, in seconds
+        self.RX_WINDOWS = 8        # Maximum number of windows read by a single recv call
+        self.RCVBUF_SIZE = 2**20   # Socket receive buffer (SO_RCVBUF), in bytes
+        self.framer = MuvBox_Framer(self.PACKET_V0, self.WINDOWS_SIZE*self.RX_WINDOWS)  # Receive buffer and packet synchronization
 
         # Sensors scales
         self.ACQ_FREQ = 1000   # nominal acquisition rate (samples/s)
@@ -131,19 +364,66 @@ class MuvBox():
         self.free_heap = 0     # free MuvBox memory
         self.sensor_task = ''  # status of MuvBox sensor chip
 
-        self.mag_present = False  # Indicates the presence of magnetometer
+        self.mag_present = False  # Indicates the presence of magnetometer (columns magx, magy, magz of sensors)
         
         self.location = ''       # Location of MuvBox in the application (free text)
         self.name = ''           # MuvBox hostname
         
         self.status = 'Offline'  # Current MuvBox status
-        self.acq_rate = 0        # Current MuvBox instant acquisition rate
+        self.acq_rate = 0        # Current MuvBox acquisition rate (samples/s, EWMA from time_health)
+        self.time_health = MuvBox_TimeHealth(self.ACQ_FREQ)  # Rate, jitter, gaps and rtc resets of the current session
         
         self.color = [0,0,0]     # black
         
         self.rtc0 = 0.0          # Initial time
 
+        # Memory usage
+        self.SESSION_DURATION = 0  # Expected session duration (s). Used to preallocate data vectors (0: grow on demand)
+        self.HISTORY = 0           # If > 0, keep only the last HISTORY seconds of data in memory (ring buffer)
+        self.COMPACT = False       # Keep sensors as raw counts (MuvBox_RawFrame). Not used with HISTORY
+        self.MAPPED = False        # Keep the vectors in memory-mapped temporary files (MuvBox_MappedFrame). Not used with HISTORY
+        self.MAPPED_PATH = None    # Directory of the mapped files (None: system temporary directory)
+
+        # Packet journal
+        self.JOURNAL = False       # Record all received packets to a file while acquiring (muvbox_journal)
+        self.JOURNAL_PATH = './data/'
+        self.journal = None        # Journal of the current session
+
+        # Continuous recording (rolling files)
+        self.RECORD = False              # Save the data to files while acquiring (muvbox_export.MuvBox_Recorder)
+        self.RECORD_PATH = './data/'
+        self.RECORD_FORMAT = 'csv'       # csv, hdf5 or parquet
+        self.RECORD_ROTATE_SIZE = 2**27  # New file after about RECORD_ROTATE_SIZE bytes (0: no limit)
+        self.RECORD_ROTATE_TIME = 3600   # New file after RECORD_ROTATE_TIME seconds of data (0: no limit)
+        self.RECORD_INTERVAL = 1.0       # New lines are written every RECORD_INTERVAL seconds
+        self.RECORD_HISTORY = 60         # Seconds kept in memory while recording (if HISTORY is 0)
+        self.recorder = None             # Recorder of the current session
+        self.recorder_files = []         # Files of the last recording
+
+        # Acquisition metrics of the current session (see stats())
+        self.bytes_received = 0           # Bytes received from the socket
+        self.packets_decoded = 0          # Valid packets appended to sensors
+        self.append_latency = 0.0         # Time from the last recv to the end of append_block (s)
+        self.append_latency_max = 0.0
+        self.battery_trend = 0.0          # Battery variation (%/h), measured every BATTERY_TREND_INTERVAL
+        self.BATTERY_TREND_INTERVAL = 60  # seconds
+        self._t_recv = 0.0                # perf_counter of the last recv
+
+        # Automatic reconnection (opt-in)
+        self.AUTO_RECONNECT = False   # Reconnect and restart transmission when the connection is lost while reading
+        self.RECONNECT_MIN = 0.5      # First delay between attempts (s), doubled after each failure
+        self.RECONNECT_MAX = 30       # Maximum delay between attempts (s)
+        self.RECONNECT_ATTEMPTS = 0   # Maximum number of attempts per outage (0: until stop)
+        self.reconnections = 0        # Successful reconnections in the current session
+        self.outages = []             # (time before, time after, seconds offline) of each outage, time in s
+        self.rtc_offset = 0.0         # Added to the MuvBox time (s) when its rtc restarted after an outage
+        self.rtc_offsets = []         # (packets_decoded, rtc_offset) at each change, saved in the journal
+        self._outage = None           # (time before, wall-clock time) while reconnecting
+        self._battery_ref = None          # (time, battery) at the beginning of the trend interval
+
         self.sock = None         # WIFI Socket
+        self.dns_cache = None    # MuvBox_DNSCache shared by the application (optional)
+        self._ip_from_cache = False
 
         ## Data vectors
         # Units:
@@ -151,162 +431,330 @@ class MuvBox():
         # acc: g (gravity)
         # gyr: °/s (degrees per second)
         # bat: % (percentage)
+        # mag: uT (only if mag_present)
         # yaw, pitch, roll: ° (degrees)
-        self.sensors = MuvBox_DataFrame(8)  # time, accx, accy, accz, gyrx, gyry, gyrz, bat
+        self.sensors = MuvBox_DataFrame(8)  # time, accx, accy, accz, gyrx, gyry, gyrz, bat (see firmware.channels)
         self.angles = MuvBox_DataFrame(4)   # time, yaw, pitch, row
         self.Q = MuvBox_DataFrame(5)        # time, a, b, c, d   (Quaternion = a + b*i + c*j + d*k)
 
         self.madgwick = ahrs.filters.Madgwick()   
         self.calculate_quaternion = False
         self.marg = False
+        self.ahrs_process = False  # Run the orientation filter in a worker process (muvbox_ahrs.MuvBox_AHRSWorker)
+        self.ahrs_worker = None
+        self.ahrs_lag = 0.0        # Orientation delay (s): time of last sample - time of last angle
+        self._ahrs_pushed = 0      # sensors.count already sent to the worker
 
         self.t = Thread() # thread for reading data
+        self._stop_lock = Lock()      # Protects _reading_done and _stop_deferred
+        self._reading_done = True     # Reading thread has left its loop
+        self._stop_deferred = False   # finish_stop timed out: the reading thread completes the stop
+        self.engine = None  # If set (muvbox_engine.MuvBox_Engine), connection and reading run on the engine event loop
         
         # Command flags
-        self.stop_reading = False
+        self.stop_reading = False    # Same as self._stop_event
         self.ajustar_rtc0 = False
         self.visible = True
         self.reading_values = False  # Indica que os dados estão sendo lidos do socket
         self.state = 0
 
-    def print_log(self, message):
-        if self.logbox != None:
-            self.logbox.append(message)
+    @property
+    def stop_reading(self):
+        return self._stop_event.is_set()
+
+    @stop_reading.setter
+    def stop_reading(self, value):
+        if value:
+            self._stop_event.set()
         else:
-            print(message)
+            self._stop_event.clear()
+
+    def print_log(self, message):
+        # Kept for compatibility. Prefer self.logger (levels, lazy formatting)
+        self.logger.info('%s', message)
 
     def connect(self):
-        
+        if self.engine is not None:
+            return self.engine.connect(self)
         if self.state == 0:
             self.stop_reading = False
-            self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'Start _do_connect')
+            self.logger.info('Start _do_connect')
             self.status = 'Connecting'
-            got_ip = False
-            try:
-                self.ip = socket.gethostbyname(self.name)
-                got_ip = True
-            except:
-                self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'Could not find hostname ' + self.name)
-            if not got_ip:
-                try:
-                    self.ip = socket.gethostbyname(self.name+'.local')
-                    got_ip = True
-                except:
-                    self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'Could not find hostname ' + self.name + '.local')
-            if got_ip:
+            if self.resolve():
                 try:
-                    self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + ' IP = ' + self.ip)
+                    self.logger.info('IP = %s', self.ip)
                     self._dest = (self.ip, self.port)
                     self.acq_rate = 0
                     self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # TCP
+                    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RCVBUF_SIZE)  # must be set before connect
                     self.sock.settimeout(self.TIMEOUT)  # enable timeout
                     self.sock.connect(self._dest)
                     self.sock.settimeout(None)  # disable timeout
                     self.status = 'Online'
-                    self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'SUCCESSFULL CONNECTED TO ' + self.ip)
+                    self.logger.info('SUCCESSFULL CONNECTED TO %s', self.ip)
                     self.command__system_info()  # Read MuvBox info, including firmware version
                     self.setup()   # Configure environment according to firmware version
-                    self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'End do_connect')
+                    self.logger.info('End do_connect')
                     self.state = 2
+                    self.cache_ip()
                 except socket.timeout:
-                    self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + '[MuvBox Error] Timeout: cannot connect to ' + self.ip)
+                    self.logger.error('[MuvBox Error] Timeout: cannot connect to %s', self.ip)
                     self.status = 'Error'
                 except OSError as msg:
-                    self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + '[MuvBox Error]: cannot connect to ' + self.ip + ' - Message: ' + str(msg))
+                    self.logger.error('[MuvBox Error]: cannot connect to %s - Message: %s', self.ip, msg)
                     self.status = 'Error'
                 except:
-                    print('Erro desconhecido')
+                    self.logger.exception('Erro desconhecido')
+                if self.status == 'Error' and self.retry_uncached():
+                    self.sock.close()
+                    return self.connect()
+            else:
+                self.status = 'Error'
         
 
+    def resolve(self):
+        # Find the IP address from hostname (self.name). Returns True if found.
+        # An IP from dns_cache is used first; the hostname is resolved again in background.
+        self._ip_from_cache = False
+        if self.dns_cache is not None:
+            ip = self.dns_cache.lookup(self.name, self.mac)
+            if ip is not None:
+                self.ip = ip
+                self._ip_from_cache = True
+                self.dns_cache.refresh(self.name)
+                return True
+        got_ip = False
+        try:
+            self.ip = socket.gethostbyname(self.name)
+            got_ip = True
+        except:
+            self.logger.warning('Could not find hostname %s', self.name)
+        if not got_ip:
+            try:
+                self.ip = socket.gethostbyname(self.name+'.local')
+                got_ip = True
+            except:
+                self.logger.warning('Could not find hostname %s.local', self.name)
+        return got_ip
+
+    def cache_ip(self):
+        # Connection succeeded: keep the IP in dns_cache
+        if self.dns_cache is not None:
+            self.dns_cache.store(self.name, self.ip, self.mac)
+
+    def retry_uncached(self):
+        # Connection failed. If the IP came from dns_cache it may be old (DHCP): forget it.
+        # Returns True if a new attempt (resolving the hostname) should be made.
+        if self._ip_from_cache:
+            self.logger.warning('Cached IP %s failed. Resolving %s again.', self.ip, self.name)
+            self.dns_cache.forget(self.name)
+            self._ip_from_cache = False
+            return True
+        return False
+
     def stop(self):
+        if self.engine is not None:
+            return self.engine.stop(self)
+        self.request_stop()
+        self.finish_stop(self.TIMEOUT)
+
+    def request_stop(self):
+        # Signal the reading thread to stop. Does not wait (see finish_stop and stop_all)
         if self.state == 4 or self.state == 3:
             self.status = 'Stopping'
             self.stop_reading = True
-            cont = 0
-            while self.reading_values: # Fica preso aqui enquanto socket estiver sendo lido
-                print('Reading socket')
-                cont = cont + 1
-                if cont == 99999999:
-                    print("No response from socket.")
-                    break
-                
+
+    def finish_stop(self, timeout):
+        # Wait (at most timeout seconds) for the reading thread to end, then stop MuvBox transmission.
+        # If the thread is still reading, the stop is completed by the thread when it ends (status 'Stopping').
+        if self.stop_reading and (self.state == 4 or self.state == 3):
+            self.t.join(timeout)  # Thread ends after the current read (bounded by TIMEOUT)
+            with self._stop_lock:
+                if not self._reading_done:
+                    self.logger.warning('No response from socket. Stop completed when the reading ends.')
+                    self._stop_deferred = True
+                    return
+            self.complete_stop()
+
+    def complete_stop(self):
+        # Reading thread ended: stop MuvBox transmission, close the session files and finalize the vectors
+        if self.stop_reading and (self.state == 4 or self.state == 3):
             self.state = 5
-            print(str(self.muvbox_number) + ': state 5')
-            print('iniciando stop_reading')
-            self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'Start stop_reading')
+            self.logger.debug('state 5')
+            self.logger.info('Start stop_reading')
             self.status = 'Online'
-            self.command__stop_transmission()
-            self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'End stop_reading')
-            print('finalizando stop_reading') 
+            try:
+                self.command__stop_transmission()
+            except OSError as msg:
+                self.logger.error('[MuvBox Error]: cannot send stop_transmission - Message: %s', msg)
+            self.close_journal()
+            self.close_recorder()
+            self.logger.info('End stop_reading')
             self.sensors.finalize()
             self.Q.finalize()
             self.angles.finalize()
-            print(len(self.sensors.data),' dados lidos.')
+            self.logger.debug('%s dados lidos.', self.sensors.size)
             self.state = 2  # Retorna ao estado 2
 
 
     def start(self):
+        if self.engine is not None:
+            return self.engine.start(self)
         if self.state==2:
-            print(str(self.muvbox_number) + 'state 3')
             self.stop_reading = False
-            self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'Start start_reading')
+            self.logger.info('Start start_reading')
             try:
                 self.command__start_sensor()
                 self.convert_scale()
                 self.clear()  # clear data
+                self.framer.reset()  # discard bytes left from the previous session
+                self.reset_stats()
+                self.open_journal()
+                self.open_recorder()
                 self.state = 3
-                print(str(self.muvbox_number) + 'state 3')
+                self.logger.debug('state 3')
                 if not self.t.is_alive():
                     self.stop_reading = False
                     self.ajustar_rtc0 = True
+                    self._reading_done = False
+                    self._stop_deferred = False
                     self.t = Thread(target=self.thread_reading, daemon=True)
                     self.t.start()
                     self.status = 'Running'
                 else:
-                    self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'Already connected - ' + self.ip + ' ')
+                    self.logger.info('Already connected - %s', self.ip)
             except:
-                print('Erro start')
-                self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'Error starting - ' + self.ip + ' ')
+                self.logger.exception('Error starting - %s', self.ip)
                 self.state = 2
-                print('state 2')
             
 
     def thread_reading(self):
         # State 4
         self.state = 4
-        print(str(self.muvbox_number) + 'state 4')
+        self.logger.debug('state 4')
         try:
+            self.sock.settimeout(self.TIMEOUT)  # enable timeout (once per session)
             while not self.stop_reading:
-                self.sock.settimeout(self.TIMEOUT)  # enable timeout
-                self.reading_values = True # Flag que indica que os dados estão send lidos do socket
-                self.read_values()
-                self.reading_values = False
-                self.sock.settimeout(None)  # disable timeout
-                self.updateQuaternion()
-                if (self.ajustar_rtc0 == True):
-                    if self.sensors.size>0:
-                        self.rtc0 = self.sensors.data[self.sensors.size-1, 0]
-                        self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' +  " - rtc0: " + str(self.rtc0))
-                        self.clear()  # Limpa os deques
-                        self.ajustar_rtc0 = False
-            print('End thread_reading')
+                try:
+                    self.reading_values = True # Flag que indica que os dados estão send lidos do socket
+                    self.read_values()
+                    self.reading_values = False
+                    self.process_values()
+                except OSError as msg:  # includes socket.timeout
+                    if not self.AUTO_RECONNECT or self.stop_reading:
+                        raise
+                    self.logger.error('[MuvBox Error]: connection lost - Message: %s', msg)
+                    if not self.reconnect():
+                        if self.stop_reading:
+                            break
+                        raise
+            self.sock.settimeout(None)  # disable timeout
+            self.logger.debug('End thread_reading')
         except socket.timeout:
-            self.reading_values = False
-            self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + '[MuvBox Error] Timeout: cannot connect to ' + self.ip)
+            self.logger.error('[MuvBox Error] Timeout: cannot connect to %s', self.ip)
             self.status = 'Error'
         except OSError as msg:
-            self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + '[MuvBox Error]: cannot connect to ' + self.ip + ' - Message: ' + str(msg))
+            self.logger.error('[MuvBox Error]: cannot connect to %s - Message: %s', self.ip, msg)
             self.status = 'Error'
         except:
-            print('Erro desconhecido')
+            self.logger.exception('Erro desconhecido')
+        finally:
+            self.reading_values = False
+            with self._stop_lock:
+                self._reading_done = True
+                deferred = self._stop_deferred
+                self._stop_deferred = False
+            if deferred:
+                self.complete_stop()
+
+    def reconnect(self):
+        # AUTO_RECONNECT: open the connection again with exponential backoff and restart the transmission
+        # with the same scales. Data vectors are kept and the outage is recorded (see outages).
+        # Returns True if reconnected; False if stopped or after RECONNECT_ATTEMPTS attempts.
+        self.status = 'Reconnecting'
+        self.begin_outage()
+        delay = self.RECONNECT_MIN
+        attempt = 0
+        while not self.stop_reading and (self.RECONNECT_ATTEMPTS == 0 or attempt < self.RECONNECT_ATTEMPTS):
+            attempt += 1
+            self.logger.warning('Reconnecting to %s (attempt %s)', self.ip, attempt)
+            try:
+                self.sock.close()
+                if attempt > 1 and self.resolve():  # IP may have changed
+                    self._dest = (self.ip, self.port)
+                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # TCP
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RCVBUF_SIZE)
+                self.sock.settimeout(self.TIMEOUT)
+                self.sock.connect(self._dest)
+                self.command__system_info()
+                self.command__start_sensor()
+                self.sock.settimeout(self.TIMEOUT)  # reading timeout
+                self.framer.discard()
+                self.reconnections += 1
+                self.status = 'Running'
+                self.logger.info('Reconnected to %s', self.ip)
+                return True
+            except OSError as msg:
+                self.logger.warning('Reconnection failed - Message: %s', msg)
+            if self._stop_event.wait(delay):
+                break
+            delay = min(2*delay, self.RECONNECT_MAX)
+        return False
+
+    def begin_outage(self):
+        # Connection lost: remember the last sample time and the wall-clock time
+        last = self.sensors.latest(1)
+        self._outage = (float(last[0, 0]) if len(last) > 0 else None, time.time())
+
+    def end_outage(self, packets):
+        # First packets after a reconnection: record the outage (time before, time after, seconds offline).
+        # If the MuvBox rtc restarted, rtc_offset keeps the time increasing (time after = time before + seconds offline).
+        t_before, wall = self._outage
+        self._outage = None
+        offline = time.time() - wall
+        t_after = float(packets['time'][0])*self.TIMESCALE + self.rtc_offset
+        if t_before is not None and t_after <= t_before:
+            self.rtc_offset += t_before + offline - t_after
+            t_after = t_before + offline
+            self.logger.warning('MuvBox rtc restarted. Time offset: %s s', self.rtc_offset)
+            self.rtc_offsets.append((self.packets_decoded, self.rtc_offset))
+            if self.journal is not None:
+                self.journal.update(rtc_offsets=list(self.rtc_offsets))
+        self.outages.append((t_before, t_after, offline))
+
+    def process_values(self):
+        # Work done after each read: orientation and rtc0 adjustment
+        self.updateQuaternion()
+        if (self.ajustar_rtc0 == True):
+            if self.sensors.size>0:
+                self.rtc0 = self.sensors.data[self.sensors.size-1, 0]
+                self.logger.info('rtc0: %s', self.rtc0)
+                if self.journal is not None:
+                    self.journal.update(rtc0=self.rtc0)
+                if self.recorder is not None:
+                    self.recorder.sync()
+                self.clear()  # Limpa os deques
+                self.ajustar_rtc0 = False
+        if self.recorder is not None and not self.ajustar_rtc0:
+            self.recorder.update()
 
     def disconnect(self):
+        if self.engine is not None:
+            return self.engine.disconnect(self)
+        if self.t.is_alive():  # Stop reading before closing the socket
+            self.stop_reading = True
+            self.t.join(self.TIMEOUT)
+        with self._stop_lock:
+            self._stop_deferred = False     # Session files are closed here
         self.sock.close()
+        self.close_ahrs_worker()
+        self.close_journal()
+        self.close_recorder()
         self.status = 'Offline'
         self.acq_rate = 0
         self.stop_reading = False
         self.ajustar_rtc0 = False
-        self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'Connection closed ' + self.ip)
+        self.logger.info('Connection closed %s', self.ip)
         self.state = 0
 
 
@@ -315,37 +763,61 @@ class MuvBox():
    
 
     def setup(self):
-        # Configure environment according to firmware version
+        # Configure environment according to firmware version (FIRMWARES)
         # firmware_version must be known
-        if self.firmware_version==0:
+        self.firmware = FIRMWARES.get(self.firmware_version)
+        if self.firmware is not None:
             # Configure MuvBox
-            self.mag_present = False
-            self.marg = False
-            self.STEP = 24                     # number of bits per packet
-            self.WINDOWS_SIZE = self.STEP*150  # MuvBox sends 150 samples per packet. Read 300 samples at once.
+            self.mag_present = self.firmware.mag_present
+            if not self.mag_present:
+                self.marg = False
+            self.STEP = self.firmware.packet.itemsize          # number of bytes per packet
+            self.WINDOWS_SIZE = self.STEP*self.firmware.window  # MuvBox sends a window of packets at once
+            self.framer = MuvBox_Framer(self.firmware.packet, self.WINDOWS_SIZE*self.RX_WINDOWS)  # Up to RX_WINDOWS windows per recv
             self.PROTOCOL = 'TCP'
-            self.convert_scale()               # calculate sensor scales
-            self.TIMESCALE = 1/1000000         # 1 us
+            self.TIMESCALE = self.firmware.timescale
             self.AXIS = 3
             self.TIMEOUT = 5                   # Maximu wifi waiting time, in secondes
-            self.BAT_VMAX = 4                  # Voltage for 100% battery
-            self.BAT_VMIN = 3.6                # Voltage for 0% battery
-            self.clear()                       # Reset all vectors
-            self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'Setup done for MuvBox version ' + self.firmware_version_full)
+            self.BAT_VMAX = self.firmware.bat_vmax
+            self.BAT_VMIN = self.firmware.bat_vmin
+            self.convert_scale()               # calculate sensor scales and compile the decoder
+            self.clear()                       # Reset all vectors (columns of the firmware)
+            self.logger.info('Setup done for MuvBox version %s', self.firmware_version_full)
         else:
-            self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'Firmware version ' + self.firmware_version_full + ' unknown. Setup not done.')
+            self.logger.warning('Firmware version %s unknown. Setup not done.', self.firmware_version_full)
 
     def read_values(self):
-        data = self.sock.recv(self.WINDOWS_SIZE)  # TCP
-        
-        while (len(data) != self.WINDOWS_SIZE):
-            data += self.sock.recv(self.WINDOWS_SIZE-len(data))  # TCP
-
-        if (data[0] == 00 and data[-1]==255):
-            self.appendFromWindow(data)
-        else:
-            self.print_log(data)
-            self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'Packets lost - synchronization error')
+        # Receive into the framer buffer (no reallocation per read). When the kernel has
+        # several windows buffered a single recv_into returns all of them (up to RX_WINDOWS).
+        # The framer returns every valid packet and drops only corrupted bytes, resynchronizing
+        # on the next valid packet boundary. An incomplete packet is kept for the next call.
+        while self.framer.length < self.WINDOWS_SIZE:
+            n = self.sock.recv_into(self.framer.free())  # TCP
+            if n == 0:
+                raise ConnectionResetError('Connection closed by MuvBox')
+            self.framer.commit(n)
+            self.bytes_received += n
+        self._t_recv = time.perf_counter()
+        self.decode_values()
+
+    def decode_values(self):
+        # Decode all packets received so far and append them to self.sensors
+        discarded = self.framer.discarded_bytes
+        packets = self.framer.packets()
+        if len(packets) > 0:
+            if self._outage is not None:
+                self.end_outage(packets)
+            self.appendPackets(packets)
+            self.append_latency = time.perf_counter() - self._t_recv
+            self.append_latency_max = max(self.append_latency_max, self.append_latency)
+            self.packets_decoded += len(packets)
+            self.time_health.update(packets['time'])
+            self.acq_rate = self.time_health.rate
+            self.updateBatteryTrend()
+            if self.journal is not None:
+                self.journal.write(packets)
+        if self.framer.discarded_bytes != discarded:
+            self.logger.warning('Packets lost - synchronization error. %s bytes discarded.', self.framer.discarded_bytes - discarded)
         
 
     # Função secundária
@@ -356,62 +828,108 @@ class MuvBox():
             longInt += shortInt[i] * mult
         return longInt
 
-    def appendSensors(self, timeRtc,  accLocal,  gyroLocal, batteryLocal):
+    def appendSensors(self, timeRtc,  accLocal,  gyroLocal, batteryLocal, magLocal=None):
         
         batteryLocal = batteryLocal*1E-3  # transform to Volts
         batteryLocalpercent = int(100*((batteryLocal-self.BAT_VMIN)/(self.BAT_VMAX-self.BAT_VMIN)))
 
-        self.sensors.append([timeRtc*self.TIMESCALE,
-                        accLocal[0] / self.TO_G, 
-                        accLocal[1] / self.TO_G, 
-                        accLocal[2] / self.TO_G,
-                        gyroLocal[0] / self.TO_DPS,
-                        gyroLocal[1] / self.TO_DPS,
-                        gyroLocal[2] / self.TO_DPS,
-                        batteryLocalpercent])
+        line = [timeRtc*self.TIMESCALE,
+                accLocal[0] / self.TO_G, 
+                accLocal[1] / self.TO_G, 
+                accLocal[2] / self.TO_G,
+                gyroLocal[0] / self.TO_DPS,
+                gyroLocal[1] / self.TO_DPS,
+                gyroLocal[2] / self.TO_DPS,
+                batteryLocalpercent]
+        if magLocal is not None:
+            line += [magLocal[i] / self.firmware.mag_scale for i in range(self.AXIS)]
+        self.sensors.append(line)
 
 
         
     def appendFromSliced(self, v):
-        
-        if self.firmware_version == 0:
-            # In this firmware version packet has 24 bytes (24 positions in v vector), organized as follows:
-            # 0 -> start byte (must be 0)
-            # 1 to 8 -> time
-            # 9 to 10 -> ax
-            # 11 to 12 -> ay
-            # 13 to 14 -> az
-            # 15 to 16 -> gx
-            # 17 to 18 -> gy
-            # 19 to 20 -> gz
-            # 21 to 22 -> battery level
-            # 23 -> end byte (must be 255)
-            
-            if (v[0] == 00 and v[-1]==255) and len(v)==24: # Verify packet integrity
-                time = self.shortToLong(v[1:9])
-                accLocal = []
-                gyroLocal = []
-                for i in range(self.AXIS):
-                    accLocal.append(struct.unpack(
-                        "<h", v[9 + 2 * i: 9 + 2 * i + 2])[0])
-                    gyroLocal.append(struct.unpack(
-                        "<h", v[15 + 2 * i: 15 + 2 * i + 2])[0])
-                batteryLocal =   struct.unpack("<h", v[21:23])[0]  
-                self.appendSensors(time, accLocal, gyroLocal, batteryLocal)
-            else:
-                self.print_log(v)
-                self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'Error - packet corrupted.')
-        else: 
-            self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'Firmware version ' + self.firmware_version_full + ' unknown. Data not read.')
+        # Decode a single packet (per-sample reference implementation, see appendFromWindow).
+        # Packet layout is given by the firmware (MuvBox_Firmware.packet). For firmware version 0 a
+        # packet has 24 bytes (24 positions in v vector), organized as follows:
+        # 0 -> start byte (must be 0)
+        # 1 to 8 -> time
+        # 9 to 10 -> ax
+        # 11 to 12 -> ay
+        # 13 to 14 -> az
+        # 15 to 16 -> gx
+        # 17 to 18 -> gy
+        # 19 to 20 -> gz
+        # 21 to 22 -> battery level
+        # 23 -> end byte (must be 255)
+        if self.firmware is None:
+            self.logger.warning('Firmware version %s unknown. Data not read.', self.firmware_version_full)
+            return
+        # Byte positions come from the packet layout; values are decoded byte by byte (shortToLong and
+        # struct), independently of the numpy decoder, so both can be compared.
+        packet = self.firmware.packet
+        if len(v) == packet.itemsize and v[0] == 00 and v[-1] == 255:  # Verify packet integrity
+            t = packet.fields['time'][1]
+            time = self.shortToLong(v[t:t + packet.fields['time'][0].itemsize])
+            accLocal = []
+            gyroLocal = []
+            magLocal = [] if self.firmware.mag_present else None
+            a = packet.fields['acc'][1]
+            g = packet.fields['gyr'][1]
+            mg = packet.fields['mag'][1] if magLocal is not None else None
+            for i in range(self.AXIS):
+                accLocal.append(struct.unpack(
+                    "<h", v[a + 2 * i: a + 2 * i + 2])[0])
+                gyroLocal.append(struct.unpack(
+                    "<h", v[g + 2 * i: g + 2 * i + 2])[0])
+                if magLocal is not None:
+                    magLocal.append(struct.unpack(
+                        "<h", v[mg + 2 * i: mg + 2 * i + 2])[0])
+            b = packet.fields['bat'][1]
+            batteryLocal = struct.unpack("<h", v[b:b + 2])[0]
+            self.appendSensors(time, accLocal, gyroLocal, batteryLocal, magLocal)
+        else:
+            self.logger.debug('Corrupted packet: %s', bytes(v))
+            self.logger.error('Error - packet corrupted.')
 
     def appendFromWindow(self, v):
-        for i in range(self.WINDOWS_SIZE//self.STEP):
-            #print(i)
-            self.appendFromSliced(v[self.STEP*i: self.STEP*(i+1)])
-            
+        # Decode a whole window at once and store it with a single append call.
+        # appendFromSliced is kept as the per-sample reference implementation.
+        if self.firmware is None:
+            self.logger.warning('Firmware version %s unknown. Data not read.', self.firmware_version_full)
+            return
+        packets = np.frombuffer(v, dtype=self.firmware.packet, count=len(v)//self.STEP)
+        valid = (packets['start'] == 0) & (packets['end'] == 255)  # Verify packets integrity
+        if not valid.all():
+            self.logger.error('Error - %s packets corrupted.', len(packets) - np.count_nonzero(valid))
+            packets = packets[valid]
+        self.appendPackets(packets)
+
+    def appendPackets(self, packets):
+        # Append an array of valid packets to sensors (decoded, or kept as raw counts if COMPACT)
+        if self.decoder is None:
+            self.compile_decoder()
+        self.sensors.append_packets(packets, self.decoder, self.rtc_offset)
+
+    def decodePackets(self, packets):
+        # Convert an array of packets to a block with the columns of firmware.channels:
+        # time, accx, accy, accz, gyrx, gyry, gyrz, bat (and magx, magy, magz if mag_present)
+        # Same units and rounding as appendSensors
+        if self.decoder is None:
+            self.compile_decoder()
+        return self.decoder(packets, self.rtc_offset)
+
+    def compile_decoder(self):
+        # Build the packet decoder for the current scales. Called by convert_scale; call it again after
+        # changing TO_G, TO_DPS, TIMESCALE or the battery limits directly.
+        if self.firmware is None:
+            raise ValueError('Firmware version ' + str(self.firmware_version_full) + ' unknown')
+        self.decoder = self.firmware.compile(self)
+        if isinstance(self.sensors, MuvBox_RawFrame):
+            self.sensors.decoder = self.decoder
 
     def updateQuaternion(self):
         # Cálculo do Quaternion
+        # All samples received since the last call are processed as one block (muvbox_ahrs)
 
         if self.calculate_quaternion:
             
@@ -421,232 +939,1173 @@ class MuvBox():
                     self.Q.append([self.sensors.data[0,0], 1, 0, 0, 0])
                     self.angles.append([self.sensors.data[0,0], 0, 0, 0])
 
-                diff_size = self.sensors.size - self.Q.size
+                if self.ahrs_process:
+                    self.updateQuaternionWorker()
+                    return
+
+                diff_size = self.sensors.count - self.Q.count
+                if diff_size > self.sensors.size - 1:
+                    # ring buffer: samples discarded before being processed are counted as discarded
+                    # lines of Q and angles, so sensors.count - Q.count stays bounded
+                    skipped = diff_size - (self.sensors.size - 1)
+                    self.Q.count += skipped
+                    self.angles.count += skipped
+                    diff_size -= skipped
                 
                 ## Cada leitura do socket recebe n valores de rtc
-                for i in range(diff_size, 0, -1):
-                    acc = self.sensors.data[self.sensors.size - i,1:4]
-                    acc = acc*self.GRAVITY
-                    gyr = self.sensors.data[self.sensors.size - i,4:7]
-                    gyr = gyr*np.pi/180
-
-                    # TODO: implementar filtro marg com mag - ajustar tamanho do vetor mag
-                    t_atual = self.sensors.data[self.sensors.size - i, 0]
-                    t_anterior = self.sensors.data[self.sensors.size - i - 1, 0]
-                    self.madgwick.Dt =  t_atual - t_anterior 
+                if diff_size > 0:
+                    n = self.sensors.size
+                    block = self.sensors.data[n-diff_size-1:n]  # last processed sample + new samples
+                    t = block[:, 0]
+                    acc = block[1:, 1:4]*self.GRAVITY
+                    gyr = block[1:, 4:7]*np.pi/180
+                    dt = np.diff(t)
                     last_Q = self.Q.data[self.Q.size-1, 1:5]
-                    if self.marg:  # default is False
-                        Q = self.madgwick.updateMARG(Quaternion(last_Q), gyr=gyr, acc=acc, mag=gyr) # TODO: ajustar vetor magnetometro
+                    if self.marg:  # default is False. Requires a firmware with magnetometer (mag_present)
+                        Q = madgwick_marg(last_Q, gyr, acc, block[1:, 8:11], dt, self.madgwick.gain)
                     else:
-                        Q = self.madgwick.updateIMU(Quaternion(last_Q), gyr=gyr, acc=acc)
-                    self.Q.append([t_atual, Q.w, Q.x, Q.y, Q.z])
-                    angles = Quaternion(Quaternion(Q).conj).to_angles()*180/np.pi
-                    self.angles.append([t_atual, angles[2], angles[1], angles[0]])
+                        Q = madgwick_imu(last_Q, gyr, acc, dt, self.madgwick.gain)
+                    self.Q.append_block(np.column_stack((t[1:], Q)))
+                    self.angles.append_block(np.column_stack((t[1:], quaternion_to_angles(Q))))
                     
     
+    def updateQuaternionWorker(self):
+        # Send new samples to the worker process and append the results already available
+        if self.ahrs_worker is None:
+            self.ahrs_worker = MuvBox_AHRSWorker(gain=self.madgwick.gain, marg=self.marg)
+        reset = self._ahrs_pushed == 0
+        if reset:  # vectors were cleared: restart from the initial quaternion (sensors.data[0])
+            self.ahrs_worker.skip()
+            self._ahrs_pushed = self.sensors.count - self.sensors.size + 1
+        n = self.sensors.size
+        new = min(self.sensors.count - self._ahrs_pushed, n - 1)
+        if new > 0:
+            block = self.sensors.data[n-new-1:n]  # last sent sample + new samples
+            lines = np.zeros((new, MuvBox_AHRSWorker.IN_COLS))
+            lines[:, 0] = block[1:, 0]
+            lines[:, 1] = np.diff(block[:, 0])
+            lines[:, 3:6] = block[1:, 1:4]*self.GRAVITY
+            lines[:, 6:9] = block[1:, 4:7]*np.pi/180
+            if self.marg:  # firmware with magnetometer (mag columns of sensors)
+                lines[:, 9:12] = block[1:, 8:11]
+            self.ahrs_worker.push(lines, reset)
+            self._ahrs_pushed = self.sensors.count
+        out = self.ahrs_worker.collect()
+        if len(out) > 0:
+            self.Q.append_block(out[:, 0:5])
+            self.angles.append_block(out[:, [0, 5, 6, 7]])
+        self.ahrs_lag = self.ahrs_worker.lag
+
+    def close_ahrs_worker(self):
+        if self.ahrs_worker is not None:
+            self.ahrs_worker.close()
+            self.ahrs_worker = None
+
+    def updateBatteryTrend(self):
+        # Battery variation (%/h) between the beginning and the end of each BATTERY_TREND_INTERVAL
+        t, battery = self.sensors.latest(1)[0, [0, 7]]
+        if self._battery_ref is None or t < self._battery_ref[0]:  # first sample or rtc reset
+            self._battery_ref = (t, battery)
+        elif t - self._battery_ref[0] >= self.BATTERY_TREND_INTERVAL:
+            self.battery_trend = 3600*(battery - self._battery_ref[1])/(t - self._battery_ref[0])
+            self._battery_ref = (t, battery)
+
+    def reset_stats(self):
+        # Reset the acquisition metrics (new session). Framer counters are reset by framer.reset()
+        self.bytes_received = 0
+        self.packets_decoded = 0
+        self.append_latency = 0.0
+        self.append_latency_max = 0.0
+        self.battery_trend = 0.0
+        self._battery_ref = None
+        self.time_health.reset(self.ACQ_FREQ)
+        self.reconnections = 0
+        self.outages = []
+        self.rtc_offset = 0.0
+        self.rtc_offsets = []
+        self._outage = None
+
+    def gaps(self):
+        # Last intervals without samples (at most TimeHealth.HISTORY_SIZE): array of lines
+        # (time before the gap, time after the gap, missing samples), time in s
+        g = np.array(self.time_health.gaps, dtype=float).reshape(-1, 3)
+        g[:, 0:2] *= self.TIMESCALE
+        return g
+
+    def stats(self):
+        # Acquisition counters and gauges of the current session (cheap: no data vector is scanned)
+        last = self.sensors.latest(1)
+        return {'name': self.name,
+                'muvbox_number': self.muvbox_number,
+                'status': self.status,
+                'state': self.state,
+                'acq_rate': self.acq_rate,
+                'bytes_received': self.bytes_received,
+                'windows_received': self.bytes_received//self.WINDOWS_SIZE,
+                'packets_decoded': self.packets_decoded,
+                'packets_dropped': self.framer.discarded_packets,
+                'bytes_discarded': self.framer.discarded_bytes,
+                'resync_events': self.framer.resync_events,
+                'time_outliers': self.framer.time_outliers,
+                'append_latency': self.append_latency,
+                'append_latency_max': self.append_latency_max,
+                'ahrs_lag': self.ahrs_lag,
+                'buffer_size': self.sensors.size,
+                'buffer_capacity': self.sensors.capacity,
+                'buffer_fill': self.sensors.size/self.sensors.capacity,
+                'buffer_bytes': self.sensors.nbytes,
+                'battery': float(last[0, 7]) if len(last) > 0 else 0.0,
+                'battery_trend': self.battery_trend,
+                'sample_rate': self.time_health.rate,
+                'gaps': self.time_health.gap_count,
+                'missing_samples': self.time_health.missing_samples,
+                'rtc_resets': self.time_health.rtc_reset_count,
+                'nonmonotonic_samples': self.time_health.nonmonotonic,
+                'reconnections': self.reconnections,
+                'jitter_histogram': self.time_health.jitter.tolist()}
+
+    def open_journal(self):
+        # Start a new journal file for this session, if JOURNAL is set
+        self.close_journal()
+        if self.JOURNAL:
+            try:
+                self.journal = MuvBox_Journal.create(self, self.JOURNAL_PATH)
+                self.logger.info('Recording journal %s', self.journal.path)
+            except (OSError, ValueError) as msg:  # ValueError: header longer than HEADER_SIZE
+                self.logger.error('[MuvBox Error]: cannot create journal - Message: %s', msg)
+
+    def close_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.logger.info('%s packets saved to %s', self.journal.packets, self.journal.path)
+            self.journal = None
+
+    def open_recorder(self):
+        # Start recording this session to rolling files, if RECORD is set
+        self.close_recorder()
+        if self.RECORD:
+            try:
+                self.recorder = MuvBox_Recorder(self, self.RECORD_PATH, self.RECORD_FORMAT, self.RECORD_ROTATE_SIZE,
+                                                self.RECORD_ROTATE_TIME, self.RECORD_INTERVAL)
+                self.recorder_files = self.recorder.files
+                self.logger.info('Recording to %s*', self.recorder.base)
+            except ValueError as msg:
+                self.logger.error('[MuvBox Error]: cannot record - Message: %s', msg)
+
+    def close_recorder(self):
+        # Write the lines not yet recorded and close the last file (reading stopped)
+        if self.recorder is not None:
+            if not self.ajustar_rtc0:
+                self.recorder.update(force=True)
+            self.recorder.close()
+            self.logger.info('%s lines saved to %s files', self.recorder.lines, len(self.recorder.files))
+            self.recorder = None
+
     def clear(self):
         # Clear and reconstructs all vectors
-        self.sensors.clear()
-        self.angles.clear()
-        self.Q.clear()
+        # Vectors are sized from ACQ_FREQ and HISTORY (ring buffer) or SESSION_DURATION (preallocation)
+        if self.HISTORY > 0:
+            capacity, ring = int(self.ACQ_FREQ*self.HISTORY), True
+        elif self.RECORD:  # Data is saved by the recorder
+            capacity, ring = int(self.ACQ_FREQ*self.RECORD_HISTORY), True
+        elif self.SESSION_DURATION > 0:
+            capacity, ring = int(self.ACQ_FREQ*self.SESSION_DURATION), False
+        else:
+            capacity, ring = MuvBox_DataFrame.DEFAULT_CAPACITY, False
+        # Vectors are kept in RAM (MuvBox_DataFrame), in mapped files (MAPPED) or as raw counts (COMPACT, sensors only)
+        frame = MuvBox_MappedFrame if self.MAPPED and not ring else MuvBox_DataFrame
+        cols = len(self.firmware.channels) if self.firmware is not None else self.sensors.cols
+        self.sensors = self.clear_frame(self.sensors, MuvBox_RawFrame if self.COMPACT and not ring else frame,
+                                        cols, capacity, ring)
+        if isinstance(self.sensors, MuvBox_RawFrame):
+            self.sensors.decoder = self.decoder
+        self.angles = self.clear_frame(self.angles, frame, 4, capacity, ring)
+        self.Q = self.clear_frame(self.Q, frame, 5, capacity, ring)
+        self._ahrs_pushed = 0
+
+    def clear_frame(self, df, frame, cols, capacity, ring):
+        # Clear vector df, or replace it by a new one if its class (frame) or number of columns changed
+        if type(df) is not frame or df.cols != cols:
+            df = frame(cols, 1, ring)
+        if frame is MuvBox_MappedFrame:
+            df.directory = self.MAPPED_PATH
+        df.clear(capacity, ring)
+        return df
 
 
     def convert_scale(self):
-        # Calculate self.GSCALE and self.DEGSCALE from self.ACCSCALE and self.GYROSCALE
-        if self.firmware_version == 0:
-            self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'Start scale procedure.')
-            self.ACC_WORD_SIZE = 16 # Number of bits of accelerometer register
-            self.GYR_WORD_SIZE = 16 # Number of bits of gyroscope register
+        # Calculate self.GSCALE and self.DEGSCALE from self.ACCSCALE and self.GYROSCALE (scale tables of
+        # the firmware, e.g. 2, 4, 8, 16 g and 250, 500, 1000, 2000 °/s for version 0) and compile the decoder
+        if self.firmware is not None:
+            self.logger.info('Start scale procedure.')
+            self.ACC_WORD_SIZE = self.firmware.word_size # Number of bits of accelerometer register
+            self.GYR_WORD_SIZE = self.firmware.word_size # Number of bits of gyroscope register
             
-            if self.ACCSCALE==0:   # 2g scale
-                self._GSCALE = 2
-            elif self.ACCSCALE==1: # 4g scale
-                self._GSCALE = 4   
-            elif self.ACCSCALE==2: # 8g scale
-                self._GSCALE = 8   
-            elif self.ACCSCALE==3: # 16g scale
-                self._GSCALE = 16  
+            if self.ACCSCALE in range(len(self.firmware.gscales)):
+                self._GSCALE = self.firmware.gscales[self.ACCSCALE]
             else:
-                self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'Warning: ACC Scale out of range. Scale not set.')
+                self.logger.warning('Warning: ACC Scale out of range. Scale not set.')
         
-            if self.GYROSCALE==0:      # 250°/s scale
-                self._DEGSCALE = 250
-            elif self.GYROSCALE==1:    # 500°/s scale
-                self._DEGSCALE = 500
-            elif self.GYROSCALE==2:    # 1000°/s scale
-                self._DEGSCALE = 1000
-            elif self.GYROSCALE==3:    # 2000°/s scale
-                self._DEGSCALE = 2000
+            if self.GYROSCALE in range(len(self.firmware.degscales)):
+                self._DEGSCALE = self.firmware.degscales[self.GYROSCALE]
             else:
-                self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'Warning: GYR Scale out of range. Scale not set.')
+                self.logger.warning('Warning: GYR Scale out of range. Scale not set.')
             
             self.TO_DPS = (2**(self.GYR_WORD_SIZE-1))/self._DEGSCALE # 65.536
             self.TO_G = (2**(self.ACC_WORD_SIZE-1))/self._GSCALE  
-            self.print_log ('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'Scale procedure done. Using DEGSCALE=' + str(self._DEGSCALE) + ' GSCALE=' + str(self._GSCALE))
+            self.compile_decoder()
+            self.logger.info('Scale procedure done. Using DEGSCALE=%s GSCALE=%s', self._DEGSCALE, self._GSCALE)
         else:
-            self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'Firmware version ' + self.firmware_version_full + ' unknown. Scale not set.')
+            self.logger.warning('Firmware version %s unknown. Scale not set.', self.firmware_version_full)
         
 
+    def message__system_info(self):
+        return '{\"command\": \"system_info\"}'.encode()
+
+    def message__start_sensor(self):
+        message = '{\"command\": \"start_sensor\",\"freq\": ' + str(int(self.ACQ_FREQ)) + ',\"GYRO\": ' + str(self.GYROSCALE) + ',\"ACCEL\": ' + str(self.ACCSCALE) + '}'
+        return message.encode()
+
+    def message__stop_transmission(self):
+        return '{\"command\": \"stop_transmission\"}'.encode()
+
+    def parse_system_info(self, data):
+        # Read MuvBox info from the system_info reply (json)
+        d2 = data.decode("utf8")
+        parsed_data=json.loads(d2) # decode json data
+        self.free_heap = parsed_data.get('free_heap')
+        self.mac = parsed_data.get('mac')
+        self.firmware_version_full = parsed_data.get('firmware')
+        self.firmware_version = int(self.firmware_version_full[5:8])
+        self.sensor_task = parsed_data.get('sensor_task')
+        self.logger.info('free heap: %s mac: %s firmware: %s sensor task: %s', self.free_heap, self.mac, self.firmware_version, self.sensor_task)
+
     def command__system_info(self):
         data = None
         try:
-            self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'Start command__system_info')
+            self.logger.info('Start command__system_info')
             self.sock.settimeout(self.TIMEOUT)  # enable timeout
-            self.sock.sendto('{\"command\": \"system_info\"}'.encode(), self._dest)
+            self.sock.sendto(self.message__system_info(), self._dest)
             data = self.sock.recv(1024)
             self.sock.settimeout(None)  # disable timeout
-            d2 = data.decode("utf8")
-            parsed_data=json.loads(d2) # decode json data
-            self.free_heap = parsed_data.get('free_heap')
-            self.mac = parsed_data.get('mac')
-            self.firmware_version_full = parsed_data.get('firmware')
-            self.firmware_version = int(self.firmware_version_full[5:8])
-            self.sensor_task = parsed_data.get('sensor_task')
-            self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'free heap: ' + str(self.free_heap) + ' mac: ' + str(self.mac) + ' firmware: ' + str(self.firmware_version) + ' sensor task: ' + str(self.sensor_task))
-            self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'command__system_info successful')
+            self.parse_system_info(data)
+            self.logger.info('command__system_info successful')
         except:
-            self.print_log(data)
-            self.print_log('Error command system_info')
+            self.logger.debug('system_info reply: %s', data)
+            self.logger.error('Error command system_info')
         
     def command__start_sensor(self):
-        self.print_log ('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'Start command__start_sensor')
-        message = '{\"command\": \"start_sensor\",\"freq\": ' + str(int(self.ACQ_FREQ)) + ',\"GYRO\": ' + str(self.GYROSCALE) + ',\"ACCEL\": ' + str(self.ACCSCALE) + '}'
-        #print(message)
+        self.logger.info('Start command__start_sensor')
         self.sock.settimeout(self.TIMEOUT)  # enable timeout
-        self.sock.sendto(message.encode(), self._dest)
-        self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'start_sensor command successful')
+        self.sock.sendto(self.message__start_sensor(), self._dest)
+        self.logger.info('start_sensor command successful')
         self.sock.settimeout(None)  # disable timeout
         
         
     def command__stop_transmission(self):
-        self.print_log ('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'Start command__stop_transmission')
+        self.logger.info('Start command__stop_transmission')
         self.sock.settimeout(self.TIMEOUT)  # enable timeout
-        self.sock.sendto('{\"command\": \"stop_transmission\"}'.encode(), self._dest)
-        self.print_log('* ' + self.name +  ' #' + str(self.muvbox_number) + ': ' + 'Stop_transmission command successful')
+        self.sock.sendto(self.message__stop_transmission(), self._dest)
+        self.logger.info('Stop_transmission command successful')
         self.sock.settimeout(None)  # disable timeout
         
 
-class MuvBox_DataFrame:
+def connect_all(M, timeout=10):
+    # Connect several MuvBoxes in parallel and wait at most timeout seconds in total, so the time
+    # is about the time of the slowest MuvBox. MuvBoxes not connected yet continue in background.
+    deadline = time.monotonic() + timeout
+    engines = {}
+    threads = []
+    for m in M:
+        if m.engine is not None:
+            engines.setdefault(m.engine, []).append(m)
+        else:
+            t = Thread(target=m.connect, daemon=True)
+            t.start()
+            threads.append(t)
+    for engine in engines:
+        engine.connect_all(engines[engine], max(0, deadline - time.monotonic()))
+    for t in threads:
+        t.join(max(0, deadline - time.monotonic()))
+    for m in M:
+        if m.status == 'Connecting':
+            m.logger.warning('Still connecting after %s s', timeout)
+
+
+def stop_all(M):
+    # Stop several MuvBoxes in parallel. All reading threads are signalled first and then
+    # joined with a common deadline, so the total time is about one TIMEOUT, not the sum.
+    engines = {}
+    for m in M:
+        if m.engine is not None:
+            engines.setdefault(m.engine, []).append(m)
+        else:
+            m.request_stop()
+    for engine in engines:
+        engine.stop_all(engines[engine])
+    deadline = time.monotonic() + max([m.TIMEOUT for m in M], default=0)
+    for m in M:
+        if m.engine is None:
+            m.finish_stop(max(0, deadline - time.monotonic()))
+
+
+class MuvBox_DNSCache:
+    # Persistent cache of MuvBox IP addresses (json file), keyed by hostname and mac.
+    # Cached IPs are tried first; hostnames are resolved again in background threads to keep the cache fresh.
+
+    def __init__(self, path='./res/dns_cache.json'):
+        self.path = path
+        self.entries = {}     # hostname: {'ip': ..., 'mac': ..., 'updated': ...}
+        self._lock = Lock()
+        self._refreshing = set()
+        try:
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def _mac(mac):
+        return str(mac or '').replace(':', '').replace('-', '').lower()
+
+    def lookup(self, name, mac=''):
+        # Cached IP of hostname name, or None. If both macs are known they must match.
+        e = self.entries.get(name)
+        if e is None or (self._mac(mac) and self._mac(e.get('mac')) and self._mac(mac) != self._mac(e.get('mac'))):
+            return None
+        return e.get('ip')
+
+    def store(self, name, ip, mac=''):
+        with self._lock:
+            e = self.entries.get(name, {})
+            mac = mac or e.get('mac', '')
+            if e.get('ip') == ip and e.get('mac') == mac:
+                return
+            self.entries[name] = {'ip': ip, 'mac': mac, 'updated': str(datetime.datetime.now())}
+            self._save()
+
+    def forget(self, name):
+        with self._lock:
+            if self.entries.pop(name, None) is not None:
+                self._save()
+
+    def refresh(self, name):
+        # Resolve hostname name in a background thread and update the cache
+        with self._lock:
+            if name in self._refreshing:
+                return
+            self._refreshing.add(name)
+        Thread(target=self._refresh, args=(name,), daemon=True).start()
+
+    def _refresh(self, name):
+        try:
+            for host in [name, name + '.local']:
+                try:
+                    self.store(name, socket.gethostbyname(host))
+                    return
+                except OSError:
+                    pass
+        finally:
+            with self._lock:
+                self._refreshing.discard(name)
+
+    def _save(self):
+        # Write to a temporary file first, so a crash never leaves a truncated cache
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.entries, f, indent=1)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as msg:
+            logger.warning('Could not save DNS cache %s - Message: %s', self.path, msg)
+
+
+class MuvBox_Framer:
+    # Splits the TCP byte stream in packets.
+    # A valid packet starts with 0x00 and ends with 0xFF and its timestamp is newer than the previous
+    # one by at most MAX_JUMP (a packet with a corrupted rtc byte and intact 0x00/0xFF bytes is an outlier).
+    # When a corrupted packet is found, only the corrupted bytes are dropped: the stream is searched
+    # for the next offset where two consecutive packets are valid and have increasing timestamps
+    # (newer than the last valid one).
+    # The last packet of the buffer is kept until the next one arrives, since an outlier is only
+    # recognized by its successor (rtc going back to the previous values).
+    #
+    # Usage: n = sock.recv_into(framer.free()); framer.commit(n); packets = framer.packets()
+
+    MAX_SKIP = 3600  # After dropping this many bytes (one window), accept a boundary even if its timestamp is older (RTC reset)
+    MAX_JUMP = 60000000  # Largest accepted step between consecutive timestamps, in us (larger steps are corrupted rtc bytes)
+
+    def __init__(self, dtype, size):
+        self.dtype = dtype               # Packet layout (numpy structured dtype with 'start', 'time' and 'end' fields)
+        self.step = dtype.itemsize       # Packet size, in bytes
+        self.buffer = bytearray(max(size, 2*self.step))
+        self.view = memoryview(self.buffer)
+        self.reset()
+
+    def reset(self):
+        self.length = 0                  # Number of bytes in buffer not decoded yet
+        self.last_time = None            # Timestamp of the last valid packet
+        self.discarded_bytes = 0         # Total of bytes dropped
+        self.discarded_packets = 0       # Total of packets dropped (estimated from discarded bytes)
+        self.resync_events = 0           # Number of times synchronization was lost
+        self.time_outliers = 0           # Packets with valid 0x00/0xFF bytes dropped for their timestamp
+        self._skipped = 0                # Bytes dropped in the current resynchronization
+        self._synchronized = True
+
+    def discard(self):
+        # New connection: drop the bytes of an incomplete packet (counters are kept).
+        # The rtc may have restarted, so the next timestamp is not compared with the old ones.
+        self.discarded_bytes += self.length
+        self.length = 0
+        self.last_time = None
+        self._skipped = 0
+        self._synchronized = True
+
+    def free(self):
+        # Free part of the buffer, for recv_into
+        return self.view[self.length:]
+
+    def commit(self, n):
+        # n bytes were written to free()
+        self.length += n
+
+    def packets(self):
+        # Return all complete valid packets in the buffer (a copy) and keep the incomplete tail
+        step = self.step
+        pos = 0
+        out = []
+        while self.length - pos >= step:
+            if not self._synchronized:
+                p = self._search(pos)
+                if p is None:
+                    # No boundary yet: keep only the bytes that can still start a packet
+                    p = max(pos, self.length - 2*step + 1)
+                    self._skip(p - pos)
+                    pos = p
+                    break
+                self._skip(p - pos)
+                pos = p
+                self.discarded_packets += (self._skipped + step - 1)//step
+                if self._skipped > self.MAX_SKIP:
+                    self.last_time = None  # boundary accepted as an rtc reset: do not compare with older times
+                self._skipped = 0
+                self._synchronized = True
+
+            n = (self.length - pos)//step
+            packets = np.frombuffer(self.buffer, dtype=self.dtype, count=n, offset=pos)
+            bad = (packets['start'] != 0) | (packets['end'] != 255)
+            k = int(np.argmax(bad)) if bad.any() else n
+            # Timestamps of the valid frames: step from the previous packet in (0, MAX_JUMP], and no
+            # spike (a packet followed by a step back to a time after the packet before it)
+            t = packets['time'][:k].astype(np.int64)
+            dt = np.diff(t, prepend=t[:1] - 1 if self.last_time is None else self.last_time)
+            late = (dt <= 0) | (dt > self.MAX_JUMP)
+            late[:-1] |= (dt[1:] <= 0) & (dt[:-1] + dt[1:] > 0)
+            if self.last_time is None and k > 1 and dt[1] <= 0:
+                late[0] = True  # no previous time to compare with: the first packet is the outlier
+            j = int(np.argmax(late)) if late.any() else k
+            held = j == n  # every packet is valid: keep the last one until its successor arrives
+            if held:
+                j -= 1
+            if j > 0:
+                out.append(packets[:j].copy())
+                self.last_time = int(t[j-1])
+                pos += j*step
+            if held:
+                break
+            if j < k:
+                self.time_outliers += 1
+            if j < n:
+                self.resync_events += 1
+                self._synchronized = False
+                self._skip(1)
+                pos += 1
+
+        # Move the remaining bytes to the beginning of the buffer
+        self.view[:self.length-pos] = self.view[pos:self.length]
+        self.length -= pos
+        if len(out) == 1:
+            return out[0]
+        return np.concatenate(out) if out else np.empty(0, dtype=self.dtype)
+
+    def _skip(self, n):
+        self.discarded_bytes += n
+        self._skipped += n
+
+    def _search(self, pos):
+        # First offset >= pos where two consecutive packets look valid, or None
+        step = self.step
+        end = self.length - 2*step + 1
+        if end <= pos:
+            return None
+        b = np.frombuffer(self.buffer, dtype=np.uint8, count=self.length)
+        candidates = np.flatnonzero((b[pos:end] == 0) & (b[pos+step-1:end+step-1] == 255) &
+                                    (b[pos+step:end+step] == 0) & (b[pos+2*step-1:end+2*step-1] == 255)) + pos
+        for p in candidates:
+            t = np.frombuffer(self.buffer, dtype=self.dtype, count=2, offset=int(p))['time']
+            t = t.astype(np.int64)
+            if 0 < t[1] - t[0] <= self.MAX_JUMP and (self.last_time is None or 0 < t[0] - self.last_time <= self.MAX_JUMP or
+                                                    self._skipped + p - pos > self.MAX_SKIP):
+                return int(p)
+        return None
+
+
+class MuvBox_TimeHealth:
+    # Health of the MuvBox clock, updated with the rtc (frames bytes 1 to 8, in us) of each decoded block.
+    # The cost is proportional to the block size; all results are available in O(1):
+    #  rate: EWMA of the sample rate of each block (samples/s), including missing samples
+    #  jitter: histogram of |dt - nominal period|, with bins limited by JITTER_EDGES (us); last bin is larger
+    #  gaps: last HISTORY_SIZE (time before, time after, missing samples), in us, for dt > GAP_FACTOR*period
+    #  rtc_resets: last HISTORY_SIZE (time before, time after), in us, when time goes back more than RESET_BACKWARDS
+    #  gap_count, rtc_reset_count: totals of the session (the deques above only keep the most recent)
+    #  nonmonotonic: number of samples with time equal or a little older than the previous one
+
+    JITTER_EDGES = np.array([10, 50, 100, 250, 500, 1000, 5000])  # us
+    RATE_ALPHA = 0.2               # EWMA weight of each block
+    GAP_FACTOR = 1.5               # Interval (in periods) considered a gap
+    RESET_BACKWARDS = 1000000      # us
+    HISTORY_SIZE = 1000            # Maximum number of gaps and rtc_resets kept (bounded deque, like the log_ring)
+
+    def __init__(self, freq=1000):
+        self.reset(freq)
+
+    def reset(self, freq):
+        self.period = 1e6/freq     # Nominal period, in us
+        self.rate = 0.0
+        self.jitter = np.zeros(len(self.JITTER_EDGES) + 1, dtype=np.int64)
+        self.gaps = deque(maxlen=self.HISTORY_SIZE)
+        self.gap_count = 0
+        self.missing_samples = 0
+        self.rtc_resets = deque(maxlen=self.HISTORY_SIZE)
+        self.rtc_reset_count = 0
+        self.nonmonotonic = 0
+        self.last_time = None      # rtc of the last sample of the previous block
+
+    def update(self, rtc):
+        t = rtc.astype(np.int64)
+        if len(t) == 0:
+            return
+        before = np.empty(len(t), dtype=np.int64)  # time of the previous sample
+        before[1:] = t[:-1]
+        before[0] = t[0] if self.last_time is None else self.last_time
+        dt = t - before
+        if self.last_time is None:
+            dt = dt[1:]
+            t = t[1:]
+            before = before[1:]
+        self.last_time = int(rtc[-1])
+
+        back = dt <= 0
+        if back.any():
+            for i in np.flatnonzero(back):
+                if before[i] - t[i] > self.RESET_BACKWARDS:
+                    self.rtc_resets.append((int(before[i]), int(t[i])))
+                    self.rtc_reset_count += 1
+                else:
+                    self.nonmonotonic += 1
+            dt = dt[~back]
+            t = t[~back]
+            before = before[~back]
+        if len(dt) == 0:
+            return
+
+        self.jitter += np.bincount(np.searchsorted(self.JITTER_EDGES, np.abs(dt - self.period), side='right'),
+                                   minlength=len(self.jitter))
+        for i in np.flatnonzero(dt > self.GAP_FACTOR*self.period):
+            missing = int(round(dt[i]/self.period)) - 1
+            self.gaps.append((int(before[i]), int(t[i]), missing))
+            self.gap_count += 1
+            self.missing_samples += missing
+
+        rate = 1e6*len(dt)/int(dt.sum())
+        self.rate = rate if self.rate == 0 else (1 - self.RATE_ALPHA)*self.rate + self.RATE_ALPHA*rate
 
-    def __init__(self, c=8):
+
+class MuvBox_DataFrame:
+    # Growing 2D array of samples (lines) x channels (columns).
+    # data[:size] holds the valid lines, oldest first.
+    #
+    # ring=False: capacity doubles when full (the whole session stays in memory).
+    # ring=True: fixed memory; only the last 'capacity' lines are kept. Each buffer has room
+    # for 2*capacity lines; when it is full the most recent lines are copied to the beginning of
+    # a second buffer (double buffer), so data[:size] is always a contiguous view.
+    #
+    # Reading from another thread: data and size are two attributes and may not match while
+    # lines are being appended. Use view(), latest(n) or snapshot(t_from, t_to) instead. They
+    # return consistent zero-copy views: written lines are never changed (ring=False) or only
+    # reused after 'capacity' more lines have been appended (ring=True).
+
+    DEFAULT_CAPACITY = 4096
+
+    def __init__(self, c=8, capacity=DEFAULT_CAPACITY, ring=False):
         self.cols = c
-        self.capacity = 4096
-        self.data = np.empty((self.capacity, self.cols))
-        self.size = int(0)
+        self.clear(capacity, ring)
+
+    @classmethod
+    def from_array(cls, a):
+        # Frame with the lines of a (lines x cols array), used without copy (e.g. a memory map).
+        # a is not changed: appending lines copies them to a new buffer.
+        df = cls(a.shape[1], 1)
+        df._buf = a
+        df.capacity = max(len(a), 1)
+        df._end = len(a)
+        df.count = len(a)
+        df._publish()
+        df.finalize()
+        return df
 
     def append(self, x):
-        if self.size == len(self.data):
+        self.append_block(np.reshape(np.asarray(x, dtype=float), (1, self.cols)))
+
+    def append_packets(self, packets, decoder, rtc_offset=0.0):
+        # Append an array of packets decoded by decoder (MuvBox_Decoder)
+        self.append_block(decoder(packets, rtc_offset))
+
+    def append_block(self, x):
+        # Append n lines at once (x is a n x cols array) with a single slice assignment
+        n = len(x)
+        self.count += n
+        if self.ring:
+            if n > self.capacity:
+                x = x[n-self.capacity:]
+                n = self.capacity
+            if self._end + n > len(self._buf):
+                keep = min(self.capacity - n, self._end - self._start)
+                self._spare[:keep] = self._buf[self._end-keep:self._end]
+                self._buf, self._spare = self._spare, self._buf
+                self._start = 0
+                self._end = keep
+        elif self._end + n > len(self._buf):
+            self._grow(self._end + n)
+        self._buf[self._end:self._end+n] = x
+        self._end += n
+        if self.ring:
+            self._start = max(self._start, self._end - self.capacity)
+        self._publish()
+
+    def _grow(self, n):
+        # Make room for n lines (ring=False): capacity doubles
+        while n > self.capacity:
             self.capacity *= 2
-            newdata = np.empty((self.capacity,self.cols))
-            newdata[:self.size] = self.data
-            self.data = newdata
-            print('Resizing memory for', len(self.data),' samples')
-
-        for i in range(len(x)):
-            self.data[self.size,i] = x[i]
-        self.size += 1
+        self._resize(self.capacity)
+
+    def _resize(self, capacity):
+        # New buffer with room for capacity lines (ring=False). The old buffer is not changed (readers may hold it)
+        newbuf = np.empty((capacity, self.cols))
+        newbuf[:self._end] = self._buf[:self._end]
+        self._buf = newbuf
+
+    def _publish(self):
+        # Lines are written before being published; _view is replaced in a single assignment
+        self._view = (self._buf, self._start, self._end)
+        self.data = self._buf[self._start:]
+        self.size = self._end - self._start
+
+    def view(self):
+        # Consistent zero-copy view of all valid lines
+        buf, start, end = self._view
+        return buf[start:end]
+
+    def latest(self, n):
+        # Consistent zero-copy view of the last n lines
+        buf, start, end = self._view
+        return buf[max(start, end - n):end]
+
+    def snapshot(self, t_from=-np.inf, t_to=np.inf):
+        # Consistent zero-copy view of the lines with t_from <= time (column 0) <= t_to
+        # Time must be increasing (binary search)
+        v = self.view()
+        first = np.searchsorted(v[:, 0], t_from, side='left')
+        last = np.searchsorted(v[:, 0], t_to, side='right')
+        return v[first:last]
+
+    def reserve(self, n):
+        # Preallocation hint: make room for n lines without further resizing (ring=False only)
+        if not self.ring and n > len(self._buf):
+            self.capacity = n
+            self._resize(n)
+            self._publish()
 
     def finalize(self):
-        data = self.data[:self.size]
-        self.data = np.reshape(data, newshape=(self.size, self.cols))
+        self.data = self._buf[self._start:self._end]
+
+    @property
+    def nbytes(self):
+        # Memory allocated for the lines (bytes)
+        return self._buf.nbytes + (self._spare.nbytes if self._spare is not None else 0)
+
+    def clear(self, capacity=DEFAULT_CAPACITY, ring=None):
+        if ring is not None:
+            self.ring = ring
+        self.capacity = max(int(capacity), 1)
+        if self.ring:
+            self._buf = np.empty((2*self.capacity, self.cols))
+            self._spare = np.empty((2*self.capacity, self.cols))
+        else:
+            self._buf = np.empty((self.capacity, self.cols))
+            self._spare = None
+        self._start = 0
+        self._end = 0
+        self.count = 0          # Total number of lines appended since clear (including discarded ones)
+        self._publish()
+
+
+class MuvBox_MappedFrame(MuvBox_DataFrame):
+    # MuvBox_DataFrame kept in a temporary file (memory map) instead of the RAM, for very long
+    # sessions (MuvBox.MAPPED). Same semantics as MuvBox_DataFrame with ring=False: data is a
+    # contiguous array (numpy memmap) and view(), latest(n) and snapshot(t_from, t_to) are
+    # consistent zero-copy views.
+    #
+    # The file grows by CHUNK lines; lines already written are never copied. When a chunk is
+    # complete and RESIDENT newer chunks exist, it is written to disk and released from the
+    # process memory (madvise), so only the recent chunks stay resident. Reading any line (GUI,
+    # SaveRoutine, snapshot) maps it in again: the OS reads only the pages touched.
+    # The file is deleted when the vector is cleared or the MuvBox is deleted.
+
+    CHUNK = 2**18       # Lines added to the file at each growth (16 MB with 8 columns)
+    RESIDENT = 2        # Most recent complete chunks kept resident
+
+    def __init__(self, c=8, capacity=MuvBox_DataFrame.DEFAULT_CAPACITY, ring=False, directory=None):
+        self.directory = directory  # Directory of the temporary file (None: system temporary directory)
+        self._file = None
+        super().__init__(c, capacity, ring)
+
+    def append_block(self, x):
+        super().append_block(x)
+        if self._end//self.CHUNK - self._released > self.RESIDENT:
+            self._release(self._end//self.CHUNK - self.RESIDENT)
+
+    def _grow(self, n):
+        self._resize(max(n, self.capacity + self.CHUNK))
+
+    def _resize(self, capacity):
+        # Extend the file to capacity lines (rounded up to CHUNK lines) and map it again.
+        # Previous maps stay valid for readers holding them.
+        capacity = -(-capacity//self.CHUNK)*self.CHUNK
+        self._file.truncate(capacity*self.cols*8)
+        self._buf = np.memmap(self._file, dtype=float, mode='r+', shape=(capacity, self.cols))
+        self.capacity = capacity
+
+    def _release(self, chunk):
+        # Write the lines of the chunks before 'chunk' to disk and drop them from the process memory
+        length = chunk*self.CHUNK*self.cols*8     # Multiple of the page size
+        start = self._released*self.CHUNK*self.cols*8
+        m = self._buf._mmap
+        m.flush(start, length - start)
+        if hasattr(mmap, 'MADV_DONTNEED'):  # Not available on Windows
+            m.madvise(mmap.MADV_DONTNEED, start, length - start)
+        self._released = chunk
+
+    def clear(self, capacity=MuvBox_DataFrame.DEFAULT_CAPACITY, ring=None):
+        if ring:
+            raise ValueError('MuvBox_MappedFrame does not support ring=True')
+        self.ring = False
+        if self._file is not None:
+            self._file.close()      # Maps still held by readers stay valid
+        self._file = tempfile.TemporaryFile(prefix='muvbox_', suffix='.frame', dir=self.directory)
+        self.capacity = 0
+        self._resize(max(int(capacity), 1))
+        self._spare = None
+        self._start = 0
+        self._end = 0
+        self._released = 0      # Chunks written and released
+        self.count = 0
+        self._publish()
+
+
+class MuvBox_RawFrame:
+    # Compact alternative to MuvBox_DataFrame for the sensors vectors (MuvBox.COMPACT).
+    # Lines are kept as received from MuvBox: rtc (uint64, in the MuvBox time unit) and the raw
+    # int16 counts of the axes (acc, gyr and mag). The battery (%) is kept for one line every
+    # BAT_DECIMATION lines. That is about 20 bytes per line instead of 64 (8 float64).
+    # Scales (counts per g, °/s and uT, time unit and battery limits) are those of 'decoder'
+    # (MuvBox_Decoder, set by MuvBox.compile_decoder).
+    #
+    # Values in s, g, °/s, % and uT are computed only for the lines and columns that are read:
+    # data, view() and snapshot(t_from, t_to) return a MuvBox_RawView, latest(n) returns a float array.
+    # Same thread safety as MuvBox_DataFrame (ring=False): written lines are never changed.
+    # ring=True is not supported (use MuvBox_DataFrame with HISTORY).
+
+    DEFAULT_CAPACITY = MuvBox_DataFrame.DEFAULT_CAPACITY
+    BAT_DECIMATION = 100    # Battery stored for lines 0, BAT_DECIMATION, 2*BAT_DECIMATION, ...
+
+    def __init__(self, c=8, capacity=DEFAULT_CAPACITY, ring=False):
+        self.cols = c
+        self.ring = False
+        self.decoder = None
+        self.clear(capacity, ring)
 
-    def clear(self):
-        self.capacity = 4096
-        self.data = np.empty((self.capacity, self.cols))
-        self.size = 0
-        
+    def append(self, x):
+        self.append_block(np.reshape(np.asarray(x, dtype=float), (1, self.cols)))
+
+    def append_packets(self, packets, decoder, rtc_offset=0.0):
+        # Append an array of packets without conversion (rtc_offset is added to the rtc)
+        self.decoder = decoder
+        n = len(packets)
+        self._reserve(self._end + n)
+        end = self._end
+        offset = int(round(rtc_offset/decoder.timescale))
+        if offset >= 0:
+            self._time[end:end+n] = packets['time'] + np.uint64(offset)
+        else:
+            self._time[end:end+n] = packets['time'] - np.uint64(-offset)
+        j = 0
+        for field, columns, scale in decoder.fields:
+            w = columns.stop - columns.start
+            self._counts[end:end+n, j:j+w] = packets[field]
+            j += w
+        k = self._battery_lines(n)
+        self._bat[k//self.BAT_DECIMATION] = decoder.battery(packets['bat'][k - end])
+        self._commit(n)
+
+    def append_block(self, x):
+        # Append n lines in units (x is a n x cols array, as MuvBox_DataFrame). Values are
+        # stored as counts with the scales of decoder.
+        d = self.decoder
+        if d is None:
+            raise ValueError('MuvBox_RawFrame: scales unknown (decoder not set)')
+        n = len(x)
+        self._reserve(self._end + n)
+        end = self._end
+        self._time[end:end+n] = np.round(x[:, 0]/d.timescale)
+        j = 0
+        for field, columns, scale in d.fields:
+            w = columns.stop - columns.start
+            self._counts[end:end+n, j:j+w] = np.round(x[:, columns]*scale)
+            j += w
+        k = self._battery_lines(n)
+        self._bat[k//self.BAT_DECIMATION] = x[k - end, d.bat_column]
+        self._commit(n)
+
+    def _battery_lines(self, n):
+        # Lines end to end+n-1 where the battery is stored
+        first = -(-self._end//self.BAT_DECIMATION)*self.BAT_DECIMATION
+        return np.arange(first, self._end + n, self.BAT_DECIMATION)
+
+    def _commit(self, n):
+        self._end += n
+        self.count += n
+        self._publish()
+
+    def _reserve(self, n):
+        # Make room for n lines (capacity doubles)
+        if n > len(self._time):
+            while n > self.capacity:
+                self.capacity *= 2
+            self._allocate(self.capacity)
+
+    def _allocate(self, capacity):
+        time, counts, bat = self._time, self._counts, self._bat
+        self._time = np.empty(capacity, dtype='<u8')
+        self._counts = np.empty((capacity, self.cols - 2), dtype='<i2')
+        self._bat = np.zeros(capacity//self.BAT_DECIMATION + 1, dtype='<i2')
+        if time is not None:
+            end = self._end
+            self._time[:end] = time[:end]
+            self._counts[:end] = counts[:end]
+            self._bat[:len(bat)] = bat
+
+    def _publish(self):
+        # Lines are written before being published; _view is replaced in a single assignment
+        self._view = (self._time, self._counts, self._bat, self._end, self.decoder)
+        self.size = self._end
+
+    @property
+    def data(self):
+        return self.view()
+
+    def view(self):
+        # Consistent view of all valid lines (converted when indexed)
+        time, counts, bat, end, decoder = self._view
+        if decoder is None:
+            return np.empty((0, self.cols))
+        return MuvBox_RawView(time, counts, bat, 0, end, decoder, self.BAT_DECIMATION)
+
+    def latest(self, n):
+        # Last n lines, converted (float array)
+        v = self.view()
+        return np.asarray(v[max(0, len(v) - n):])
+
+    def snapshot(self, t_from=-np.inf, t_to=np.inf):
+        # Consistent view of the lines with t_from <= time (column 0) <= t_to
+        # Time must be increasing (binary search on the rtc)
+        v = self.view()
+        if len(v) == 0:
+            return v
+        return v[v.search(t_from, 'left'):v.search(t_to, 'right')]
+
+    def reserve(self, n):
+        # Preallocation hint: make room for n lines without further resizing
+        if n > len(self._time):
+            self.capacity = n
+            self._allocate(n)
+            self._publish()
+
+    def finalize(self):
+        pass  # data is always consistent
+
+    @property
+    def nbytes(self):
+        # Memory allocated for the lines (bytes)
+        return self._time.nbytes + self._counts.nbytes + self._bat.nbytes
+
+    def clear(self, capacity=DEFAULT_CAPACITY, ring=None):
+        if ring:
+            raise ValueError('MuvBox_RawFrame does not support ring=True')
+        self.capacity = max(int(capacity), 1)
+        self._time = self._counts = self._bat = None
+        self._end = 0
+        self._allocate(self.capacity)
+        self.count = 0          # Total number of lines appended since clear
+        self._publish()
+
+
+class MuvBox_RawView:
+    # Lines start to end-1 of a MuvBox_RawFrame, indexed as a (lines x cols) float array.
+    # v[a:b] is another view (nothing converted). Other indexing (v[:,0], v[i,j], v[a:b,1:4],
+    # v[mask], np.asarray(v)) converts only the selected lines and columns to float64, with the
+    # same values as MuvBox_Decoder. Battery of line i is that of line i//BAT_DECIMATION*BAT_DECIMATION.
+
+    def __init__(self, time, counts, bat, start, end, decoder, decimation):
+        self._time = time
+        self._counts = counts
+        self._bat = bat
+        self.start = start
+        self.end = end
+        self.decoder = decoder
+        self.decimation = decimation
+        self.cols = len(decoder.firmware.channels)
+        self.shape = (end - start, self.cols)
+        self.ndim = 2
+        self._columns = [None]*self.cols     # column -> (counts column, counts per unit)
+        j = 0
+        for field, columns, scale in decoder.fields:
+            for c in range(columns.start, columns.stop):
+                self._columns[c] = (j, scale)
+                j += 1
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __array__(self, dtype=None, copy=None):
+        a = self._convert(slice(self.start, self.end), np.arange(self.cols))
+        return a if dtype is None else a.astype(dtype)
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        n = len(self)
+        if isinstance(rows, slice):
+            first, last, step = rows.indices(n)
+            if step == 1:
+                last = max(first, last)
+                if isinstance(cols, slice) and cols == slice(None):
+                    return MuvBox_RawView(self._time, self._counts, self._bat, self.start + first, self.start + last,
+                                          self.decoder, self.decimation)
+                lines = slice(self.start + first, self.start + last)
+            else:
+                lines = self.start + np.arange(first, last, step)
+        elif isinstance(rows, (int, np.integer)):
+            if not -n <= rows < n:
+                raise IndexError('index ' + str(rows) + ' out of range for ' + str(n) + ' lines')
+            lines = self.start + rows % n
+        else:
+            lines = self.start + np.arange(n)[rows]
+        return self._convert(lines, np.arange(self.cols)[cols])
+
+    def _convert(self, lines, c):
+        # Columns c (index or index array) of lines, as a float array
+        out = np.stack([self._column(k, lines) for k in np.atleast_1d(c)], axis=-1)
+        if np.ndim(c) == 0:
+            out = out[..., 0]
+        return out[()] if out.ndim == 0 else out
+
+    def _column(self, c, lines):
+        # Column c of lines (slice, index or index array of the frame), in units
+        d = self.decoder
+        if c == 0:
+            return self._time[lines]*d.timescale
+        if c == d.bat_column:
+            if isinstance(lines, slice):
+                lines = np.arange(lines.start, lines.stop)
+            return self._bat[np.asarray(lines)//self.decimation].astype(float)
+        j, scale = self._columns[c]
+        return self._counts[lines, j]/scale
+
+    def search(self, t, side='left'):
+        # Index of time t in the view (as np.searchsorted on column 0), searching the rtc
+        n = len(self)
+        if t == -np.inf:
+            return 0
+        if t == np.inf:
+            return n
+        time = self._time[self.start:self.end]
+        r = t/self.decoder.timescale
+        lo = np.searchsorted(time, np.uint64(min(max(np.floor(r) - 1, 0), 2**63)), side='left')
+        hi = np.searchsorted(time, np.uint64(min(max(np.ceil(r) + 1, 0), 2**63)), side='right')
+        return int(lo + np.searchsorted(time[lo:hi]*self.decoder.timescale, t, side=side))
+
+
+class MuvBox_SaveJob:
+    # Export of one MuvBox to a file (see SaveRoutine), with its own state (file, comment, limits).
+    # format: name of the exporter in muvbox_export.EXPORTERS (csv, npz, hdf5, parquet, ...)
+    # The lines to be saved are taken from a consistent snapshot when the job is created, so the
+    # MuvBox may keep acquiring while run() writes the file in another thread. Several jobs may
+    # run at the same time. cancel() stops a running job (the incomplete files are removed).
+
+    def __init__(self, m, path, comment, datetime2, start_point=0, stop_point=0,
+                 chunk_lines=2**13, buffer_size=2**20, format='csv'):
+        if format not in EXPORTERS:
+            raise ValueError('Unknown save format: ' + str(format))
+        self.exporter = EXPORTERS[format]()
+        self.format = format
+        self.name = m.name
+        self.location = m.location
+        self.comment = comment
+        self.rtc0 = m.rtc0
+        self.logger = m.logger
+        self.file = path + datetime2 + "_" + comment + "_" + m.name + self.exporter.EXTENSION
+        self.files = []     # Files created by the exporter
+        self.chunk_lines = chunk_lines      # Lines formatted and written at once (bounds the memory used)
+        self.buffer_size = buffer_size      # File buffer, in bytes
+
+        # Discover first and last elements to be saved (same limits as the former linear scan):
+        # first sample after start_point (0 if none), up to the first sample after stop_point
+        # (excluded), or up to the sample before the last one
+        data = m.sensors.view()
+        time = data[:,0]
+        rtc0 = self.rtc0
+        n = len(time)
+        first = 0
+        last = 0
+        if n > 0:
+            if (start_point>=0):
+                first = self._first_after(time, rtc0, start_point)
+                if first == n:
+                    first = 0
+            if (stop_point<=time[-1] - rtc0):
+                last = self._first_after(time, rtc0, stop_point)
+                if last == n:
+                    last = 0
+            else:
+                last = n - 1
+        last = max(first, last)
+        self.time = time[first:last]
+        self.data = data[first:last]
+        if m.sensors.ring:  # Ring buffer lines are reused while acquiring: copy (at most HISTORY seconds)
+            self.time = self.time.copy()
+            self.data = np.array(self.data)
+        self.lines = last - first
+
+        # Orientation (Q and angles) in the time interval of the sensors lines
+        if self.lines > 0:
+            self.Q = m.Q.snapshot(self.time[0], self.time[-1])
+            self.angles = m.angles.snapshot(self.time[0], self.time[-1])
+        else:
+            self.Q = m.Q.view()[:0]
+            self.angles = m.angles.view()[:0]
+        if m.Q.ring:
+            self.Q = self.Q.copy()
+            self.angles = self.angles.copy()
+        self.vectors = {'sensors': self.data, 'Q': self.Q, 'angles': self.angles}
+        self.cols = {'sensors': m.sensors.cols, 'Q': 5, 'angles': 4}
+        self.metadata = export_metadata(m, comment)
+
+        self.state = 'pending'      # pending, running, done, cancelled or error
+        self.progress = 0.0         # Fraction of lines written
+        self.error = None
+        self._cancel = Event()
+
+    @staticmethod
+    def _first_after(time, rtc0, t):
+        # Index of the first sample with time - rtc0 > t (len(time) if none). Time must be increasing.
+        # Binary search on time, then the exact comparison of the linear scan on the neighbours
+        i = int(np.searchsorted(time, t + rtc0, side='right'))
+        while i > 0 and time[i-1] - rtc0 > t:
+            i -= 1
+        while i < len(time) and not time[i] - rtc0 > t:
+            i += 1
+        return i
+
+    def header(self):
+        return self.exporter.header(self) if hasattr(self.exporter, 'header') else ''
+
+    def chunks(self, vector):
+        # (index, lines) of vector, chunk_lines lines at a time (converted to an array). Stops if cancelled.
+        for i in range(0, len(vector), self.chunk_lines):
+            if self._cancel.is_set():
+                return
+            yield i, np.asarray(vector[i:i+self.chunk_lines])
+
+    def report(self, lines, total):
+        # Called by the exporter after writing lines of total lines
+        self._done += lines
+        self.progress = self._done/total if total > 0 else 1.0
+        if self._progress is not None:
+            self._progress(self.progress)
+
+    def run(self, progress=None):
+        # Write the file. progress (optional) is called with the fraction of lines written after each chunk.
+        # Returns the final state.
+        self.state = 'running'
+        self._done = 0
+        self._progress = progress
+        try:
+            self.exporter.write(self)
+            if self._cancel.is_set():
+                for file in self.files:
+                    if os.path.exists(file):
+                        os.remove(file)
+                self.state = 'cancelled'
+                self.logger.warning('Save cancelled: %s', self.file)
+            else:
+                self.progress = 1.0
+                self.state = 'done'
+                self.logger.info('Data saved to %s', ', '.join(self.files))
+        except (OSError, ImportError) as msg:
+            self.error = msg
+            self.state = 'error'
+            self.logger.error('[MuvBox Error]: cannot save %s - Message: %s', self.file, msg)
+        except Exception as msg:    # Exporter error: the job must end (run in a thread pool)
+            self.error = msg
+            self.state = 'error'
+            self.logger.exception('[MuvBox Error]: cannot save %s - Message: %s', self.file, msg)
+        return self.state
+
+    def cancel(self):
+        self._cancel.set()
 
 
 class SaveRoutine:
+    # Saves the data of MuvBoxes to files in PATH, one file per MuvBox (MuvBox_SaveJob).
+    # format: csv (default), npz, hdf5 or parquet (see muvbox_export)
+    # start() saves in the calling thread. jobs() returns the jobs, to be run in background threads.
 
     __instance = None
 
+    CHUNK_LINES = 2**13         # Lines formatted and written at once (bounds the memory used by a save)
+    BUFFER_SIZE = 2**20         # File buffer, in bytes
+
     def __new__(cls):
         if SaveRoutine.__instance is None:
             SaveRoutine.__instance = object.__new__(cls)
             SaveRoutine.__instance.PATH = "./data/"
-            SaveRoutine.__instance.__saving = False
-            SaveRoutine.__instance.__start = False
-            SaveRoutine.__instance.__current_file = ""
-            SaveRoutine.__instance.__comment = []
-            SaveRoutine.__instance.__name = []
-            SaveRoutine.__instance.__datetime2 = ""
-            SaveRoutine.__instance.__start_point = 0
-            SaveRoutine.__instance.__stop_point = 0
-            SaveRoutine.__instance.__rtc0 = []
             SaveRoutine.__instance.M = []
+            SaveRoutine.__instance.last_jobs = []   # Jobs of the last call to jobs() or start()
         return SaveRoutine.__instance
 
-    def __append_points(self, m):
-        with open(self.__current_file, "a") as f:
-            # Discover first and last elements to be saved:
-            print('m = ' + str(m))
-            time2 = self.M[m].sensors.data[:,0]
-            print('rtc0 = ' + str(self.M[m].rtc0))
-            #for i in range(len(time2)):
-            #    time2[i] = time2[i] - self.M[m].rtc0
-            time2 = time2 - self.M[m].rtc0
-            if (self.__start_point>=0):
-                try:
-                    first = next(x[0] for x in enumerate(time2) if x[1] > self.__start_point)
-                except:
-                    first = 0
-            else:
-                first = 0
-            
-            if (self.__stop_point<=time2[-1]):
-                try:
-                    last =  next(x[0] for x in enumerate(time2) if x[1] > self.__stop_point)
-                except:
-                    last = 0
-            else:
-                last = len(time2) - 1
-
-            s = ""
-
-            for i in range(first, last, 1):
-                s += str(time2[i])
-                for j in range(6):
-                    s += ";{}".format(self.M[m].sensors.data[i,j+1])
-                #for j in range(3):
-                #    s += ";{}".format(self.M[m].gyroDeg[j][i])
-                #for j in range(3):
-                    #s += ";{}".format(self.M[m].magNorm[j][-1]) - TODO: incluir magnetometro
-                #    s += ";{}".format(0)
-                s += "\n"
-
-            f.write(s)
-            print('Data saved to ' + self.__current_file)
-            
-    def __start_file(self, m):
-        name = self.M[m].name
-        self.__current_file = SaveRoutine().PATH + self.__datetime2 + "_" + self.__comment + "_" + name + ".csv"
-        with open(self.__current_file, "w") as f:
-            s = name + ";" + self.M[m].location + ";" + self.__comment; self.__datetime2
-            s += "\n"
-            s += "time"
-            axis = ["x", "y", "z"]
-            types = ["acc_", "gyr_"]
-            for i in types:
-                for j in axis:
-                    s += ";{}{}".format(i, j)
-            s += "\n"
-            f.write(s)
-    
-    def start(self, M=[], comment="", start_point=0, stop_point=0):
+    def jobs(self, M=[], comment="", start_point=0, stop_point=0, format='csv'):
+        # One job per MuvBox with data. Snapshots of the data are taken now.
         self.M = M
-        self.__comment = comment
-        self.__start_point = start_point
-        self.__stop_point = stop_point
-        self.__datetime2 = str(datetime.datetime.now()).replace(" ", "_").replace(":","-")
-        for m in range(len(self.M)):
-            if (M[m].sensors.size > 0):
-                self.__start_file(m)
-                self.__append_points(m)
+        datetime2 = str(datetime.datetime.now()).replace(" ", "_").replace(":","-")
+        self.last_jobs = [MuvBox_SaveJob(m, self.PATH, comment, datetime2, start_point, stop_point,
+                                         self.CHUNK_LINES, self.BUFFER_SIZE, format)
+                          for m in M if m.sensors.size > 0]
+        return self.last_jobs
+
+    def start(self, M=[], comment="", start_point=0, stop_point=0, format='csv'):
+        for job in self.jobs(M, comment, start_point, stop_point, format):
+            job.run()
         
     def stop(self):
-        self.__start = False
-        self.__saving = False
-
-
-
+        # Cancel the jobs still running
+        for job in self.last_jobs:
+            job.cancel()
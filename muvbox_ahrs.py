@@ -0,0 +1,274 @@
+"""
+    ** MuvBox orientation (AHRS) **
+
+    Block-wise Madgwick filter on plain float arrays, used by MuvBox.updateQuaternion.
+
+    The equations are the same as ahrs.filters.Madgwick.updateIMU and updateMARG, but a whole
+    block of samples is processed in one call, without building Quaternion objects for each
+    sample. Results match the ahrs package within floating point tolerance.
+
+    Example:
+
+    Q = madgwick_imu([1, 0, 0, 0], gyr, acc, dt)   # gyr in rad/s, acc in m/s^2, dt in s
+    angles = quaternion_to_angles(Q)               # yaw, pitch, roll in degrees
+
+    MuvBox_AHRSWorker runs the same filter in a separate process, so orientation does not delay
+    data acquisition and scales across cores. Sensor blocks are copied to a shared memory ring
+    and the worker writes quaternions and angles to a second shared memory ring. It is used by
+    MuvBox when M.ahrs_process is True.
+"""
+import math
+import numpy as np
+
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+
+
+def madgwick_imu(q, gyr, acc, dt, gain=0.033):
+    # Madgwick IMU filter (gyroscope + accelerometer) for a block of n samples
+    ## Inputs:
+    # q -> initial quaternion [w, x, y, z]
+    # gyr -> (n, 3) angular rate, in rad/s
+    # acc -> (n, 3) acceleration
+    # dt -> (n,) time step of each sample, in s
+    # gain -> filter gain (beta)
+    ## Output:
+    # Q -> (n, 4) quaternion after each sample
+    Q = np.empty((len(dt), 4))
+    qw, qx, qy, qz = [float(v) for v in q]
+    samples = np.column_stack((gyr, acc, dt)).tolist()
+    for i, (gx, gy, gz, ax, ay, az, t) in enumerate(samples):
+        if gx != 0 or gy != 0 or gz != 0:
+            # Rate of change from gyroscope: 0.5 * q x [0, gyr]
+            dw = 0.5*(-qx*gx - qy*gy - qz*gz)
+            dx = 0.5*( qw*gx + qy*gz - qz*gy)
+            dy = 0.5*( qw*gy - qx*gz + qz*gx)
+            dz = 0.5*( qw*gz + qx*gy - qy*gx)
+            a_norm = math.sqrt(ax*ax + ay*ay + az*az)
+            if a_norm > 0:
+                ax, ay, az = ax/a_norm, ay/a_norm, az/a_norm
+                n = math.sqrt(qw*qw + qx*qx + qy*qy + qz*qz)
+                w, x, y, z = qw/n, qx/n, qy/n, qz/n
+                # Objective function and gradient (J.T @ f)
+                f1 = 2.0*(x*z - w*y) - ax
+                f2 = 2.0*(w*x + y*z) - ay
+                f3 = 2.0*(0.5 - x*x - y*y) - az
+                g0 = -2.0*y*f1 + 2.0*x*f2
+                g1 = 2.0*z*f1 + 2.0*w*f2 - 4.0*x*f3
+                g2 = -2.0*w*f1 + 2.0*z*f2 - 4.0*y*f3
+                g3 = 2.0*x*f1 + 2.0*y*f2
+                g_norm = math.sqrt(g0*g0 + g1*g1 + g2*g2 + g3*g3)
+                if g_norm > 0:
+                    dw -= gain*g0/g_norm
+                    dx -= gain*g1/g_norm
+                    dy -= gain*g2/g_norm
+                    dz -= gain*g3/g_norm
+            qw, qx, qy, qz = qw + dw*t, qx + dx*t, qy + dy*t, qz + dz*t
+            n = math.sqrt(qw*qw + qx*qx + qy*qy + qz*qz)
+            qw, qx, qy, qz = qw/n, qx/n, qy/n, qz/n
+        Q[i] = (qw, qx, qy, qz)
+    return Q
+
+
+def madgwick_marg(q, gyr, acc, mag, dt, gain=0.033):
+    # Madgwick MARG filter (gyroscope + accelerometer + magnetometer) for a block of n samples
+    ## Inputs: same as madgwick_imu, plus
+    # mag -> (n, 3) magnetic field
+    ## Output:
+    # Q -> (n, 4) quaternion after each sample
+    Q = np.empty((len(dt), 4))
+    qw, qx, qy, qz = [float(v) for v in q]
+    samples = np.column_stack((gyr, acc, mag, dt)).tolist()
+    for i, (gx, gy, gz, ax, ay, az, mx, my, mz, t) in enumerate(samples):
+        m_norm = math.sqrt(mx*mx + my*my + mz*mz)
+        if m_norm == 0:
+            Q[i:i+1] = madgwick_imu((qw, qx, qy, qz), [(gx, gy, gz)], [(ax, ay, az)], [t], gain)
+            qw, qx, qy, qz = Q[i].tolist()
+            continue
+        if gx != 0 or gy != 0 or gz != 0:
+            dw = 0.5*(-qx*gx - qy*gy - qz*gz)
+            dx = 0.5*( qw*gx + qy*gz - qz*gy)
+            dy = 0.5*( qw*gy - qx*gz + qz*gx)
+            dz = 0.5*( qw*gz + qx*gy - qy*gx)
+            a_norm = math.sqrt(ax*ax + ay*ay + az*az)
+            if a_norm > 0:
+                ax, ay, az = ax/a_norm, ay/a_norm, az/a_norm
+                mx, my, mz = mx/m_norm, my/m_norm, mz/m_norm
+                # Earth magnetic field: h = q x [0, m] x q*
+                pw = -qx*mx - qy*my - qz*mz
+                px =  qw*mx + qy*mz - qz*my
+                py =  qw*my - qx*mz + qz*mx
+                pz =  qw*mz + qx*my - qy*mx
+                hx = -pw*qx + px*qw - py*qz + pz*qy
+                hy = -pw*qy + px*qz + py*qw - pz*qx
+                hz = -pw*qz - px*qy + py*qx + pz*qw
+                bx = math.sqrt(hx*hx + hy*hy)
+                bz = hz
+                n = math.sqrt(qw*qw + qx*qx + qy*qy + qz*qz)
+                w, x, y, z = qw/n, qx/n, qy/n, qz/n
+                # Objective function and gradient (J.T @ f)
+                f1 = 2.0*(x*z - w*y) - ax
+                f2 = 2.0*(w*x + y*z) - ay
+                f3 = 2.0*(0.5 - x*x - y*y) - az
+                f4 = 2.0*bx*(0.5 - y*y - z*z) + 2.0*bz*(x*z - w*y) - mx
+                f5 = 2.0*bx*(x*y - w*z) + 2.0*bz*(w*x + y*z) - my
+                f6 = 2.0*bx*(w*y + x*z) + 2.0*bz*(0.5 - x*x - y*y) - mz
+                g0 = -2.0*y*f1 + 2.0*x*f2 - 2.0*bz*y*f4 + (-2.0*bx*z + 2.0*bz*x)*f5 + 2.0*bx*y*f6
+                g1 = 2.0*z*f1 + 2.0*w*f2 - 4.0*x*f3 + 2.0*bz*z*f4 + (2.0*bx*y + 2.0*bz*w)*f5 + (2.0*bx*z - 4.0*bz*x)*f6
+                g2 = -2.0*w*f1 + 2.0*z*f2 - 4.0*y*f3 + (-4.0*bx*y - 2.0*bz*w)*f4 + (2.0*bx*x + 2.0*bz*z)*f5 + (2.0*bx*w - 4.0*bz*y)*f6
+                g3 = 2.0*x*f1 + 2.0*y*f2 + (-4.0*bx*z + 2.0*bz*x)*f4 + (-2.0*bx*w + 2.0*bz*y)*f5 + 2.0*bx*x*f6
+                g_norm = math.sqrt(g0*g0 + g1*g1 + g2*g2 + g3*g3)
+                if g_norm > 0:
+                    dw -= gain*g0/g_norm
+                    dx -= gain*g1/g_norm
+                    dy -= gain*g2/g_norm
+                    dz -= gain*g3/g_norm
+            qw, qx, qy, qz = qw + dw*t, qx + dx*t, qy + dy*t, qz + dz*t
+            n = math.sqrt(qw*qw + qx*qx + qy*qy + qz*qz)
+            qw, qx, qy, qz = qw/n, qx/n, qy/n, qz/n
+        Q[i] = (qw, qx, qy, qz)
+    return Q
+
+
+def quaternion_to_angles(Q):
+    # Euler angles of the conjugate of each quaternion (same as Quaternion(Q.conj).to_angles())
+    ## Input:
+    # Q -> (n, 4) quaternions [w, x, y, z]
+    ## Output:
+    # (n, 3) yaw, pitch and roll, in degrees
+    w, x, y, z = Q[:, 0], -Q[:, 1], -Q[:, 2], -Q[:, 3]
+    angles = np.empty((len(Q), 3))
+    angles[:, 0] = np.arctan2(2.0*(w*z + x*y), 1.0 - 2.0*(y**2 + z**2))   # yaw
+    angles[:, 1] = np.arcsin(np.clip(2.0*(w*y - z*x), -1.0, 1.0))         # pitch
+    angles[:, 2] = np.arctan2(2.0*(w*x + y*z), 1.0 - 2.0*(x**2 + y**2))   # roll
+    return angles*180/np.pi
+
+
+class MuvBox_AHRSWorker:
+    # Madgwick filter in a worker process.
+    # Input ring (shared memory), one line per sample: time, dt, reset, accx, accy, accz, gyrx, gyry, gyrz,
+    #   magx, magy, magz (acc in m/s^2, gyr in rad/s, mag in uT (zero without magnetometer),
+    #   reset=1 restarts from quaternion [1, 0, 0, 0])
+    # Output ring (shared memory), same line index: time, qw, qx, qy, qz, yaw, pitch, roll
+    # Lines are identified by a counter that never decreases (line i is stored at i % capacity).
+
+    IN_COLS = 12
+    OUT_COLS = 8
+
+    def __init__(self, capacity=2**16, gain=0.033, marg=False):
+        self.capacity = capacity
+        ctx = multiprocessing.get_context('spawn')  # fork is not safe with the GUI and reading threads
+        self._shm_in = SharedMemory(create=True, size=capacity*self.IN_COLS*8)
+        self._shm_out = SharedMemory(create=True, size=capacity*self.OUT_COLS*8)
+        self._in = np.ndarray((capacity, self.IN_COLS), buffer=self._shm_in.buf)
+        self._out = np.ndarray((capacity, self.OUT_COLS), buffer=self._shm_out.buf)
+        self.written = ctx.Value('q', 0, lock=False)    # Lines written by the application
+        self.processed = ctx.Value('q', 0, lock=False)  # Lines processed by the worker
+        self.collected = 0       # Lines read back by the application (never decreases)
+        self._skip_until = 0     # Output lines before this one are discarded (see skip)
+        self._reset_pending = False  # reset requested by a push that was dropped
+        self.dropped = 0         # Lines not sent because the worker was too slow (input ring full)
+        self.lag = 0.0           # Time of the last pushed sample - time of the last collected angle (s)
+        self._last_time = 0.0
+        self._wakeup = ctx.Event()
+        self._stop = ctx.Event()
+        self.process = ctx.Process(target=_ahrs_worker, daemon=True,
+                                   args=(self._shm_in.name, self._shm_out.name, capacity, self.written,
+                                         self.processed, self._wakeup, self._stop, gain, marg))
+        self.process.start()
+
+    def push(self, block, reset=False):
+        # Send a block of samples: (n, 12) lines, see IN_COLS. Returns False if the block was dropped.
+        # A reset of a dropped block is applied to the next block sent.
+        n = len(block)
+        w = self.written.value
+        self._reset_pending = self._reset_pending or reset
+        if n == 0:
+            return True
+        if w + n - self.processed.value > self.capacity:
+            self.dropped += n
+            return False
+        i = w % self.capacity
+        k = min(n, self.capacity - i)   # the block may wrap around the ring
+        self._in[i:i+k] = block[:k]
+        self._in[:n-k] = block[k:]
+        if self._reset_pending:
+            self._in[i, 2] = 1
+            self._reset_pending = False
+        self.written.value = w + n
+        self._last_time = block[-1, 0]
+        self._wakeup.set()
+        return True
+
+    def skip(self):
+        # Discard results of every line pushed so far (data vectors were cleared).
+        # The worker may not have processed them yet: they are dropped by collect().
+        self._skip_until = self.written.value
+
+    def collect(self):
+        # Return the output lines processed since the last call: (n, 8), see OUT_COLS
+        p = self.processed.value
+        if p - self.collected > self.capacity:  # too late: older results were overwritten
+            self.collected = p - self.capacity
+        if self.collected < self._skip_until:   # results of lines pushed before skip()
+            self.collected = min(self._skip_until, p)
+        i = self.collected % self.capacity
+        n = p - self.collected
+        k = min(n, self.capacity - i)
+        out = np.concatenate((self._out[i:i+k], self._out[:n-k]))
+        self.collected = p
+        if n > 0:
+            self.lag = self._last_time - out[-1, 0]
+        elif p == self.written.value:
+            self.lag = 0.0
+        return out
+
+    def close(self):
+        self._stop.set()
+        self._wakeup.set()
+        self.process.join(1)
+        del self._in, self._out
+        self._shm_in.close()
+        self._shm_in.unlink()
+        self._shm_out.close()
+        self._shm_out.unlink()
+
+
+def _ahrs_worker(in_name, out_name, capacity, written, processed, wakeup, stop, gain, marg):
+    # Worker process main loop (see MuvBox_AHRSWorker)
+    shm_in = SharedMemory(name=in_name)
+    shm_out = SharedMemory(name=out_name)
+    inp = np.ndarray((capacity, MuvBox_AHRSWorker.IN_COLS), buffer=shm_in.buf)
+    out = np.ndarray((capacity, MuvBox_AHRSWorker.OUT_COLS), buffer=shm_out.buf)
+    q = np.array([1.0, 0, 0, 0])
+    r = processed.value
+    while not stop.is_set():
+        wakeup.wait(0.1)
+        wakeup.clear()
+        w = written.value
+        while r < w:
+            i = r % capacity
+            n = min(w - r, capacity - i)
+            lines = inp[i:i+n]
+            resets = np.flatnonzero(lines[:, 2])
+            if len(resets) > 0 and resets[0] > 0:
+                n = resets[0]                   # process up to the next reset
+                lines = lines[:n]
+            elif len(resets) > 0:
+                q = np.array([1.0, 0, 0, 0])
+                if len(resets) > 1:
+                    n = resets[1]
+                    lines = lines[:n]
+            if marg:
+                Q = madgwick_marg(q, lines[:, 6:9], lines[:, 3:6], lines[:, 9:12], lines[:, 1], gain)
+            else:
+                Q = madgwick_imu(q, lines[:, 6:9], lines[:, 3:6], lines[:, 1], gain)
+            out[i:i+n, 0] = lines[:, 0]
+            out[i:i+n, 1:5] = Q
+            out[i:i+n, 5:8] = quaternion_to_angles(Q)
+            q = Q[-1]
+            r += n
+            processed.value = r
+    del inp, out
+    shm_in.close()
+    shm_out.close()
@@ -0,0 +1,312 @@
+"""
+    ** MuvBox benchmarks **
+
+    Measures throughput and latency percentiles of the acquisition and analysis hot paths:
+     - decode: appendFromWindow and framer + decodePackets (one 150 packet window per call, and
+   MuvBox_Engine.BATCH_WINDOWS windows per call as the asyncio engine)
+     - dataframe: MuvBox_DataFrame.append (one line) and append_block (one window), packets appended to
+   MuvBox_DataFrame, MuvBox_RawFrame (COMPACT) and MuvBox_MappedFrame (MAPPED) and reading 10 s back from them
+     - quaternion: updateQuaternion after each window
+     - utilities: filters and analysis functions of utilities.py at plot window and session sizes
+     - save: SaveRoutine csv export
+     - gui: one update_sensor_data refresh with N MuvBoxes, with and without COMPACT (offscreen Qt, Agg canvas).
+       Skipped if PyQt5 is missing.
+
+    Results are written to a json file (one entry per benchmark, times in seconds), so releases can be compared:
+
+    python muvbox_benchmark.py --output bench.json
+    python muvbox_benchmark.py --output new.json --compare bench.json --tolerance 0.2
+
+    With --compare, the exit code is 1 if the median time of any benchmark increased more than tolerance.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import contextlib
+import datetime
+import subprocess
+
+import numpy as np
+
+from muvbox import MuvBox, MuvBox_DataFrame, SaveRoutine
+from muvbox_engine import MuvBox_Engine
+from muvbox_simulator import synthetic_signal, WINDOW
+import utilities
+
+
+def bench(name, func, repeat, items=1, setup=None):
+    # Call func repeat times and return the statistics of the call time.
+    # setup (optional) is called before each call and is not timed. items: number of samples per call.
+    times = np.empty(repeat)
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        t = time.perf_counter()
+        func()
+        times[i] = time.perf_counter() - t
+    result = {'name': name,
+              'calls': repeat,
+              'items_per_call': items,
+              'mean': float(times.mean()),
+              'p50': float(np.percentile(times, 50)),
+              'p90': float(np.percentile(times, 90)),
+              'p99': float(np.percentile(times, 99)),
+              'max': float(times.max()),
+              'throughput': float(items*repeat/times.sum()) if times.sum() > 0 else 0.0}  # items/s
+    print('%-40s p50 %10.3f ms   p99 %10.3f ms   %12.0f items/s' % (name, 1e3*result['p50'], 1e3*result['p99'], result['throughput']))
+    return result
+
+
+def make_muvbox(freq=1000):
+    # Offline MuvBox configured for firmware version 0
+    m = MuvBox()
+    m.name = 'BENCH'
+    m.ACQ_FREQ = freq
+    m.setup()
+    return m
+
+
+def make_packets(n, freq=1000, t0=0):
+    # n packets of the synthetic signal (PACKET_V0), with times starting at t0 samples
+    s = synthetic_signal(freq, n/freq + 1)[:n]
+    packets = np.zeros(n, dtype=MuvBox.PACKET_V0)
+    packets['end'] = 255
+    packets['time'] = (t0 + np.arange(n))*1000000//freq
+    packets['acc'] = np.round(s[:, 0:3]*2**15/4)
+    packets['gyr'] = np.round(s[:, 3:6]*2**15/250)
+    packets['bat'] = 3900
+    return packets
+
+
+def make_session(m, duration, freq=1000):
+    # Fill m.sensors with duration seconds of synthetic data
+    m.clear()
+    m.sensors.append_block(m.decodePackets(make_packets(int(duration*freq), freq)))
+    m.sensors.finalize()
+    return m
+
+
+def bench_decode(scale):
+    results = []
+    m = make_muvbox()
+    window = make_packets(WINDOW).tobytes()
+    m.clear()
+    results.append(bench('decode.appendFromWindow', lambda: m.appendFromWindow(window), 2000*scale, WINDOW))
+
+    packets = make_packets(WINDOW)
+    data = packets.view(np.uint8)
+
+    def next_window():
+        packets['time'] += WINDOW*1000  # the framer drops packets with older timestamps
+
+    def framer():
+        m.framer.free()[:len(data)] = data
+        m.framer.commit(len(data))
+        m.decode_values()
+    m.clear()
+    results.append(bench('decode.framer_decode_values', framer, 2000*scale, WINDOW, setup=next_window))
+
+    # Asyncio engine: MuvBox_Engine.BATCH_WINDOWS windows decoded by a single decode_values call
+    batch = MuvBox_Engine.BATCH_WINDOWS
+    windows = make_packets(WINDOW*batch)
+    windows_data = windows.view(np.uint8)
+
+    def next_batch():
+        windows['time'] += WINDOW*batch*1000
+        m.framer.free()[:len(windows_data)] = windows_data
+        m.framer.commit(len(windows_data))
+    m.clear()
+    results.append(bench('decode.framer_decode_values_batch', m.decode_values, 2000*scale//batch,
+                         WINDOW*batch, setup=next_batch))
+    return results
+
+
+def bench_dataframe(scale):
+    results = []
+    line = [0.0]*8
+    block = np.zeros((WINDOW, 8))
+    df = MuvBox_DataFrame(8)
+    results.append(bench('dataframe.append', lambda: df.append(line), 100000*scale))
+    df = MuvBox_DataFrame(8)
+    results.append(bench('dataframe.append_block', lambda: df.append_block(block), 10000*scale, WINDOW))
+    df = MuvBox_DataFrame(8, 60000, ring=True)
+    results.append(bench('dataframe.append_block_ring', lambda: df.append_block(block), 10000*scale, WINDOW))
+    for storage in ['', 'compact', 'mapped']:
+        m = make_muvbox()
+        m.COMPACT = storage == 'compact'
+        m.MAPPED = storage == 'mapped'
+        m.clear()
+        packets = make_packets(WINDOW, t0=-WINDOW)
+
+        def next_window():
+            packets['time'] += WINDOW*1000  # increasing times, as received
+        name = 'dataframe.append_packets' + ('_' + storage if storage else '')
+        results.append(bench(name, lambda: m.appendPackets(packets), 10000*scale, WINDOW, setup=next_window))
+        rows = len(m.sensors.snapshot(10, 20))
+        if rows != 10001:
+            raise RuntimeError(name + ': snapshot(10, 20) returned ' + str(rows) + ' lines instead of 10001')
+        results.append(bench(name + '.snapshot_10s', lambda: np.array(m.sensors.snapshot(10, 20)), 100*scale, rows))
+    return results
+
+
+def bench_quaternion(scale):
+    m = make_muvbox()
+    m.calculate_quaternion = True
+    m.clear()
+    state = {'k': 0}
+
+    def new_window():
+        m.sensors.append_block(m.decodePackets(make_packets(WINDOW, t0=state['k'])))
+        state['k'] += WINDOW
+    return [bench('quaternion.updateQuaternion', m.updateQuaternion, 200*scale, WINDOW, setup=new_window)]
+
+
+def bench_utilities(scale):
+    results = []
+    fs = 1000
+    for duration in [10, 60]:  # plot window, one minute session
+        n = duration*fs
+        t = np.arange(n)/fs
+        y = synthetic_signal(fs, duration)[:, 0]
+        ylist = list(y)
+        r = max(1, 5*scale)
+        suffix = '[' + str(n) + ']'
+        results.append(bench('utilities.lowpass_iir_filter' + suffix, lambda: utilities.lowpass_iir_filter(y, fs, 20), r, n))
+        results.append(bench('utilities.lowpass_filter' + suffix, lambda: utilities.lowpass_filter(y, fs, 20), r, n))
+        results.append(bench('utilities.bandpass_iir_filter' + suffix, lambda: utilities.bandpass_iir_filter(y, fs, 1, 20), r, n))
+        results.append(bench('utilities.bandpass_filter' + suffix, lambda: utilities.bandpass_filter(y, fs, 1, 20), r, n))
+        results.append(bench('utilities.resample' + suffix, lambda: utilities.resample(t, y), r, n))
+        results.append(bench('utilities.integrate' + suffix, lambda: utilities.integrate(t, y), r, n))
+        results.append(bench('utilities.bind_last_point' + suffix, lambda: utilities.bind_last_point(t, y), r, n))
+        results.append(bench('utilities.find_cross' + suffix, lambda: utilities.find_cross(t, y, 0, 'r'), r, n))
+        results.append(bench('utilities.find_peaks' + suffix, lambda: utilities.find_peaks(y, 0, 'r', 'max'), r, n))
+        results.append(bench('utilities.remove_outliers' + suffix, lambda: utilities.remove_outliers(list(ylist), 0.5), r, n))
+        results.append(bench('utilities.subtraction_mean' + suffix, lambda: utilities.subtraction_mean(ylist, ylist), r, n))
+        results.append(bench('utilities.g_to_ms2' + suffix, lambda: utilities.g_to_ms2(y), r, n))
+        results.append(bench('utilities.std' + suffix, lambda: utilities.std(ylist), r, n))
+        results.append(bench('utilities.rms' + suffix, lambda: utilities.rms(y), r, n))
+    return results
+
+
+def bench_save(scale, boxes=4, duration=60):
+    M = [make_session(make_muvbox(), duration) for i in range(boxes)]
+    saver = SaveRoutine()
+    path = saver.PATH
+
+    def save():
+        with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):  # messages of the MuvBoxes (LOG_CONSOLE)
+            saver.start(M, 'bench', 0, 1e9)
+    with tempfile.TemporaryDirectory() as directory:
+        saver.PATH = directory + '/'
+        try:
+            result = bench('save.SaveRoutine[' + str(boxes) + 'x' + str(duration) + 's]', save, max(1, scale),
+                           boxes*duration*1000)
+        finally:
+            saver.PATH = path
+    return [result]
+
+
+def bench_gui(scale, boxes=4, duration=60):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    try:
+        from PyQt5 import QtWidgets
+        import muvbox_control
+    except ImportError as msg:
+        print('gui benchmark skipped: ' + str(msg))
+        return [{'name': 'gui.update_sensor_data', 'skipped': str(msg)}]
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv[:1])
+    results = []
+    for storage in ['', 'compact']:
+        main = muvbox_control.MainWindow()
+        main.M = []
+        for m in range(boxes):
+            muvbox = make_muvbox()
+            muvbox.COMPACT = storage == 'compact'
+            main.M.append(make_session(muvbox, duration))
+            main.M[m].color = 'C' + str(m+1)
+            for ax, lines in zip(main.ax2, [main.line0, main.line1, main.line2]):
+                line, = ax.plot([0], [0])
+                line.set_color(main.M[m].color)
+                lines.append(line)
+        main.radio_button_acc.setChecked(True)
+        name = 'gui.update_sensor_data[' + str(boxes) + ' boxes]' + ('_' + storage if storage else '')
+        results.append(bench(name, main.update_sensor_data, 20*scale, boxes*main.time_window.value()*1000))
+        main.close()
+    return results
+
+
+BENCHMARKS = {'decode': bench_decode,
+              'dataframe': bench_dataframe,
+              'quaternion': bench_quaternion,
+              'utilities': bench_utilities,
+              'save': bench_save,
+              'gui': bench_gui}
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'date': str(datetime.datetime.now()),
+            'driver_version': MuvBox.PC_DRIVER_VERSION,
+            'commit': commit,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor()}
+
+
+def compare(results, baseline, tolerance):
+    # Print the change of the median time of each benchmark. Return the names of the regressions.
+    old = {r['name']: r for r in baseline['results'] if 'p50' in r}
+    regressions = []
+    for r in results:
+        if 'p50' in r and r['name'] in old and old[r['name']]['p50'] > 0:
+            change = r['p50']/old[r['name']]['p50'] - 1
+            flag = ''
+            if change > tolerance:
+                flag = '  REGRESSION'
+                regressions.append(r['name'])
+            print('%-40s %+8.1f %%%s' % (r['name'], 100*change, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='MuvBox benchmarks')
+    parser.add_argument('--output', default='bench.json', help='json file with the results')
+    parser.add_argument('--only', default=','.join(BENCHMARKS), help='Comma separated list of: ' + ', '.join(BENCHMARKS))
+    parser.add_argument('--scale', type=int, default=1, help='Multiply the number of calls')
+    parser.add_argument('--boxes', type=int, default=4, help='Number of MuvBoxes in save and gui benchmarks')
+    parser.add_argument('--compare', default='', help='json file of a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed increase of the median time (0.2 = 20 %%)')
+    args = parser.parse_args(argv)
+    output = os.path.abspath(args.output)
+    baseline = os.path.abspath(args.compare) if args.compare else ''
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))  # main.ui, ./res and ./log are relative
+    results = []
+    for name in args.only.split(','):
+        if name in ['save', 'gui']:
+            results += BENCHMARKS[name](args.scale, args.boxes)
+        else:
+            results += BENCHMARKS[name](args.scale)
+
+    with open(output, 'w') as f:
+        json.dump({'environment': environment(), 'results': results}, f, indent=1)
+    print('Results saved to ' + output)
+
+    if baseline:
+        with open(baseline) as f:
+            if compare(results, json.load(f), args.tolerance):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
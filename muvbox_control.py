@@ -44,10 +44,23 @@ from ahrs import Quaternion
 import ahrs
 
 from utilities import *
+from muvbox_engine import MuvBox_Engine
+from muvbox_metrics import start_metrics_server
 
 TABLE_FILE = "./res/ip.txt"
 LOGO_FILE = "./res/muv.svg"
+DNS_CACHE_FILE = "./res/dns_cache.json"
 USER_OS = platform.system()
+ACQUISITION_ENGINE = False  # True: all MuvBoxes run on a single asyncio event loop (muvbox_engine)
+RECORD_JOURNAL = False      # True: received packets are recorded to ./data/*.muvj while acquiring (muvbox_journal)
+COMPACT_STORAGE = False     # True: sensors kept as raw counts (about 3x less memory, converted when plotted/saved)
+MAPPED_STORAGE = False      # True: data vectors kept in temporary files (sessions longer than the RAM allows)
+CONNECT_TIMEOUT = 10        # Maximum time (s) to wait for all MuvBoxes in connect_n
+AUTO_RECONNECT = False      # True: reconnect automatically when a connection is lost while reading (data is kept)
+SAVE_FORMAT = 'csv'         # Format of the saved files: csv, npz, hdf5 (needs h5py) or parquet (needs pyarrow)
+RECORD_DATA = False         # True: data is saved to rolling files in ./data/ while acquiring (only the last minute kept in memory)
+RECORD_FORMAT = 'csv'       # Format of the recorded files: csv, hdf5 or parquet
+METRICS_PORT = 0            # > 0: serve Prometheus metrics at http://127.0.0.1:METRICS_PORT/metrics (muvbox_metrics)
 
 # ctypes - MessageBox
 MB_OK = 0
@@ -79,6 +92,29 @@ def Mbox(title, text, style):
             msgBox.exec()
 
 
+class SaveSignals(QtCore.QObject):
+    # Signals of a background save (emitted in the worker thread, delivered in the GUI thread)
+    progress = QtCore.pyqtSignal(int, float)   # job number, fraction of lines written
+    finished = QtCore.pyqtSignal(int, str)     # job number, final state (done, cancelled or error)
+
+
+class SaveTask(QtCore.QRunnable):
+    # Runs one MuvBox_SaveJob in a QThreadPool
+
+    def __init__(self, number, job):
+        super(SaveTask, self).__init__()
+        self.number = number
+        self.job = job
+        self.signals = SaveSignals()
+
+    def run(self):
+        state = 'error'
+        try:
+            state = self.job.run(lambda fraction: self.signals.progress.emit(self.number, fraction))
+        finally:
+            self.signals.finished.emit(self.number, state)    # The progress dialog waits for all jobs
+
+
 # TODO: inserir o comando finalize quando parar o gráfico.
 
 class MainWindow(QtWidgets.QMainWindow):
@@ -115,6 +151,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.logo_muv = self.findChild(QtWidgets.QLabel, 'label_8')
         self.cutoff = self.findChild(QtWidgets.QSpinBox, 'spinBox_5')
         self.log_data = 0
+        self.log_formatter = MuvBox_Formatter()
         ## Config. Inicial var
         self.scanButton = self.findChild(QtWidgets.QPushButton, 'pushButton_12')
         self.saveButton = self.findChild(QtWidgets.QPushButton, 'pushButton_15')
@@ -212,14 +249,20 @@ class MainWindow(QtWidgets.QMainWindow):
         self.M = []  # Vetor de muvboxes
 
         self.threads = []     
+        self.save_pool = QtCore.QThreadPool()  # Background saves (one job per MuvBox)
+        self.save_tasks = []
+        self.save_progress = None
+        self.engine = MuvBox_Engine() if ACQUISITION_ENGINE else None
+        self.dns_cache = MuvBox_DNSCache(DNS_CACHE_FILE)
+        if METRICS_PORT > 0:
+            start_metrics_server(self.M, METRICS_PORT)
         logo = QPixmap(LOGO_FILE)
         self.logo_muv.setPixmap(logo.scaled(200, 200, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation))
 
         
     def stop_reading(self):
         self.timer2.stop()
-        for m in range(len(self.M)):
-            self.M[m].stop()        
+        stop_all(self.M)  # all MuvBoxes at the same time
         self.update_sensor_data(0)  # Atualiza o gráfico com todos os pontos lidos
     
     def disconnect(self):
@@ -267,16 +310,16 @@ class MainWindow(QtWidgets.QMainWindow):
     def connect_n(self):
         # Connect all MuvBoxes from table
         # Connect to multiple MuvBoxes
-        if USER_OS == 'Linux': #Check for Linux and clear mDns
-            os.system('avahi-browse -a -r -t -v')
-            time.sleep(1)
-        for m in range(len(self.M)):
-            self.M[m].stop_reading = True
-        time.sleep(1)
+        if USER_OS == 'Linux': #Check for Linux and clear mDns (in background, connection does not wait)
+            try:
+                subprocess.Popen(['avahi-browse', '-a', '-r', '-t'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            except OSError:
+                pass
+        stop_all(self.M)  # Para as MuvBoxes anteriores
+        self.update_logbox()  # Mensagens pendentes das MuvBoxes anteriores
         self.M.clear()  # Limpa vetor de muvboxes
 
         print(self.table.columnCount())
-        self.stringlist0 = [[] for i in range(self.table.columnCount())]
 
         for column in range(self.table.columnCount()):
             m = column
@@ -289,8 +332,16 @@ class MainWindow(QtWidgets.QMainWindow):
             self.M[m].location = self.table.item(2,m).text()
             # self.M[m].calculate_quaternion = False
             self.M[m].marg = False      
-            self.M[m].logbox = self.stringlist0[m]        
-            self.M[m].connect()           
+            self.M[m].engine = self.engine
+            self.M[m].JOURNAL = RECORD_JOURNAL
+            self.M[m].COMPACT = COMPACT_STORAGE
+            self.M[m].MAPPED = MAPPED_STORAGE
+            self.M[m].AUTO_RECONNECT = AUTO_RECONNECT
+            self.M[m].RECORD = RECORD_DATA
+            self.M[m].RECORD_FORMAT = RECORD_FORMAT
+            self.M[m].dns_cache = self.dns_cache
+            self.M[m].LOG_CONSOLE = False   # Messages are shown in the logbox (update_logbox)
+        connect_all(self.M, CONNECT_TIMEOUT)  # all MuvBoxes at the same time
 
         
         self.parar = False
@@ -327,13 +378,14 @@ class MainWindow(QtWidgets.QMainWindow):
         self.logbox.setReadOnly(True)
 
     def update_logbox(self):
-        try:
-            for m in range(len(self.stringlist0)):
-                for n in range(len(self.stringlist0[m])):
-                    self.log_write('['+str(datetime.datetime.now())+']:  '+self.stringlist0[m][n])
-                self.stringlist0[m].clear()   
-        except:
-            print('Erro atualizando logboxes')
+        # Drain the log rings of all MuvBoxes (records are formatted only here)
+        lines = []
+        for m in self.M:
+            while m.log_ring:
+                record = m.log_ring.popleft()
+                lines.append('['+str(datetime.datetime.fromtimestamp(record.created))+']:  '+self.log_formatter.format(record))
+        if lines:
+            self.log_write('\n'.join(lines))
 
     def log_write(self, string):
         with open(self.log_filename, 'a') as file_object:
@@ -367,129 +419,50 @@ class MainWindow(QtWidgets.QMainWindow):
 
         for m in range(nro_active_muvboxes):
             if (self.M[m].visible and self.M[m].sensors.size>30):
-                if self.radio_button_acc.isChecked() or self.radio_button_gyr.isChecked():
+                if self.radio_button_acc.isChecked():
+                    self.M[m].calculate_quaternion = False
+                    frame = self.M[m].sensors
+                    columns = [1, 2, 3]  # acc_x, acc_y, acc_z
+                elif self.radio_button_gyr.isChecked():
                     self.M[m].calculate_quaternion = False
-                    last_index = self.M[m].sensors.size - 1
-                    rtc = self.M[m].sensors.data[:last_index,0]  # Vetor de tempo
+                    frame = self.M[m].sensors
+                    columns = [4, 5, 6]  # gyr_x, gyr_y, gyr_z
                 else:
                     self.M[m].calculate_quaternion = True
-                    last_index = self.M[m].angles.size - 1
-                    rtc = self.M[m].angles.data[:last_index,0]  # Vetor de tempo
+                    frame = self.M[m].angles
+                    columns = [1, 2, 3]  # yaw, pitch, roll
+                # acq_rate is estimated by the driver (MuvBox.time_health)
                 
-                if (len(rtc)>30):
-                    deltat = (rtc[-1] - rtc[-20])
-                    if (deltat>0):
-                        acquisition_rate = (20/deltat)
-                    else:
-                        acquisition_rate = 0
+                # Consistent views of the data vectors (no torn lines while the MuvBox is appending).
+                # Seleciona os pontos a serem impressos no gráfico (busca binária no tempo): only the
+                # lines shown are read (with COMPACT, only those are converted)
+                last = frame.latest(1)
+                if (opt==1) and (len(last)>0):
+                    x_axis_min = last[0, 0] - self.time_window.value()
+                    data = frame.snapshot(x_axis_min)
                 else:
-                    acquisition_rate = 0
-                self.M[m].acq_rate = acquisition_rate
+                    data = frame.view()
                 
-                # Calcula o número de pontos dos vetores a serem impressos no gráfico
-                nro_pontos = 0
-                try:
-                    if (len(rtc)>0):
-                        x_axis_min = rtc[-1] - self.time_window.value()
-                    else:
-                        x_axis_min = 0
-                    
-                    if (opt==1):
-                        nro_pontos = sum(rtc>x_axis_min)
-                    else:
-                        nro_pontos = len(rtc)
-                except:
-                    nro_pontos = 1
-
-                first_index = len(rtc) - nro_pontos
-                
-                if self.radio_button_acc.isChecked():
+                rtc = data[:,0] - self.M[m].rtc0
+                y = [data[:,c] for c in columns]
+                if (self.M[m].acq_rate > 2*float(self.cutoff.value())):
                     try:
-                        # TODO: testar para várias muvboxes ao mesmo tempo
-                        rtc = self.M[m].sensors.data[first_index:last_index,0]
-                        rtc = rtc - self.M[m].rtc0      
-                        acc_x = self.M[m].sensors.data[first_index:last_index,1]
-                        acc_y = self.M[m].sensors.data[first_index:last_index,2]
-                        acc_z = self.M[m].sensors.data[first_index:last_index,3]
-
-                        if (self.M[m].acq_rate > 2*float(self.cutoff.value())):
-                            acc_x = lowpass_iir_filter(acc_x, self.M[m].acq_rate, float(self.cutoff.value()))
-                            acc_y = lowpass_iir_filter(acc_y, self.M[m].acq_rate, float(self.cutoff.value()))
-                            acc_z = lowpass_iir_filter(acc_z, self.M[m].acq_rate, float(self.cutoff.value()))
-                        
-                        self.line0[m].set_ydata(acc_x)
-                        self.line0[m].set_xdata(rtc)
-                        self.line1[m].set_ydata(acc_y)
-                        self.line1[m].set_xdata(rtc)
-                        self.line2[m].set_ydata(acc_z)
-                        self.line2[m].set_xdata(rtc)
-                        self.ax2[0].draw_artist(self.line0[m])
-                        self.ax2[1].draw_artist(self.line1[m])
-                        self.ax2[2].draw_artist(self.line2[m])
-                                                
-                        self.fig2.update()
-                        self.fig2.flush_events()
-
-                    except:
-                        pass
-
-                if self.radio_button_gyr.isChecked():
-                    try:
-                        rtc = self.M[m].sensors.data[first_index:last_index,0]
-                        rtc = rtc - self.M[m].rtc0   
-                        gyr_x = self.M[m].sensors.data[first_index:last_index,4]
-                        gyr_y = self.M[m].sensors.data[first_index:last_index,5]
-                        gyr_z = self.M[m].sensors.data[first_index:last_index,6]
-
-                        if (self.M[m].acq_rate > 2*float(self.cutoff.value())):
-                            gyr_x = lowpass_iir_filter(gyr_x, self.M[m].acq_rate, float(self.cutoff.value()))
-                            gyr_y = lowpass_iir_filter(gyr_y, self.M[m].acq_rate, float(self.cutoff.value()))
-                            gyr_z = lowpass_iir_filter(gyr_z, self.M[m].acq_rate, float(self.cutoff.value()))
-                        
-                        self.line0[m].set_ydata(gyr_x)
-                        self.line0[m].set_xdata(rtc)
-                        self.line1[m].set_ydata(gyr_y)
-                        self.line1[m].set_xdata(rtc)
-                        self.line2[m].set_ydata(gyr_z)
-                        self.line2[m].set_xdata(rtc)
-                        self.ax2[0].draw_artist(self.line0[m])
-                        self.ax2[1].draw_artist(self.line1[m])
-                        self.ax2[2].draw_artist(self.line2[m])
-                                                
-                        self.fig2.update()
-                        self.fig2.flush_events()
-                    except:
-                        pass
-    
-                if self.radio_button_angles.isChecked():
-                    try:
-                        rtc = self.M[m].angles.data[first_index:last_index,0]
-                        rtc = rtc - self.M[m].rtc0 
-                        yaw = self.M[m].angles.data[first_index:last_index,1]
-                        pitch = self.M[m].angles.data[first_index:last_index,2]
-                        roll = self.M[m].angles.data[first_index:last_index,3]
-                        
-                        if (self.M[m].acq_rate > 2*float(self.cutoff.value())):
-                            yaw = lowpass_iir_filter(yaw, self.M[m].acq_rate, float(self.cutoff.value()))
-                            pitch = lowpass_iir_filter(pitch, self.M[m].acq_rate, float(self.cutoff.value()))
-                            roll = lowpass_iir_filter(roll, self.M[m].acq_rate, float(self.cutoff.value()))
-
-                        self.line0[m].set_ydata(yaw)
-                        self.line0[m].set_xdata(rtc)
-                        self.line1[m].set_ydata(pitch)
-                        self.line1[m].set_xdata(rtc)
-                        self.line2[m].set_ydata(roll)
-                        self.line2[m].set_xdata(rtc)
-                        self.ax2[0].draw_artist(self.line0[m])
-                        self.ax2[1].draw_artist(self.line1[m])
-                        self.ax2[2].draw_artist(self.line2[m])
-                                                
-                        self.fig2.update()
-                        self.fig2.flush_events()
-                      
-                    except:
-                        pass
-
+                        y = [lowpass_iir_filter(v, self.M[m].acq_rate, float(self.cutoff.value())) for v in y]
+                    except ValueError:
+                        pass  # too few points to filter
+
+                self.line0[m].set_ydata(y[0])
+                self.line0[m].set_xdata(rtc)
+                self.line1[m].set_ydata(y[1])
+                self.line1[m].set_xdata(rtc)
+                self.line2[m].set_ydata(y[2])
+                self.line2[m].set_xdata(rtc)
+                self.ax2[0].draw_artist(self.line0[m])
+                self.ax2[1].draw_artist(self.line1[m])
+                self.ax2[2].draw_artist(self.line2[m])
+                                        
+                self.fig2.update()
+                self.fig2.flush_events()
                     
                 if (len(rtc)>0) and (rtc[-1] > self.max_time):
                     self.max_time = rtc[-1]
@@ -717,8 +690,9 @@ class MainWindow(QtWidgets.QMainWindow):
                 formatted_acqusition_rate = "{:.0f}".format(self.M[column].acq_rate)
                 item = QTableWidgetItem(formatted_acqusition_rate) 
                 self.table.setItem(9, column, item)  # acq. rate
-                if self.M[column].sensors.size > 0:
-                    b = self.M[column].sensors.data[self.M[column].sensors.size-1,7]  # último ponto lido da bateria
+                last = self.M[column].sensors.latest(1)
+                if len(last) > 0:
+                    b = last[0,7]  # último ponto lido da bateria
                     if b>150:
                         b_level = 'Charging'
                     elif b>100:
@@ -742,11 +716,47 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def save_data(self):
         # Salva os dados do gráfico na pasta ./Data
+        # Each MuvBox is saved by a background job working on a snapshot of its data, so the
+        # acquisition and the GUI keep running. Progress and cancel in a progress dialog.
+        if any(task.job.state in ['pending', 'running'] for task in self.save_tasks):
+            Mbox('Save file', 'Files are still being saved.', 'information')
+            return
         comment, ok = QInputDialog.getText(self, 'Save file', 'Comment: ')
         if ok:
             start = float(self.start_value.text())
             stop = float(self.stop_value.text())
-            SaveRoutine().start(self.M, comment, start, stop)
+            jobs = SaveRoutine().jobs(self.M, comment, start, stop, SAVE_FORMAT)
+            if len(jobs) == 0:
+                return
+            self.save_tasks = [SaveTask(number, job) for number, job in enumerate(jobs)]
+            self.save_progress = QtWidgets.QProgressDialog('Saving ' + str(len(jobs)) + ' file(s)...', 'Cancel', 0, 100, self)
+            self.save_progress.setWindowTitle('Save file')
+            self.save_progress.setMinimumDuration(500)
+            self.save_progress.setValue(0)
+            self.save_progress.canceled.connect(self.cancel_save)
+            self.save_pool.setMaxThreadCount(len(jobs))  # all MuvBoxes in parallel
+            for task in self.save_tasks:
+                task.signals.progress.connect(self.save_data_progress)
+                task.signals.finished.connect(self.save_data_finished)
+                self.save_pool.start(task)
+
+    def save_data_progress(self, number, fraction):
+        lines = sum(task.job.lines for task in self.save_tasks)
+        done = sum(task.job.progress*task.job.lines for task in self.save_tasks)
+        if lines > 0 and self.save_progress is not None:
+            self.save_progress.setValue(min(99, int(100*done/lines)))
+
+    def save_data_finished(self, number, state):
+        if all(task.job.state not in ['pending', 'running'] for task in self.save_tasks):
+            self.save_progress.reset()
+            self.update_logbox()
+            states = [task.job.state for task in self.save_tasks]
+            if 'cancelled' not in states:
+                Mbox('Save file', str(states.count('done')) + ' of ' + str(len(states)) + ' file(s) saved!', 'information')
+
+    def cancel_save(self):
+        for task in self.save_tasks:
+            task.job.cancel()
 
 
     def onselect(self, xmin, xmax):
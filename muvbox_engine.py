@@ -0,0 +1,280 @@
+"""
+    ** MuvBox acquisition engine **
+
+    Runs the connections of many MuvBoxes on a single asyncio event loop, instead of one
+    reading thread with blocking sockets per MuvBox.
+
+    The event loop runs in a daemonic background thread. When M.engine is set, the MuvBox
+    commands connect(), start(), stop() and disconnect() are forwarded to the engine, so the
+    MuvBox API does not change. Example:
+
+    from muvbox import *
+    from muvbox_engine import MuvBox_Engine
+    engine = MuvBox_Engine()
+    M = MuvBox()
+    M.name = 'MuvBox14'
+    M.engine = engine
+    M.connect()
+    M.start()
+    M.stop()
+    M.disconnect()
+
+    connect_all(), start_all(), stop_all() and disconnect_all() run a command on several
+    MuvBoxes at the same time.
+
+    Sockets are non-blocking and received bytes go straight into the framer buffer of each
+    MuvBox (loop.sock_recv_into). Packets are decoded in batches of BATCH_WINDOWS windows (less CPU per
+    window than decoding each window, see the benchmark decode.framer_decode_values_batch), or after
+    BATCH_LATENCY seconds, so data reaches the plot at least as often as it is refreshed.
+    Commands are sent with loop.sock_sendall, so they never block the streams of other MuvBoxes.
+
+    The blocking methods (connect, start, ...) must not be called from the engine loop itself.
+"""
+import asyncio
+import concurrent.futures
+import socket
+import time
+from threading import Thread
+
+
+class MuvBox_Engine:
+
+    BATCH_WINDOWS = 4       # Decode when at least this number of windows is buffered (<= MuvBox.RX_WINDOWS/2)
+    BATCH_LATENCY = 0.2     # ... or when this time (s) passed since the last decode (GUI refresh interval)
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.tasks = {}     # Streaming task of each MuvBox
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        # Schedule a coroutine on the engine loop from any thread. Returns a concurrent.futures.Future
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        # Run a coroutine on the engine loop and wait for the result
+        return self.submit(coro).result()
+
+    ## Blocking commands (MuvBox facade)
+
+    def connect(self, m):
+        self.run(self.do_connect(m))
+
+    def start(self, m):
+        self.run(self.do_start(m))
+
+    def stop(self, m):
+        self.run(self.do_stop(m))
+
+    def disconnect(self, m):
+        self.run(self.do_disconnect(m))
+
+    def connect_all(self, M, timeout=None):
+        # Wait at most timeout seconds (None: until all are done). The others continue connecting.
+        try:
+            self.submit(self._gather(self.do_connect, M)).result(timeout)
+        except concurrent.futures.TimeoutError:
+            pass
+
+    def start_all(self, M):
+        self.run(self._gather(self.do_start, M))
+
+    def stop_all(self, M):
+        self.run(self._gather(self.do_stop, M))
+
+    def disconnect_all(self, M):
+        self.run(self._gather(self.do_disconnect, M))
+
+    async def _gather(self, command, M):
+        await asyncio.gather(*[command(m) for m in M])
+
+    ## Coroutines
+
+    async def do_connect(self, m):
+        if m.state != 0:
+            return
+        m.stop_reading = False
+        m.logger.info('Start _do_connect')
+        m.status = 'Connecting'
+        got_ip = await self.loop.run_in_executor(None, m.resolve)  # DNS is blocking
+        if not got_ip:
+            m.status = 'Error'
+            return
+        try:
+            m.logger.info('IP = %s', m.ip)
+            m._dest = (m.ip, m.port)
+            m.acq_rate = 0
+            m.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # TCP
+            m.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, m.RCVBUF_SIZE)
+            m.sock.setblocking(False)
+            await asyncio.wait_for(self.loop.sock_connect(m.sock, m._dest), m.TIMEOUT)
+            m.status = 'Online'
+            m.logger.info('SUCCESSFULL CONNECTED TO %s', m.ip)
+            await self.command__system_info(m)  # Read MuvBox info, including firmware version
+            m.setup()   # Configure environment according to firmware version
+            m.logger.info('End do_connect')
+            m.state = 2
+            m.cache_ip()
+        except asyncio.TimeoutError:
+            m.logger.error('[MuvBox Error] Timeout: cannot connect to %s', m.ip)
+            m.status = 'Error'
+        except OSError as msg:
+            m.logger.error('[MuvBox Error]: cannot connect to %s - Message: %s', m.ip, msg)
+            m.status = 'Error'
+        except Exception as msg:    # e.g. setup of a firmware not supported: not raised in the caller thread
+            m.logger.exception('[MuvBox Error]: cannot set up %s - Message: %s', m.ip, msg)
+            m.status = 'Error'
+        if m.status == 'Error':
+            m.sock.close()
+            if m.retry_uncached():
+                await self.do_connect(m)
+
+    async def command__system_info(self, m):
+        data = None
+        try:
+            m.logger.info('Start command__system_info')
+            await asyncio.wait_for(self.loop.sock_sendall(m.sock, m.message__system_info()), m.TIMEOUT)
+            data = await asyncio.wait_for(self.loop.sock_recv(m.sock, 1024), m.TIMEOUT)
+            m.parse_system_info(data)
+            m.logger.info('command__system_info successful')
+        except Exception:
+            m.logger.debug('system_info reply: %s', data)
+            m.logger.error('Error command system_info')
+
+    async def do_start(self, m):
+        if m.state != 2:
+            return
+        m.stop_reading = False
+        m.logger.info('Start start_reading')
+        try:
+            m.logger.info('Start command__start_sensor')
+            await asyncio.wait_for(self.loop.sock_sendall(m.sock, m.message__start_sensor()), m.TIMEOUT)
+            m.logger.info('start_sensor command successful')
+            m.convert_scale()
+            m.clear()  # clear data
+            m.framer.reset()  # discard bytes left from the previous session
+            m.reset_stats()
+            m.open_journal()
+            m.open_recorder()
+            m.ajustar_rtc0 = True
+            m.state = 3
+            self.tasks[m] = self.loop.create_task(self._stream(m))
+            m.status = 'Running'
+        except (asyncio.TimeoutError, OSError):
+            m.logger.error('Error starting - %s', m.ip)
+            m.state = 2
+
+    async def _stream(self, m):
+        # State 4: receive, decode in batches and process
+        m.state = 4
+        batch = m.WINDOWS_SIZE*max(1, min(self.BATCH_WINDOWS, m.RX_WINDOWS//2))  # recv buffer never full
+        t_decode = time.perf_counter()
+        try:
+            while not m.stop_reading:
+                try:
+                    n = await asyncio.wait_for(self.loop.sock_recv_into(m.sock, m.framer.free()), m.TIMEOUT)
+                    if n == 0:
+                        raise ConnectionResetError('Connection closed by MuvBox')
+                except (asyncio.TimeoutError, OSError) as msg:
+                    if not m.AUTO_RECONNECT or m.stop_reading:
+                        raise
+                    m.logger.error('[MuvBox Error]: connection lost - Message: %s', msg)
+                    if not await self._reconnect(m):
+                        raise
+                    continue
+                m.framer.commit(n)
+                m.bytes_received += n
+                m._t_recv = time.perf_counter()
+                if m.framer.length >= batch or (m.framer.length >= m.WINDOWS_SIZE and
+                                                m._t_recv - t_decode >= self.BATCH_LATENCY):
+                    m.decode_values()
+                    m.process_values()
+                    t_decode = m._t_recv
+        except asyncio.TimeoutError:
+            m.logger.error('[MuvBox Error] Timeout: cannot connect to %s', m.ip)
+            m.status = 'Error'
+        except OSError as msg:
+            m.logger.error('[MuvBox Error]: cannot connect to %s - Message: %s', m.ip, msg)
+            m.status = 'Error'
+
+    async def _reconnect(self, m):
+        # Same as MuvBox.reconnect, on the event loop (the other MuvBoxes keep streaming)
+        m.status = 'Reconnecting'
+        m.begin_outage()
+        delay = m.RECONNECT_MIN
+        attempt = 0
+        while not m.stop_reading and (m.RECONNECT_ATTEMPTS == 0 or attempt < m.RECONNECT_ATTEMPTS):
+            attempt += 1
+            m.logger.warning('Reconnecting to %s (attempt %s)', m.ip, attempt)
+            try:
+                m.sock.close()
+                if attempt > 1 and await self.loop.run_in_executor(None, m.resolve):  # IP may have changed
+                    m._dest = (m.ip, m.port)
+                m.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # TCP
+                m.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, m.RCVBUF_SIZE)
+                m.sock.setblocking(False)
+                await asyncio.wait_for(self.loop.sock_connect(m.sock, m._dest), m.TIMEOUT)
+                await self.command__system_info(m)
+                await asyncio.wait_for(self.loop.sock_sendall(m.sock, m.message__start_sensor()), m.TIMEOUT)
+                m.framer.discard()
+                m.reconnections += 1
+                m.status = 'Running'
+                m.logger.info('Reconnected to %s', m.ip)
+                return True
+            except (asyncio.TimeoutError, OSError) as msg:
+                m.logger.warning('Reconnection failed - Message: %s', msg)
+            await asyncio.sleep(delay)
+            delay = min(2*delay, m.RECONNECT_MAX)
+        return False
+
+    async def _cancel(self, m):
+        task = self.tasks.pop(m, None)
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def do_stop(self, m):
+        if m.state == 4 or m.state == 3:
+            m.status = 'Stopping'
+            m.stop_reading = True
+            await self._cancel(m)
+            m.decode_values()   # packets already received
+            m.process_values()
+            m.state = 5
+            m.logger.info('Start stop_reading')
+            m.status = 'Online'
+            try:
+                m.logger.info('Start command__stop_transmission')
+                await asyncio.wait_for(self.loop.sock_sendall(m.sock, m.message__stop_transmission()), m.TIMEOUT)
+                m.logger.info('Stop_transmission command successful')
+            except (asyncio.TimeoutError, OSError) as msg:
+                m.logger.error('[MuvBox Error]: cannot send stop_transmission - Message: %s', msg)
+            await self.loop.run_in_executor(None, m.close_journal)  # waits for the writer thread
+            await self.loop.run_in_executor(None, m.close_recorder)
+            m.logger.info('End stop_reading')
+            m.sensors.finalize()
+            m.Q.finalize()
+            m.angles.finalize()
+            m.state = 2  # Retorna ao estado 2
+
+    async def do_disconnect(self, m):
+        await self._cancel(m)
+        if m.sock is not None:
+            m.sock.close()
+        m.close_ahrs_worker()
+        await self.loop.run_in_executor(None, m.close_journal)
+        await self.loop.run_in_executor(None, m.close_recorder)
+        m.status = 'Offline'
+        m.acq_rate = 0
+        m.stop_reading = False
+        m.ajustar_rtc0 = False
+        m.logger.info('Connection closed %s', m.ip)
+        m.state = 0
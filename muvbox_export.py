@@ -0,0 +1,470 @@
+"""
+    ** MuvBox export formats **
+
+    Writers used by SaveRoutine (MuvBox_SaveJob) to save the data of a MuvBox, one file per MuvBox:
+     - csv: text 'time;acc_x;acc_y;acc_z;gyr_x;gyr_y;gyr_z' with time - rtc0 (the original format), and
+       mag_x;mag_y;mag_z for firmware versions with magnetometer
+     - npz: numpy zip (compressed) with the arrays sensors, Q, angles and metadata (json text)
+     - hdf5: datasets sensors, Q and angles (gzip) and the metadata as file attributes (needs h5py)
+     - parquet: sensors table in file.parquet and orientation table (time, Q and angles) in
+       file_orientation.parquet, with the metadata (json) in the schema (needs pyarrow)
+
+    Binary formats have all channels of the MuvBox (including battery and magnetometer), the time in
+    seconds as in M.sensors (subtract metadata rtc0 to get the time of the csv files) and the metadata
+    of the MuvBox: name, location, mac, firmware, scales, rtc0, columns, outages, ...
+    The vectors are written CHUNK_LINES lines at a time from the snapshot of the job, so a session is
+    never copied in memory (also with COMPACT and MAPPED vectors).
+
+    Example:
+
+    SaveRoutine().start(M, 'test', 0, 1e9, format='hdf5')
+
+    Reading:
+
+    d = np.load(file)                               # npz
+    sensors = d['sensors']
+    metadata = json.loads(str(d['metadata']))
+
+    with h5py.File(file, 'r') as f:                 # hdf5
+        sensors = f['sensors'][:]
+        rtc0 = f.attrs['rtc0']
+
+    sensors = pandas.read_parquet(file)             # parquet
+
+    New formats are added with register_exporter(name, exporter class). An exporter has the attribute
+    EXTENSION and the method write(job), which creates the files listed in job.files, writes the
+    vectors of the job in chunks (job.chunks) and reports the lines written (job.report).
+    Exporters derived from MuvBox_StreamExporter (csv, hdf5 and parquet) write the lines incrementally
+    with begin(), append() and end(), so they can also be used for continuous recording.
+
+    ** Continuous recording **
+
+    MuvBox_Recorder saves the data of a MuvBox to rolling files while acquiring (M.RECORD). Every
+    RECORD_INTERVAL seconds the lines appended since the last write (sensors.count) are copied and
+    written by a background thread. A new file is started when RECORD_ROTATE_SIZE bytes or
+    RECORD_ROTATE_TIME seconds of data are reached, and when rtc0 changes. While recording only the
+    last RECORD_HISTORY seconds are kept in memory (unless M.HISTORY is set). Example:
+
+    M.RECORD = True
+    M.RECORD_FORMAT = 'hdf5'
+    M.RECORD_ROTATE_TIME = 600      # Files with 10 minutes of data: date_name_0001.h5, date_name_0002.h5, ...
+    M.start()
+    M.stop()                        # Lines not yet written are saved and the last file is closed
+    print(M.recorder_files)
+
+    ** Reading csv files **
+
+    read_csv parses a csv saved by SaveRoutine (or the recorder) with the pandas C parser (values are
+    exact) and keeps the result in a cache next to the file (file.csv.cache.npy and file.csv.cache.json).
+    The cache is used while the size and modification time of the csv do not change, and is read as a
+    memory map, so opening a session again takes milliseconds. load_csv returns an offline MuvBox:
+
+    from muvbox_export import load_csv
+    M = load_csv('./data/2021-10-07_10-59-13.956400_teste_MUVBOX_5051.csv')
+    time = M.sensors.data[:,0]      # time - rtc0, in s
+    accx = M.sensors.data[:,1]      # Same columns as a MuvBox for files saved by SaveRoutine (no bat)
+"""
+import os
+import json
+import time
+import queue
+import datetime
+import zipfile
+from threading import Thread
+
+import numpy as np
+import pandas as pd
+
+from muvbox_journal import journal_header
+
+
+Q_COLUMNS = ['time', 'a', 'b', 'c', 'd']                # Quaternion = a + b*i + c*j + d*k
+ANGLES_COLUMNS = ['time', 'yaw', 'pitch', 'roll']       # degrees
+
+
+def export_metadata(m, comment=''):
+    # Metadata of MuvBox m saved with the binary formats (json compatible)
+    metadata = journal_header(m)
+    channels = m.firmware.channels if m.firmware is not None else []
+    metadata.update({'comment': comment,
+                     'columns': {'sensors': channels, 'Q': Q_COLUMNS, 'angles': ANGLES_COLUMNS},
+                     'outages': [list(o) for o in m.outages]})
+    return metadata
+
+
+class MuvBox_StreamExporter:
+    # Exporter writing the lines incrementally: begin(source, file), append(source, blocks) any number
+    # of times and end(). blocks: {'sensors': lines, 'Q': lines, 'angles': lines} (missing: no lines),
+    # Q and angles with the same lines. source (MuvBox_SaveJob or MuvBox_Recorder) gives name, location,
+    # comment, rtc0, metadata, cols, files, chunk_lines and buffer_size.
+
+    VECTORS = ('sensors', 'Q', 'angles')    # Vectors written by the format
+
+    def write(self, job):
+        sensors = job.vectors['sensors']
+        n = min(len(job.vectors['Q']), len(job.vectors['angles'])) if 'Q' in self.VECTORS else 0
+        total = len(sensors) + n
+        self.begin(job, job.file)
+        try:
+            for i, block in job.chunks(sensors):
+                self.append(job, {'sensors': block})
+                job.report(len(block), total)
+            for i, block in job.chunks(job.vectors['Q'][:n]):
+                self.append(job, {'Q': block, 'angles': np.asarray(job.vectors['angles'][i:i+len(block)])})
+                job.report(len(block), total)
+        finally:
+            self.end()
+
+
+class MuvBox_CSVExporter(MuvBox_StreamExporter):
+    # Text file, six IMU columns and the magnetometer columns when the MuvBox has one (without
+    # magnetometer, byte-compatible with the files of the previous versions)
+
+    EXTENSION = '.csv'
+    VECTORS = ('sensors',)
+
+    @staticmethod
+    def columns(source):
+        # Columns of sensors written after the time: acc and gyr, then magx, magy, magz if present
+        channels = source.metadata['columns']['sensors']
+        mag = [channels.index(c) for c in ['magx', 'magy', 'magz'] if c in channels]
+        return list(range(1, 7)) + mag
+
+    def header(self, job):
+        s = job.name + ";" + job.location + ";" + job.comment
+        s += "\n"
+        s += "time"
+        axis = ["x", "y", "z"]
+        types = ["acc_", "gyr_"]
+        if len(self.columns(job)) > 6:
+            types.append("mag_")
+        for i in types:
+            for j in axis:
+                s += ";{}{}".format(i, j)
+        s += "\n"
+        return s
+
+    def begin(self, source, file):
+        source.files.append(file)
+        self.cols = self.columns(source)
+        self.line = "%r" + ";%r"*len(self.cols) + "\n"
+        self.f = open(file, "w", buffering=source.buffer_size)
+        self.f.write(self.header(source))
+
+    def append(self, source, blocks):
+        # Lines 'time;acc_x;acc_y;acc_z;gyr_x;gyr_y;gyr_z[;mag_x;mag_y;mag_z]' (time - rtc0)
+        # %r gives the same text as str() of the values (shortest repr)
+        data = blocks.get('sensors')
+        if data is not None and len(data) > 0:
+            block = np.empty((len(data), 1 + len(self.cols)))
+            block[:, 0] = data[:, 0] - source.rtc0
+            block[:, 1:] = data[:, self.cols]
+            self.f.write((self.line*len(data)) % tuple(block.ravel().tolist()))
+
+    def end(self):
+        self.f.close()
+
+
+class MuvBox_NPZExporter:
+    # numpy zip (as np.savez_compressed), each array written in chunks
+
+    EXTENSION = '.npz'
+
+    def write(self, job):
+        total = sum(len(v) for v in job.vectors.values())
+        job.files.append(job.file)
+        with zipfile.ZipFile(job.file, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as z:
+            with z.open('metadata.npy', 'w') as f:
+                np.lib.format.write_array(f, np.array(json.dumps(job.metadata)))
+            for name, vector in job.vectors.items():
+                with z.open(name + '.npy', 'w', force_zip64=True) as f:
+                    np.lib.format.write_array_header_1_0(f, {'descr': '<f8', 'fortran_order': False,
+                                                             'shape': (len(vector), job.cols[name])})
+                    for i, block in job.chunks(vector):
+                        f.write(np.ascontiguousarray(block, dtype='<f8').tobytes())
+                        job.report(len(block), total)
+
+
+class MuvBox_HDF5Exporter(MuvBox_StreamExporter):
+    # HDF5 file: one extendable dataset per vector (gzip, chunks of chunk_lines lines), metadata as attributes
+
+    EXTENSION = '.h5'
+
+    def begin(self, source, file):
+        import h5py
+        source.files.append(file)
+        self.f = h5py.File(file, 'w')
+        for key, value in source.metadata.items():
+            self.f.attrs[key] = value if isinstance(value, (int, float, str)) else json.dumps(value)
+        for name in self.VECTORS:
+            cols = source.cols[name]
+            d = self.f.create_dataset(name, shape=(0, cols), maxshape=(None, cols), dtype='f8',
+                                      compression='gzip', chunks=(source.chunk_lines, cols))
+            d.attrs['columns'] = source.metadata['columns'][name]
+
+    def append(self, source, blocks):
+        for name, block in blocks.items():
+            if len(block) > 0:
+                d = self.f[name]
+                n = len(d)
+                d.resize(n + len(block), axis=0)
+                d[n:] = block
+
+    def end(self):
+        self.f.close()
+
+
+class MuvBox_ParquetExporter(MuvBox_StreamExporter):
+    # Parquet files (one row group per append): sensors in file and orientation (Q and angles side by
+    # side) in file_orientation, created only if there are orientation lines
+
+    EXTENSION = '.parquet'
+
+    def begin(self, source, file):
+        self.file = file
+        self.files = source.files
+        self.metadata = {b'muvbox': json.dumps(source.metadata).encode()}
+        self.sensors = self.writer(file, source.metadata['columns']['sensors'])
+        self.orientation = None
+
+    def writer(self, file, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.files.append(file)
+        return pq.ParquetWriter(file, pa.schema([(c, pa.float64()) for c in columns], metadata=self.metadata))
+
+    def append(self, source, blocks):
+        if 'sensors' in blocks and len(blocks['sensors']) > 0:
+            self.write_table(self.sensors, blocks['sensors'])
+        if 'Q' in blocks and len(blocks['Q']) > 0:
+            if self.orientation is None:
+                self.orientation = self.writer(self.file[:-len(self.EXTENSION)] + '_orientation' + self.EXTENSION,
+                                               Q_COLUMNS + ANGLES_COLUMNS[1:])
+            self.write_table(self.orientation, np.column_stack((blocks['Q'], blocks['angles'][:, 1:])))
+
+    @staticmethod
+    def write_table(writer, block):
+        import pyarrow as pa
+        writer.write_table(pa.Table.from_arrays([pa.array(block[:, k]) for k in range(block.shape[1])],
+                                                schema=writer.schema))
+
+    def end(self):
+        self.sensors.close()
+        if self.orientation is not None:
+            self.orientation.close()
+
+
+EXPORTERS = {'csv': MuvBox_CSVExporter,
+             'npz': MuvBox_NPZExporter,
+             'hdf5': MuvBox_HDF5Exporter,
+             'parquet': MuvBox_ParquetExporter}
+
+
+def register_exporter(name, exporter):
+    # Add (or replace) an export format of SaveRoutine
+    EXPORTERS[name] = exporter
+    return exporter
+
+
+class MuvBox_Recorder:
+    # Continuous recording of MuvBox m to rolling files (MuvBox.RECORD), in a stream format of EXPORTERS.
+    # update() is called by the reading thread after each read: every 'interval' seconds the new lines
+    # (sensors.count since the last update) are copied and put in a queue. Files are written by a
+    # background thread, so only the lines not yet written are kept by the recorder.
+
+    BUFFER_SIZE = 2**20     # File buffer, in bytes (csv)
+    CHUNK_LINES = 2**13     # Lines per HDF5 chunk
+
+    def __init__(self, m, path, format='csv', rotate_size=0, rotate_time=0, interval=1.0, comment=''):
+        exporter = EXPORTERS.get(format)
+        if exporter is None or not issubclass(exporter, MuvBox_StreamExporter):
+            raise ValueError('Format ' + str(format) + ' cannot be recorded')
+        self.m = m
+        self.exporter = exporter
+        self.name = m.name
+        self.location = m.location
+        self.comment = comment
+        self.rtc0 = m.rtc0
+        self.metadata = export_metadata(m, comment)
+        self.cols = {'sensors': m.sensors.cols, 'Q': 5, 'angles': 4}
+        self.chunk_lines = self.CHUNK_LINES
+        self.buffer_size = self.BUFFER_SIZE
+        date = str(datetime.datetime.now()).replace(" ", "_").replace(":","-")
+        self.base = os.path.join(path, date + "_" + m.name)   # Files base_0001.ext, base_0002.ext, ...
+        self.rotate_size = rotate_size  # New file after about rotate_size bytes (0: no limit)
+        self.rotate_time = rotate_time  # New file after rotate_time seconds of data (0: no limit)
+        self.interval = interval
+        self.log = m.logger.error
+
+        self.files = []         # Files created
+        self.lines = 0          # Sensors lines written
+        self.lines_lost = 0     # Lines discarded by the ring buffer before being copied
+        self.error = None       # Exception raised by the writer thread, if any (recording stops)
+        self._synced = False    # rtc0 of the session already set (lines are being recorded)
+        self._saved = {'sensors': 0, 'orientation': 0}  # count of the vectors already copied
+        self._t_update = time.monotonic()
+        self._queue = queue.Queue()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def update(self, force=False):
+        # Copy the lines appended since the last update (reading thread). force: do not wait for interval
+        now = time.monotonic()
+        if self.error is not None or (not force and now - self._t_update < self.interval):
+            return
+        self._t_update = now
+        m = self.m
+        if m.sensors.count < self._saved['sensors'] or min(m.Q.count, m.angles.count) < self._saved['orientation']:
+            self._saved = {'sensors': 0, 'orientation': 0}  # Vectors cleared
+        # Q and angles: lines present in both
+        first, last = self._saved['sensors'], m.sensors.count
+        blocks = {'sensors': self._lines(m.sensors, first, last)}
+        if len(blocks['sensors']) < last - first:
+            self.lines_lost += last - first - len(blocks['sensors'])
+            m.logger.warning('Recording: %s lines lost (memory history shorter than RECORD_INTERVAL)',
+                             last - first - len(blocks['sensors']))
+        self._saved['sensors'] = last
+        first, last = self._saved['orientation'], min(m.Q.count, m.angles.count)
+        Q = self._lines(m.Q, first, last)
+        angles = self._lines(m.angles, first, last)
+        n = min(len(Q), len(angles))
+        if n > 0:
+            blocks['Q'] = Q[len(Q)-n:]
+            blocks['angles'] = angles[len(angles)-n:]
+        self._saved['orientation'] = last
+        if len(blocks['sensors']) > 0 or n > 0:
+            self._queue.put(('blocks', blocks))
+
+    @staticmethod
+    def _lines(df, first, last):
+        # Copy of the lines first to last (numbered as df.count) still in df (a ring buffer discards old lines)
+        after = df.count - last
+        n = max(min(last - first, df.size - after), 0)
+        return np.array(df.latest(n + after)[:n], dtype=float)
+
+    def sync(self):
+        # rtc0 changed (vectors will be cleared): the lines not yet copied are queued for the current
+        # file, the next lines go to a new file. self.rtc0 is changed by the writer thread.
+        if self._synced:
+            self.update(force=True)
+        self._synced = True
+        self._saved = {'sensors': 0, 'orientation': 0}
+        self._queue.put(('metadata', export_metadata(self.m, self.comment)))
+
+    def close(self):
+        # Write the lines already copied, close the last file and wait for the writer thread
+        self._queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            self.log('[MuvBox Recorder] Error writing ' + self.base + ' - Message: ' + str(self.error))
+
+    def _run(self):
+        writer = None
+        part = 0
+        first = 0.0     # Time of the first line of the current file
+        rtc0 = self.rtc0
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                kind, value = item
+                if kind == 'metadata':
+                    if writer is not None:
+                        writer.end()
+                        writer = None
+                    self.metadata = value
+                    rtc0 = value['rtc0']
+                    continue
+                sensors = value['sensors']
+                if writer is None:
+                    part += 1
+                    start = len(self.files)
+                    self.rtc0 = rtc0
+                    new = self.exporter()
+                    new.begin(self, self.base + "_%04d" % part + new.EXTENSION)
+                    writer = new    # Only a file that was opened is closed
+                    first = sensors[0, 0] if len(sensors) > 0 else value['Q'][0, 0]
+                writer.append(self, value)
+                self.lines += len(sensors)
+                last = sensors[-1, 0] if len(sensors) > 0 else first
+                if ((self.rotate_time > 0 and last - first >= self.rotate_time) or
+                        (self.rotate_size > 0 and sum(os.path.getsize(f) for f in self.files[start:]) >= self.rotate_size)):
+                    writer.end()
+                    writer = None
+        except Exception as msg:    # OSError (e.g. disk full), ImportError or unexpected: recording stops
+            self.error = msg
+        finally:
+            try:
+                if writer is not None:
+                    writer.end()
+            except Exception as msg:
+                self.error = self.error or msg
+
+
+CACHE_VERSION = 1   # Changed when the cache layout changes (older caches are rebuilt)
+
+
+def parse_csv(path):
+    # Return (header, data) of a csv saved by SaveRoutine: first line name;location;comment, second line
+    # the columns, then the values. header: name, location, comment, columns. data: float array (lines x columns)
+    with open(path, 'r', encoding='latin-1') as f:
+        first = f.readline().rstrip('\r\n').split(';')
+        columns = f.readline().rstrip('\r\n').split(';')
+        try:
+            data = pd.read_csv(f, sep=';', header=None, usecols=range(len(columns)), dtype=float,
+                               float_precision='round_trip').to_numpy()
+        except pd.errors.EmptyDataError:
+            data = np.empty((0, len(columns)))
+        except ValueError:
+            # Text in the values (file edited in a spreadsheet): values that are not numbers are NaN
+            f.seek(0)
+            data = pd.read_csv(f, sep=';', header=None, skiprows=2, usecols=range(len(columns)), dtype=str)
+            data = data.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+    header = {'name': first[0],
+              'location': first[1] if len(first) > 1 else '',
+              'comment': ';'.join(first[2:]).rstrip(';'),
+              'columns': columns}
+    return header, np.ascontiguousarray(data)
+
+
+def read_csv(path, cache=True):
+    # As parse_csv, using the cache file.csv.cache.npy (data, read-only memory map) if it is valid
+    # for the size and modification time of the csv. Otherwise the csv is parsed and the cache written.
+    # cache=False: always parse, no cache. The cache is not written if the directory is read-only.
+    stat = os.stat(path)
+    key = {'version': CACHE_VERSION, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if cache:
+        try:
+            with open(path + '.cache.json') as f:
+                info = json.load(f)
+            if all(info.get(k) == v for k, v in key.items()):
+                data = np.load(path + '.cache.npy', mmap_mode='r')
+                if list(data.shape) == info['shape']:
+                    return info['header'], data
+        except (OSError, ValueError, KeyError):
+            pass    # No cache, old or incomplete cache: parse
+    header, data = parse_csv(path)
+    if cache:
+        try:
+            # Data first, then the json (a cache is valid only when both are complete)
+            with open(path + '.cache.npy.tmp', 'wb') as f:
+                np.save(f, data)
+            os.replace(path + '.cache.npy.tmp', path + '.cache.npy')
+            with open(path + '.cache.json.tmp', 'w') as f:
+                json.dump(dict(key, shape=list(data.shape), header=header), f)
+            os.replace(path + '.cache.json.tmp', path + '.cache.json')
+        except OSError:
+            pass
+    return header, data
+
+
+def load_csv(path, cache=True):
+    # Offline MuvBox (not connected) with the data of a csv in sensors (columns of the file, see read_csv)
+    from muvbox import MuvBox, MuvBox_DataFrame
+    header, data = read_csv(path, cache)
+    m = MuvBox()
+    m.name = header['name']
+    m.location = header['location']
+    m.sensors = MuvBox_DataFrame.from_array(data)
+    return m
@@ -0,0 +1,200 @@
+"""
+    ** MuvBox packet journal **
+
+    Records every valid packet received from a MuvBox to a binary file while acquiring, so long
+    sessions are kept on disk (and survive a crash of the application) without waiting for a
+    manual save.
+
+    File layout:
+     - Header with HEADER_SIZE bytes: MAGIC followed by a json text (firmware version, scales,
+       rtc0, name, location, mac, packet layout, ...) padded with spaces.
+     - Packets as received from MuvBox (fixed size records, e.g. 24 bytes for firmware version 0).
+
+    Writing is done by a background thread with large buffered writes. The header is rewritten
+    when rtc0 changes and when the journal is closed. If the application crashes, the number of
+    packets is given by the file size (an incomplete last record is ignored).
+
+    Recording is enabled by the MuvBox flag 'JOURNAL'. Example:
+
+    from muvbox import *
+    M = MuvBox()
+    M.name = 'MuvBox14'
+    M.JOURNAL = True          # Files are created in M.JOURNAL_PATH
+    M.connect()
+    M.start()
+    M.stop()
+    M.disconnect()
+
+    Reading a journal (memory-mapped, decoded in chunks):
+
+    from muvbox_journal import load_journal
+    M = load_journal('./data/2021-10-07_10-59-13.956400_MUVBOX_5051.muvj')
+    time = M.sensors.data[:,0]
+"""
+import os
+import json
+import queue
+import datetime
+import logging
+from threading import Thread
+
+import numpy as np
+
+
+logger = logging.getLogger('muvbox')  # Driver messages (see muvbox.py)
+
+MAGIC = b'MUVBOXJ1'
+HEADER_SIZE = 4096
+
+
+def journal_header(m):
+    # Metadata needed to decode the packets of MuvBox m
+    return {'name': m.name,
+            'location': m.location,
+            'mac': m.mac,
+            'muvbox_number': m.muvbox_number,
+            'firmware_version_full': m.firmware_version_full,
+            'firmware_version': m.firmware_version,
+            'driver_version': m.PC_DRIVER_VERSION,
+            'ACQ_FREQ': m.ACQ_FREQ,
+            'ACCSCALE': m.ACCSCALE,
+            'GYROSCALE': m.GYROSCALE,
+            'TO_G': m.TO_G,
+            'TO_DPS': m.TO_DPS,
+            'TIMESCALE': m.TIMESCALE,
+            'BAT_VMAX': m.BAT_VMAX,
+            'BAT_VMIN': m.BAT_VMIN,
+            'rtc0': m.rtc0,
+            'packet': np.lib.format.dtype_to_descr(m.framer.dtype),
+            'channels': m.firmware.channels if m.firmware is not None else [],
+            'created': str(datetime.datetime.now())}
+
+
+class MuvBox_Journal:
+    # Append-only packet file written by a background thread.
+    # write() only puts the packets in a queue, so it costs almost nothing in the reading thread.
+
+    BUFFER_SIZE = 2**20     # File buffer, in bytes
+    FLUSH_INTERVAL = 1.0    # Maximum time (s) packets stay in the file buffer
+
+    def __init__(self, path, header, log=logger.error):
+        self.path = path
+        self.header = dict(header)
+        self.header['packets'] = 0
+        self.header['closed'] = False
+        self.log = log
+        self.packets = 0        # Number of packets written
+        self.error = None       # Exception raised by the writer thread, if any
+        self._queue = queue.Queue()
+        self._file = open(path, 'wb', buffering=self.BUFFER_SIZE)
+        self._write_header()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def create(cls, m, directory):
+        # New journal for MuvBox m, named as the csv files (date_name.muvj)
+        date = str(datetime.datetime.now()).replace(" ", "_").replace(":","-")
+        path = os.path.join(directory, date + "_" + m.name + ".muvj")
+        return cls(path, journal_header(m), m.logger.error)
+
+    def write(self, packets):
+        # packets: array of packets (not changed after this call). Ignored after a writer error.
+        if len(packets) > 0 and self.error is None:
+            self._queue.put(packets)
+
+    def update(self, **fields):
+        # Change header fields (e.g. rtc0). The header is rewritten by the writer thread.
+        if self.error is None:
+            self._queue.put(dict(fields))
+
+    def close(self):
+        # Write pending packets, the final header and close the file
+        self._queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            self.log('[MuvBox Journal] Error writing ' + self.path + ' - Message: ' + str(self.error))
+
+    def _run(self):
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=self.FLUSH_INTERVAL)
+                except queue.Empty:
+                    self._file.flush()  # At most FLUSH_INTERVAL seconds are lost in a crash
+                    continue
+                if item is None:
+                    break
+                if isinstance(item, dict):
+                    self._update_header(item)
+                else:
+                    self._file.write(item.data)
+                    self.packets += len(item)
+            self._update_header({'packets': self.packets, 'closed': True})
+        except Exception as msg:    # OSError (e.g. disk full) or unexpected: recording stops
+            self.error = msg
+        finally:
+            try:
+                self._file.close()
+            except OSError as msg:  # Buffered packets not written
+                self.error = self.error or msg
+
+    def _update_header(self, fields):
+        # Rewrite the header with fields. If it does not fit in HEADER_SIZE, the last header is kept
+        # (packets are still recorded; their number is given by the file size).
+        previous = dict(self.header)
+        self.header.update(fields)
+        try:
+            self._write_header()
+        except ValueError as msg:
+            self.header = previous
+            self.log('[MuvBox Journal] Header of ' + self.path + ' not updated - Message: ' + str(msg))
+
+    def _write_header(self):
+        # Header is rewritten in place; packets continue at the end of the file
+        text = json.dumps(self.header).encode()
+        if len(MAGIC) + len(text) + 1 > HEADER_SIZE:
+            raise ValueError('Journal header too long')
+        pos = self._file.tell()
+        self._file.seek(0)
+        self._file.write(MAGIC + text.ljust(HEADER_SIZE - len(MAGIC) - 1) + b'\n')
+        self._file.seek(max(pos, HEADER_SIZE))
+
+
+def read_journal(path):
+    # Return (header, packets). packets is a read-only memory map of the records.
+    with open(path, 'rb') as f:
+        head = f.read(HEADER_SIZE)
+    if head[:len(MAGIC)] != MAGIC or len(head) < HEADER_SIZE:
+        raise ValueError(path + ' is not a MuvBox journal')
+    header = json.loads(head[len(MAGIC):].decode())
+    dtype = np.lib.format.descr_to_dtype(header['packet'])
+    n = (os.path.getsize(path) - HEADER_SIZE)//dtype.itemsize  # Complete records only (crash safe)
+    if n == 0:
+        return header, np.empty(0, dtype=dtype)
+    return header, np.memmap(path, dtype=dtype, mode='r', offset=HEADER_SIZE, shape=(n,))
+
+
+def load_journal(path, chunk=2**16, compact=False):
+    # Decode a journal into an offline MuvBox (sensors.data filled, not connected)
+    # compact: keep the raw counts (MuvBox.COMPACT)
+    from muvbox import MuvBox
+    header, packets = read_journal(path)
+    m = MuvBox(header['muvbox_number'], version=header['firmware_version_full'])
+    for key in ['name', 'location', 'mac', 'ACQ_FREQ', 'ACCSCALE', 'GYROSCALE', 'TO_G', 'TO_DPS',
+                'TIMESCALE', 'BAT_VMAX', 'BAT_VMIN', 'rtc0']:
+        setattr(m, key, header[key])
+    m.COMPACT = compact
+    m.compile_decoder()  # Scales of the header
+    m.clear()
+    m.sensors.reserve(len(packets))
+    # rtc_offset changes (MuvBox rtc restarted after a reconnection) split the packets in segments
+    offsets = [(0, 0.0)] + [tuple(o) for o in header.get('rtc_offsets', [])] + [(len(packets), 0.0)]
+    for (first, offset), (last, _) in zip(offsets[:-1], offsets[1:]):
+        m.rtc_offset = offset
+        for i in range(first, last, chunk):
+            block = packets[i:min(i+chunk, last)]
+            valid = (block['start'] == 0) & (block['end'] == 255)
+            m.appendPackets(block[valid])
+    m.sensors.finalize()
+    return m
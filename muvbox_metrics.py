@@ -0,0 +1,96 @@
+"""
+    ** MuvBox metrics **
+
+    Exposes the acquisition metrics of MuvBoxes (MuvBox.stats()) in the Prometheus text format, so
+    recording stations can be monitored without the GUI.
+
+    Metrics are read from the MuvBoxes only when the endpoint is scraped (no cost on the acquisition
+    path). Each metric has the labels 'muvbox' (hostname) and 'number' (MuvBox number in the application).
+
+    prometheus_client is only needed when the endpoint is started. Example:
+
+    from muvbox_metrics import start_metrics_server
+    start_metrics_server(M, port=9100)   # M: list of MuvBoxes (may change later)
+
+    curl http://127.0.0.1:9100/metrics
+"""
+import numpy as np
+
+from muvbox import MuvBox_TimeHealth
+
+
+# stats() key: (metric name, type, help)
+METRICS = {
+    'bytes_received': ('muvbox_received_bytes', 'counter', 'Bytes received from MuvBox in the current session'),
+    'windows_received': ('muvbox_received_windows', 'counter', 'Windows received from MuvBox in the current session'),
+    'packets_decoded': ('muvbox_decoded_packets', 'counter', 'Valid packets decoded in the current session'),
+    'packets_dropped': ('muvbox_dropped_packets', 'counter', 'Packets dropped by the framer (estimated)'),
+    'bytes_discarded': ('muvbox_discarded_bytes', 'counter', 'Bytes discarded by the framer'),
+    'resync_events': ('muvbox_resync_events', 'counter', 'Number of times packet synchronization was lost'),
+    'time_outliers': ('muvbox_time_outliers', 'counter', 'Packets dropped by the framer for a corrupted timestamp'),
+    'gaps': ('muvbox_gaps', 'counter', 'Intervals without samples, detected from the rtc'),
+    'missing_samples': ('muvbox_missing_samples', 'counter', 'Samples missing in gaps'),
+    'rtc_resets': ('muvbox_rtc_resets', 'counter', 'Number of times the MuvBox rtc went back'),
+    'nonmonotonic_samples': ('muvbox_nonmonotonic_samples', 'counter', 'Samples with time not greater than the previous one'),
+    'reconnections': ('muvbox_reconnections', 'counter', 'Automatic reconnections in the current session'),
+    'acq_rate': ('muvbox_acquisition_rate', 'gauge', 'Acquisition rate (samples/s)'),
+    'append_latency': ('muvbox_append_latency_seconds', 'gauge', 'Time from the last recv to the end of append (s)'),
+    'append_latency_max': ('muvbox_append_latency_max_seconds', 'gauge', 'Maximum append latency in the current session (s)'),
+    'ahrs_lag': ('muvbox_ahrs_lag_seconds', 'gauge', 'Delay of the orientation filter (s)'),
+    'buffer_size': ('muvbox_buffer_samples', 'gauge', 'Samples in the sensors buffer'),
+    'buffer_fill': ('muvbox_buffer_fill_ratio', 'gauge', 'Sensors buffer size / capacity'),
+    'buffer_bytes': ('muvbox_buffer_bytes', 'gauge', 'Memory allocated for the sensors buffer (bytes)'),
+    'battery': ('muvbox_battery_percent', 'gauge', 'Last battery level (%)'),
+    'battery_trend': ('muvbox_battery_trend_percent_per_hour', 'gauge', 'Battery variation (%/h)'),
+    'state': ('muvbox_state', 'gauge', 'State of the MuvBox state machine'),
+}
+
+
+class MuvBox_Collector:
+    # Prometheus collector (prometheus_client custom collector) reading MuvBox.stats() at each scrape
+
+    def __init__(self, M):
+        self.M = M      # List of MuvBoxes, or a function returning it
+
+    def muvboxes(self):
+        return self.M() if callable(self.M) else list(self.M)
+
+    def collect(self):
+        from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+        stats = [m.stats() for m in self.muvboxes()]
+        labels = ['muvbox', 'number']
+        for key, (name, kind, documentation) in METRICS.items():
+            if kind == 'counter':
+                family = CounterMetricFamily(name, documentation, labels=labels)
+            else:
+                family = GaugeMetricFamily(name, documentation, labels=labels)
+            for s in stats:
+                family.add_metric([s['name'], str(s['muvbox_number'])], s[key])
+            yield family
+        jitter = HistogramMetricFamily('muvbox_jitter_seconds', '|dt - nominal period| of consecutive samples', labels=labels)
+        edges = [str(e/1e6) for e in MuvBox_TimeHealth.JITTER_EDGES] + ['+Inf']
+        for s in stats:
+            buckets = list(zip(edges, np.cumsum(s['jitter_histogram']).tolist()))
+            jitter.add_metric([s['name'], str(s['muvbox_number'])], buckets, None)
+        yield jitter
+        up = GaugeMetricFamily('muvbox_running', 'MuvBox is acquiring data (status Running)', labels=labels)
+        for s in stats:
+            up.add_metric([s['name'], str(s['muvbox_number'])], 1 if s['status'] == 'Running' else 0)
+        yield up
+
+
+def start_metrics_server(M, port=9100, addr='127.0.0.1'):
+    # Serve the metrics of MuvBoxes M at http://addr:port/metrics (daemonic thread). Returns the registry.
+    from prometheus_client import CollectorRegistry, start_http_server
+    registry = CollectorRegistry()
+    registry.register(MuvBox_Collector(M))
+    start_http_server(port, addr, registry)
+    return registry
+
+
+def generate_metrics(M):
+    # Metrics of MuvBoxes M in the Prometheus text format (bytes)
+    from prometheus_client import CollectorRegistry, generate_latest
+    registry = CollectorRegistry()
+    registry.register(MuvBox_Collector(M))
+    return generate_latest(registry)
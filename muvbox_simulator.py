@@ -0,0 +1,254 @@
+"""
+    ** MuvBox simulator **
+
+    Local TCP server that behaves as a MuvBox with firmware version 0, for load testing the driver
+    without physical MuvBoxes:
+     - replies to 'system_info' with a json (free_heap, mac, firmware, sensor_task)
+     - 'start_sensor' (freq, GYRO, ACCEL) starts streaming windows of 150 packets of 24 bytes
+     - 'stop_transmission' stops streaming (the connection stays open)
+
+    The signal is synthetic (gravity + sine waves) or replayed from a csv file saved by SaveRoutine
+    (files in ./data/, read with muvbox_export.read_csv). Faults can be injected: delivery jitter, windows split in partial writes,
+    corrupted packets, dropped windows (gaps in the rtc) and disconnects.
+
+    Each simulated MuvBox listens on its own port. Many MuvBoxes run on a single event loop.
+
+    Command line (20 MuvBoxes on ports 9001 to 9020, replaying a session):
+
+    python muvbox_simulator.py --boxes 20 --port 9001 --replay ./data/2021-10-07_10-59-13.956400_teste_MUVBOX_5051.csv
+
+    Connecting the driver:
+
+    from muvbox import *
+    M = MuvBox()
+    M.name = '127.0.0.1'
+    M.port = 9001
+    M.connect()
+    M.start()
+"""
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+
+import numpy as np
+
+from muvbox import MuvBox
+from muvbox_export import read_csv
+
+
+WINDOW = 150            # Packets per window (firmware version 0)
+GSCALES = [2, 4, 8, 16]             # ACCEL 0 to 3, in g
+DEGSCALES = [250, 500, 1000, 2000]  # GYRO 0 to 3, in °/s
+
+
+def synthetic_signal(freq=1000, duration=10):
+    # Signal in g and °/s (columns accx, accy, accz, gyrx, gyry, gyrz): gravity in -z and slow oscillations
+    t = np.arange(int(freq*duration))/freq
+    s = np.zeros((len(t), 6))
+    s[:, 0] = 0.2*np.sin(2*np.pi*1.0*t)
+    s[:, 1] = 0.1*np.sin(2*np.pi*2.5*t)
+    s[:, 2] = -1 + 0.05*np.sin(2*np.pi*7.0*t)
+    s[:, 3] = 30*np.sin(2*np.pi*0.5*t)
+    s[:, 4] = 10*np.cos(2*np.pi*0.8*t)
+    s[:, 5] = 5*np.sin(2*np.pi*0.2*t)
+    return s
+
+
+def replay_signal(path):
+    # Read the sensor columns of a csv saved by SaveRoutine (first line: name;location;comment, second line: columns)
+    header, data = read_csv(path)
+    columns = header['columns']
+    s = np.zeros((len(data), 6))
+    for i, c in enumerate(['acc_x', 'acc_y', 'acc_z', 'gyr_x', 'gyr_y', 'gyr_z']):
+        if c in columns:
+            s[:, i] = np.nan_to_num(data[:, columns.index(c)])
+    return s
+
+
+class MuvBox_Simulator:
+    # One simulated MuvBox
+
+    def __init__(self, port, host='127.0.0.1', signal=None, mac='', firmware='FM10V000.950',
+                 jitter=0.0, partial=0.0, corrupt=0.0, drop=0.0, disconnect=0.0, seed=None):
+        self.host = host
+        self.port = port
+        self.signal = synthetic_signal() if signal is None else signal   # (n, 6) in g and °/s, repeated
+        self.mac = mac if mac else '24:0a:c4:00:%02x:%02x' % (port//256 % 256, port % 256)
+        self.firmware = firmware
+        self.BAT_MV = 3900      # Battery level sent, in mV
+
+        # Faults
+        self.jitter = jitter            # Maximum extra delay of a window (s)
+        self.partial = partial          # Probability of sending a window in several partial writes
+        self.corrupt = corrupt          # Probability of corrupting a packet
+        self.drop = drop                # Probability of dropping a window (gap in rtc)
+        self.disconnect = disconnect    # Mean time between disconnects while streaming (s). 0: never
+        self.random = random.Random(seed)
+
+        # Counters
+        self.connections = 0
+        self.windows_sent = 0
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.packets_corrupted = 0
+        self.windows_dropped = 0
+        self.disconnects = 0
+
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        stream = None
+        pending = ''
+        decoder = json.JSONDecoder()
+        try:
+            while True:
+                data = await reader.read(1024)
+                if not data:
+                    break
+                pending += data.decode('utf8', errors='replace')
+                # Commands are json objects without separator; several may arrive in one read
+                while pending.strip():
+                    try:
+                        command, end = decoder.raw_decode(pending.lstrip())
+                    except ValueError:
+                        break
+                    pending = pending.lstrip()[end:]
+                    name = command.get('command')
+                    if name == 'system_info':
+                        writer.write(json.dumps({'free_heap': 150000, 'mac': self.mac, 'firmware': self.firmware,
+                                                 'sensor_task': 'running'}).encode())
+                        await writer.drain()
+                    elif name == 'start_sensor':
+                        if stream is not None:
+                            stream.cancel()
+                        stream = asyncio.ensure_future(self._stream(writer, command))
+                    elif name == 'stop_transmission':
+                        if stream is not None:
+                            stream.cancel()
+                            stream = None
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            if stream is not None:
+                stream.cancel()
+            writer.close()
+
+    async def _stream(self, writer, command):
+        freq = int(command.get('freq', 1000))
+        to_g = 2**15/GSCALES[int(command.get('ACCEL', 1))]
+        to_dps = 2**15/DEGSCALES[int(command.get('GYRO', 0))]
+        scale = np.array([to_g]*3 + [to_dps]*3)
+        period = WINDOW/freq
+        rtc0 = int(time.time()*1e6) % 2**32     # Device clock (us)
+        k = 0                                   # Sample index
+        t_next = time.monotonic() + period
+        t_disconnect = time.monotonic() + self.random.expovariate(1/self.disconnect) if self.disconnect > 0 else None
+        packets = np.zeros(WINDOW, dtype=MuvBox.PACKET_V0)
+        packets['end'] = 255
+        try:
+            while True:
+                await asyncio.sleep(max(0, t_next - time.monotonic()) + self.random.uniform(0, self.jitter))
+                t_next += period
+                i = (k + np.arange(WINDOW)) % len(self.signal)
+                packets['time'] = rtc0 + (k + np.arange(WINDOW))*1000000//freq
+                k += WINDOW
+                if self.random.random() < self.drop:
+                    self.windows_dropped += 1
+                    continue
+                counts = np.clip(np.round(self.signal[i]*scale), -2**15, 2**15-1)
+                packets['acc'] = counts[:, 0:3]
+                packets['gyr'] = counts[:, 3:6]
+                packets['bat'] = self.BAT_MV
+                data = bytearray(packets.tobytes())
+                if self.corrupt > 0:
+                    for p in range(WINDOW):
+                        if self.random.random() < self.corrupt:
+                            data[p*24 + self.random.randrange(24)] ^= 0xFF
+                            self.packets_corrupted += 1
+                if self.random.random() < self.partial:
+                    # Several small writes, as seen by a slow network
+                    pos = 0
+                    while pos < len(data):
+                        n = self.random.randint(1, len(data) - pos)
+                        writer.write(bytes(data[pos:pos+n]))
+                        await writer.drain()
+                        await asyncio.sleep(0)
+                        pos += n
+                else:
+                    writer.write(bytes(data))
+                    await writer.drain()
+                self.windows_sent += 1
+                self.packets_sent += WINDOW
+                self.bytes_sent += len(data)
+                if t_disconnect is not None and time.monotonic() > t_disconnect:
+                    self.disconnects += 1
+                    writer.transport.abort()
+                    return
+        except (ConnectionError, OSError):
+            pass
+
+    def stats(self):
+        return {'port': self.port,
+                'connections': self.connections,
+                'windows_sent': self.windows_sent,
+                'packets_sent': self.packets_sent,
+                'bytes_sent': self.bytes_sent,
+                'packets_corrupted': self.packets_corrupted,
+                'windows_dropped': self.windows_dropped,
+                'disconnects': self.disconnects}
+
+
+async def run(simulators, report=0):
+    # Serve all simulators until cancelled. If report > 0, print the counters every report seconds.
+    for s in simulators:
+        await s.start()
+    try:
+        while True:
+            await asyncio.sleep(report if report > 0 else 3600)
+            if report > 0:
+                print(json.dumps([s.stats() for s in simulators]))
+    finally:
+        for s in simulators:
+            s.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='MuvBox simulator (firmware version 0)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9001, help='Port of the first MuvBox')
+    parser.add_argument('--boxes', type=int, default=1, help='Number of MuvBoxes (consecutive ports)')
+    parser.add_argument('--replay', default='', help='csv file saved by SaveRoutine (default: synthetic signal)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Maximum delay added to each window (s)')
+    parser.add_argument('--partial', type=float, default=0.0, help='Probability of partial writes per window')
+    parser.add_argument('--corrupt', type=float, default=0.0, help='Probability of corrupting a packet')
+    parser.add_argument('--drop', type=float, default=0.0, help='Probability of dropping a window')
+    parser.add_argument('--disconnect', type=float, default=0.0, help='Mean time between disconnects (s)')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--report', type=float, default=10, help='Print counters every REPORT seconds (0: never)')
+    args = parser.parse_args(argv)
+
+    signal = replay_signal(args.replay) if args.replay else None
+    simulators = [MuvBox_Simulator(args.port + i, args.host, signal, jitter=args.jitter, partial=args.partial,
+                                   corrupt=args.corrupt, drop=args.drop, disconnect=args.disconnect,
+                                   seed=None if args.seed is None else args.seed + i)
+                  for i in range(args.boxes)]
+    print('Simulating ' + str(args.boxes) + ' MuvBoxes on ' + args.host + ':' + str(args.port) + '-' + str(args.port + args.boxes - 1))
+    try:
+        asyncio.run(run(simulators, args.report))
+    except KeyboardInterrupt:
+        print(json.dumps([s.stats() for s in simulators]))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])